@@ -1,12 +1,18 @@
 import * as cdk from 'aws-cdk-lib';
 import { Duration, RemovalPolicy } from 'aws-cdk-lib';
 import * as iam from 'aws-cdk-lib/aws-iam';
+import * as lambda from 'aws-cdk-lib/aws-lambda';
 import * as s3 from 'aws-cdk-lib/aws-s3';
 import * as secretsmanager from 'aws-cdk-lib/aws-secretsmanager';
 import * as sqs from 'aws-cdk-lib/aws-sqs';
 import { Construct } from 'constructs';
 import * as crypto from 'crypto';
 
+/** 環境変数を追加できるもの(LambdaやECSのコンテナ) */
+export interface EnvironmentTarget {
+  addEnvironment(key: string, value: string): unknown;
+}
+
 interface CommonResourceStackProps extends cdk.StackProps {
   contextJson: any;
   stage: string;
@@ -44,6 +50,9 @@ export class CommonResourceStack extends cdk.Stack {
   public readonly vpcMask: number;
   public readonly maxRetries: number;
   public readonly maxCapacity: number;
+  public readonly bskySessionPrefix = 'bsky_sessions';
+  public readonly pdsCachePrefix = 'pds_cache';
+  public readonly firehoseStatePrefix = 'firehose';
 
   constructor(scope: Construct, id: string, props: CommonResourceStackProps) {
     super(scope, id, props);
@@ -74,6 +83,43 @@ export class CommonResourceStack extends cdk.Stack {
     this.ecsTaskRole = this.createEcsTaskRole();
   }
 
+  /**
+   * Blueskyのセッションをuserinfoバケットで共有するための環境変数と権限を付与する
+   * パスワードでのログインはPDSのレート制限が厳しいため、ログインするLambdaはすべてセッションを共有する
+   */
+  public grantBskySessionStore(fn: lambda.Function): void {
+    this.grantBskySessionStoreTo(fn, fn);
+  }
+
+  /**
+   * grantBskySessionStore のうち、ECSのコンテナのように環境変数の設定先と権限の付与先が異なる場合に使う
+   */
+  public grantBskySessionStoreTo(target: EnvironmentTarget, grantee: iam.IGrantable): void {
+    target.addEnvironment('BSKY_SESSION_BUCKET_NAME', this.userinfoBucket.bucketName);
+    target.addEnvironment('BSKY_SESSION_PREFIX', this.bskySessionPrefix);
+    this.userinfoBucket.grantReadWrite(grantee, `${this.bskySessionPrefix}/*`);
+  }
+
+  /**
+   * firehoseのチェックポイントと重複排除キャッシュをuserinfoバケットに保存するための環境変数と権限を付与する
+   * userinfoバケットにはユーザーのapp passwordが保存されているため、権限は保存先のプレフィックスに限る
+   */
+  public grantFirehoseState(target: EnvironmentTarget, grantee: iam.IGrantable): void {
+    target.addEnvironment('FIREHOSE_CHECKPOINT_BUCKET_NAME', this.userinfoBucket.bucketName);
+    target.addEnvironment('FIREHOSE_CHECKPOINT_KEY', `${this.firehoseStatePrefix}/checkpoint.json`);
+    target.addEnvironment('FIREHOSE_DEDUP_KEY', `${this.firehoseStatePrefix}/dedup.txt`);
+    this.userinfoBucket.grantReadWrite(grantee, `${this.firehoseStatePrefix}/*`);
+  }
+
+  /**
+   * 投稿者のDIDから解決したPDSのエンドポイントをuserinfoバケットで共有するための環境変数と権限を付与する
+   */
+  public grantPdsCache(fn: lambda.Function): void {
+    fn.addEnvironment('PDS_CACHE_BUCKET_NAME', this.userinfoBucket.bucketName);
+    fn.addEnvironment('PDS_CACHE_PREFIX', this.pdsCachePrefix);
+    this.userinfoBucket.grantReadWrite(fn, `${this.pdsCachePrefix}/*`);
+  }
+
   private createSecretManager(): secretsmanager.ISecret {
     const secretId = `${this.appName}-secretsmanager-${this.stage}`.toLowerCase();
     try {
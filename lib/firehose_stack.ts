@@ -69,13 +69,14 @@ export class FirehoseStack extends Stack {
     });
 
     const serviceName = `${commonResource.appName}-${commonResource.stage}-service`;
-    taskDefinition.addContainer('firehose', {
+    const container = taskDefinition.addContainer('firehose', {
       image: ecs.ContainerImage.fromDockerImageAsset(this.imageAsset),
       logging: logDriver,
       environment: {
         FOLLOWED_QUEUE_URL: commonResource.followedQueue.queueUrl,
         SET_WATERMARK_IMG_QUEUE_URL: commonResource.setWatermarkImgQueue.queueUrl,
         WATERMARKING_QUEUE_URL: commonResource.watermarkingQueue.queueUrl,
+        METRICS_NAMESPACE: `${commonResource.appName}/${commonResource.stage}/firehose`,
         SECRET_NAME: commonResource.secretManager.secretName,
         CLUSTER_NAME: cluster.clusterName,
         SERVICE_NAME: serviceName,
@@ -85,6 +86,8 @@ export class FirehoseStack extends Stack {
     commonResource.followedQueue.grantSendMessages(taskDefinition.taskRole);
     commonResource.setWatermarkImgQueue.grantSendMessages(taskDefinition.taskRole);
     commonResource.watermarkingQueue.grantSendMessages(taskDefinition.taskRole);
+    commonResource.grantFirehoseState(container, taskDefinition.taskRole);
+    commonResource.grantBskySessionStoreTo(container, taskDefinition.taskRole);
 
     const service = new ecs.FargateService(this, serviceName, {
       serviceName: serviceName,
@@ -27,6 +27,8 @@ export class FollowFlowStack extends Stack {
     commonResource.userinfoBucket.grantReadWrite(this.touchUserFileLambda);
     commonResource.userinfoBucket.grantReadWrite(this.followbackLambda);
     commonResource.userinfoBucket.grantReadWrite(this.sendDmLambda);
+    commonResource.grantBskySessionStore(this.followbackLambda);
+    commonResource.grantBskySessionStore(this.sendDmLambda);
 
     this.flow = this.createWorkflow(this.touchUserFileLambda, this.followbackLambda, this.sendDmLambda);
 
@@ -23,6 +23,9 @@ export class SetWatermarkImgStack extends Stack {
 
     commonResource.watermarksBucket.grantReadWrite(this.executorLambda);
     commonResource.watermarksBucket.grantReadWrite(this.notifierLambda);
+    commonResource.grantBskySessionStore(this.executorLambda);
+    commonResource.grantBskySessionStore(this.notifierLambda);
+    commonResource.grantPdsCache(this.executorLambda);
 
     this.flow = this.createWorkflow(this.notifierLambda);
     this.executorLambda.addEnvironment("STATEMACHINE_ARN", this.flow.stateMachineArn);
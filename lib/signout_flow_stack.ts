@@ -41,6 +41,8 @@ export class SignoutFlowStack extends Stack {
     commonResource.userinfoBucket.grantReadWrite(this.delUserFilesLambda);
     commonResource.userinfoBucket.grantRead(this.delWatermarksLambda);
     commonResource.watermarksBucket.grantReadWrite(this.delWatermarksLambda);
+    commonResource.grantBskySessionStore(this.findFollowEventsLambda);
+    commonResource.grantBskySessionStore(this.sendDmLambda);
 
     this.flow = this.createWorkflow(this.delUserFilesLambda, this.delWatermarksLambda, this.sendDmLambda);
     this.findFollowEventsLambda.addEnvironment("STATE_MACHINE_ARN", this.flow.stateMachineArn);
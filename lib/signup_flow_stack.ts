@@ -24,6 +24,9 @@ export class SignupFlowStack extends Stack {
     commonResource.secretManager.grantRead(this.executorLambda);
     commonResource.secretManager.grantRead(this.getterLambda);
     commonResource.secretManager.grantRead(this.notifierLambda);
+    commonResource.grantBskySessionStore(this.executorLambda);
+    commonResource.grantBskySessionStore(this.getterLambda);
+    commonResource.grantBskySessionStore(this.notifierLambda);
 
     this.flow = this.createWorkflow(this.getterLambda, this.notifierLambda);
     this.executorLambda.addEnvironment("STATEMACHINE_ARN", this.flow.stateMachineArn);
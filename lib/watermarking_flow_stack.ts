@@ -31,14 +31,21 @@ export class WatermarkingFlowStack extends cdk.Stack {
 
     // S3バケットの利用権限付与
     commonResource.originalImageBucket.grantReadWrite(this.getImageLambda);
+    commonResource.watermarksBucket.grantRead(this.getImageLambda);
+    commonResource.watermarkedImageBucket.grantRead(this.getImageLambda);
     commonResource.originalImageBucket.grantRead(this.watermarkingLambda);
     commonResource.watermarksBucket.grantRead(this.watermarkingLambda);
-    commonResource.watermarkedImageBucket.grantWrite(this.watermarkingLambda);
+    commonResource.watermarkedImageBucket.grantReadWrite(this.watermarkingLambda);
     commonResource.watermarkedImageBucket.grantRead(this.postWatermarkedLambda);
     commonResource.originalImageBucket.grantRead(this.postWatermarkedLambda);
     commonResource.userinfoBucket.grantRead(this.postWatermarkedLambda);
     commonResource.userinfoBucket.grantRead(this.delOriginalPostLambda);
     commonResource.originalImageBucket.grantRead(this.delOriginalPostLambda);
+    commonResource.grantBskySessionStore(this.getImageLambda);
+    commonResource.grantBskySessionStore(this.postWatermarkedLambda);
+    commonResource.grantBskySessionStore(this.delOriginalPostLambda);
+    commonResource.grantPdsCache(this.getImageLambda);
+    commonResource.grantPdsCache(this.watermarkingLambda);
 
     // Step Functionの作成
     this.flow = this.createWorkflow(
@@ -133,10 +140,18 @@ export class WatermarkingFlowStack extends cdk.Stack {
         LOG_LEVEL: commonResource.loglevel,
         SECRET_NAME: commonResource.secretManager.secretName,
         ORIGINAL_IMAGE_BUCKET_NAME: commonResource.originalImageBucket.bucketName,
+        WATERMARKS_BUCKET_NAME: commonResource.watermarksBucket.bucketName,
+        WATERMARKED_IMAGE_BUCKET_NAME: commonResource.watermarkedImageBucket.bucketName,
+        RESULT_CACHE_MAX_AGE_SECS: this.resultCacheMaxAgeSecs(commonResource),
       },
     });
   }
 
+  // 合成結果のキャッシュを使う期限。ライフサイクルルールで削除される前に使い終わるよう1時間短くする
+  private resultCacheMaxAgeSecs(commonResource: CommonResourceStack): string {
+    return String(Math.max(commonResource.imageExpirationDays * 24 - 1, 0) * 60 * 60);
+  }
+
   private createWatermarkingLambda(commonResource: CommonResourceStack): lambda.DockerImageFunction {
     const name = `${this.stackName}-watermarking-watermarking`;
     const code = lambda.DockerImageCode.fromImageAsset('.', {
@@ -154,6 +169,8 @@ export class WatermarkingFlowStack extends cdk.Stack {
         ORIGINAL_IMAGE_BUCKET_NAME: commonResource.originalImageBucket.bucketName,
         WATERMARKS_BUCKET_NAME: commonResource.watermarksBucket.bucketName,
         WATERMARKED_IMAGE_BUCKET_NAME: commonResource.watermarkedImageBucket.bucketName,
+        OVERLAY_CACHE_SPILL_DIR: '/tmp/watermark-overlays',
+        RESULT_CACHE_MAX_AGE_SECS: this.resultCacheMaxAgeSecs(commonResource),
       },
     });
   }
@@ -0,0 +1,146 @@
+"""firehoseの処理済みカーソルを永続化し、再起動時にそこから再開するためのチェックポイント
+
+送信済みポストの重複排除キャッシュのスナップショットは、カーソルとは別に保存する。カーソルより先まで
+送信したポストを記録しておかないと、再開時に再送されるポストを除外できないため。
+"""
+
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+
+from lib.aws.s3 import get_object, is_exiests_object, post_string_object
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class Checkpoint:
+    seq: int
+    """処理し終えた最後のseq"""
+    saved_at: float
+    """保存した時刻(UNIX時間)"""
+
+    @classmethod
+    def from_json(cls, body: str) -> "Checkpoint":
+        # 以前の形式に含まれていた重複排除キャッシュ(dedup)は使わない
+        value = json.loads(body)
+        return cls(seq=value["seq"], saved_at=value["saved_at"])
+
+
+class FileCheckpointStore:
+    """ローカルファイルにチェックポイントを保存する。重複排除キャッシュは拡張子を `.dedup` にしたファイルに保存する"""
+
+    def __init__(self, path: str):
+        self._path = Path(path)
+        self._dedup_path = self._path.with_suffix(".dedup")
+
+    def _read(self, path: Path) -> Optional[str]:
+        try:
+            return path.read_text(encoding="UTF-8")
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: Path, body: str) -> None:
+        # 書き込み途中で停止しても壊れたファイルが残らないよう、一時ファイルから置き換える
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(body, encoding="UTF-8")
+        os.replace(tmp_path, path)
+
+    def load(self) -> Optional[Checkpoint]:
+        body = self._read(self._path)
+        return Checkpoint.from_json(body) if body is not None else None
+
+    def save(self, checkpoint: Checkpoint) -> None:
+        self._write(self._path, json.dumps(asdict(checkpoint)))
+
+    def load_dedup(self) -> Optional[str]:
+        return self._read(self._dedup_path)
+
+    def save_dedup(self, snapshot: str) -> None:
+        self._write(self._dedup_path, snapshot)
+
+
+class S3CheckpointStore:
+    """S3オブジェクトにチェックポイントと重複排除キャッシュを保存する"""
+
+    def __init__(self, bucket_name: str, key: str, dedup_key: str):
+        self._bucket_name = bucket_name
+        self._key = key
+        self._dedup_key = dedup_key
+
+    def _read(self, key: str) -> Optional[str]:
+        if not is_exiests_object(self._bucket_name, key):
+            return None
+        return get_object(self._bucket_name, key)["Body"].read().decode("utf-8")
+
+    def load(self) -> Optional[Checkpoint]:
+        body = self._read(self._key)
+        return Checkpoint.from_json(body) if body is not None else None
+
+    def save(self, checkpoint: Checkpoint) -> None:
+        post_string_object(self._bucket_name, self._key, json.dumps(asdict(checkpoint)))
+
+    def load_dedup(self) -> Optional[str]:
+        return self._read(self._dedup_key)
+
+    def save_dedup(self, snapshot: str) -> None:
+        post_string_object(self._bucket_name, self._dedup_key, snapshot)
+
+
+def get_checkpoint_store() -> FileCheckpointStore | S3CheckpointStore | None:
+    """環境変数の設定に応じたチェックポイントの保存先を返す。未設定の場合は None"""
+    bucket_name = os.getenv("FIREHOSE_CHECKPOINT_BUCKET_NAME")
+    if bucket_name:
+        key = os.getenv("FIREHOSE_CHECKPOINT_KEY", default="firehose/checkpoint.json")
+        dedup_key = os.getenv("FIREHOSE_DEDUP_KEY", default="firehose/dedup.txt")
+        return S3CheckpointStore(bucket_name, key, dedup_key)
+    path = os.getenv("FIREHOSE_CHECKPOINT_PATH")
+    if path:
+        return FileCheckpointStore(path)
+    return None
+
+
+def load_checkpoint(store: FileCheckpointStore | S3CheckpointStore | None) -> Optional[Checkpoint]:
+    """チェックポイントを読み込む。未設定・未保存・読み込みに失敗した場合は None"""
+    if store is None:
+        return None
+    try:
+        return store.load()
+    except Exception as e:
+        logger.warning(f"Failed to load checkpoint: `{str(e)}`")
+        return None
+
+
+def get_resume_cursor(checkpoint: Optional[Checkpoint], max_rewind_secs: float) -> Optional[int]:
+    """再開するカーソルを返す
+
+    チェックポイントが無い場合や、max_rewind_secs より古い場合は None(最新から購読)を返す
+    """
+    if checkpoint is None:
+        logger.info("No checkpoint found, subscribing from the latest.")
+        return None
+    age = time.time() - checkpoint.saved_at
+    if age > max_rewind_secs:
+        logger.warning(
+            f"Checkpoint seq `{checkpoint.seq}` is {age:.0f}s old, "
+            f"exceeds {max_rewind_secs:.0f}s rewind window. Subscribing from the latest."
+        )
+        return None
+    logger.info(f"Resuming from checkpoint seq `{checkpoint.seq}` saved {age:.0f}s ago.")
+    return checkpoint.seq
+
+
+def load_dedup(store: FileCheckpointStore | S3CheckpointStore | None) -> Optional[str]:
+    """重複排除キャッシュのスナップショットを読み込む。未設定・未保存・読み込みに失敗した場合は None"""
+    if store is None:
+        return None
+    try:
+        return store.load_dedup()
+    except Exception as e:
+        logger.warning(f"Failed to load dedup snapshot: `{str(e)}`")
+        return None
@@ -0,0 +1,208 @@
+"""firehoseのcommitをデコードし、後段の判定に必要な最小限のポスト情報だけを返す
+
+ワーカープロセス上で実行されるため、settings など起動時に外部通信が発生するモジュールを import しないこと。
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from typing import AsyncIterator, Tuple
+
+import libipld
+from atproto import models
+
+from lib.bs.car import LazyCAR
+from lib.bs.post_message import encode_post_message
+from lib.log import get_logger
+
+_INTERESTED_RECORDS = {models.ids.AppBskyFeedPost: models.AppBskyFeedPost}
+
+logger = get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class PostDescriptor:
+    """画像付きポストの判定とキューイングに必要な情報"""
+
+    cid: str
+    uri: str
+    author: str
+    created_at: str
+    image_mime_types: Tuple[str, ...]
+    image_alts: Tuple[str, ...]
+    """Altが設定されている画像のAltのみ"""
+    message: dict = field(default_factory=dict, compare=False)
+    """キューに送るメッセージ。`lib.bs.post_message` の形式で、後段がポストを取得し直さずに済むようレコードを含む"""
+
+
+@dataclass(frozen=True)
+class DecodedCommit:
+    """commit 1件分のデコード結果"""
+
+    seq: int
+    posts: Tuple[PostDescriptor, ...]
+    elapsed: float = 0.0
+    """デコードに要した秒数"""
+    skipped: bool = False
+    """フィルタで除外されデコードしなかったか"""
+
+
+def _get_ops_by_type(body: dict) -> defaultdict:
+    """`#commit` フレームのbodyから対象コレクションの操作を取り出す
+
+    CARは必要なレコードのブロックだけをデコードするため、pydanticのCommitモデルは組み立てない
+    """
+    operation_by_type = defaultdict(lambda: {"created": [], "deleted": []})
+
+    repo = body["repo"]
+    car = LazyCAR(body["blocks"])
+    for op in body["ops"]:
+        action = op["action"]
+        if action == "update":
+            # not supported yet
+            continue
+
+        path = op["path"]
+        collection = path.split("/", 1)[0]
+        uri = f"at://{repo}/{path}"
+
+        if action == "create":
+            if not op.get("cid"):
+                continue
+
+            record_type = _INTERESTED_RECORDS.get(collection)
+            if not record_type:
+                # 対象外のコレクションはブロックをデコードしない
+                continue
+
+            create_info = {"uri": uri, "cid": libipld.encode_cid(op["cid"]), "author": repo}
+
+            record_raw_data = car.get(op["cid"])
+            if not record_raw_data:
+                continue
+
+            record = models.get_or_create(record_raw_data, strict=False)
+            if models.is_record_type(record, record_type):
+                operation_by_type[collection]["created"].append({"record": record, **create_info})
+
+        if action == "delete":
+            operation_by_type[collection]["deleted"].append({"uri": uri})
+
+    return operation_by_type
+
+
+def _to_descriptor(created_post: dict) -> PostDescriptor | None:
+    """画像を含まないポストは None を返す"""
+    record = created_post["record"]
+    images = getattr(record.embed, "images", None)
+    if not images:
+        return None
+    return PostDescriptor(
+        cid=created_post["cid"],
+        uri=created_post["uri"],
+        author=created_post["author"],
+        created_at=record.created_at,
+        image_mime_types=tuple(i.image.mime_type for i in images),
+        image_alts=tuple(i.alt for i in images if "alt" in i.model_fields_set),
+        message=encode_post_message(
+            created_post["cid"], created_post["uri"], created_post["author"], record
+        ),
+    )
+
+
+def decode_commit(body: dict) -> DecodedCommit:
+    """`#commit` フレームのbodyをデコードし、画像付きポストの情報だけを返す
+
+    Args:
+        body (dict): `MessageFrame.body`
+
+    Returns:
+        DecodedCommit: seqと画像付きポストの一覧
+    """
+    started = time.perf_counter()
+    seq = body["seq"]
+    if not body.get("blocks"):
+        return DecodedCommit(seq=seq, posts=(), elapsed=time.perf_counter() - started)
+
+    posts = []
+    ops = _get_ops_by_type(body)
+    for created_post in ops[models.ids.AppBskyFeedPost]["created"]:
+        descriptor = _to_descriptor(created_post)
+        if descriptor is not None:
+            posts.append(descriptor)
+    return DecodedCommit(seq=seq, posts=tuple(posts), elapsed=time.perf_counter() - started)
+
+
+def _ready() -> None:
+    """ワーカープロセスを起動させるための空のタスク"""
+
+
+class DecodeStage:
+    """commitのデコードをワーカープロセスへ分散し、結果を受信順に返す
+
+    workers が 0 の場合はワーカープロセスを使わず、イベントループ上でデコードする。
+    未処理の結果が max_pending 件に達すると submit は空きが出るまで待機する。
+
+    ワーカープロセスは fork で起動するため、スレッドを起動する前に生成すること。
+    fork 時に他のスレッドが保持していたロックは子プロセスで解放されず、デッドロックの原因になる。
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self._executor = None
+        if workers > 0:
+            # settings の再読込を避けるため fork で起動し、親プロセスのモジュールをそのまま引き継ぐ
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context("fork")
+            )
+            # 最初のタスクの投入時にすべてのワーカーが fork されるため、ここで起動を済ませておく
+            self._executor.submit(_ready).result()
+        self._pending: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+
+    async def submit(self, body: dict) -> None:
+        """`#commit` フレームのbodyをデコード待ちに積む"""
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            future = loop.create_future()
+            try:
+                future.set_result(decode_commit(body))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            future = loop.run_in_executor(self._executor, decode_commit, body)
+        await self._pending.put(future)
+
+    async def skip(self, seq: int) -> None:
+        """デコード不要なcommitを、カーソルの順序を保つためにデコード済みとして積む"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(DecodedCommit(seq=seq, posts=(), skipped=True))
+        await self._pending.put(future)
+
+    async def results(self) -> AsyncIterator[DecodedCommit]:
+        """submit された順にデコード結果を返す。デコードに失敗したcommitは読み飛ばす"""
+        while True:
+            future = await self._pending.get()
+            try:
+                decoded = await future
+            except Exception as e:
+                logger.warning(f"Failed to decode commit: `{str(e)}`")
+                self._pending.task_done()
+                continue
+            yield decoded
+            # 呼び出し側が次の結果を要求した時点で、前の結果は処理済みとみなす
+            self._pending.task_done()
+
+    async def join(self) -> None:
+        """submit/skip したcommitがすべて処理されるまで待つ"""
+        await self._pending.join()
+
+    def close(self) -> None:
+        """未処理のデコードを取り消し、ワーカープロセスが終了するまで待つ
+
+        実行中のデコードは短時間で終わるため待っても停止は遅れない。終了を待つことで、ワーカーの
+        リソース使用量が RUSAGE_CHILDREN に計上される
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,76 @@
+"""キューに送ったポストを記録し、再接続やカーソルの巻き戻しで同じポストを二重に送らないようにする
+
+ポストごとにウォーターマーク付与から再投稿までが実行されるため、重複はそのまま二重投稿になる。
+"""
+
+import base64
+import hashlib
+import struct
+import time
+from collections import OrderedDict
+from typing import Optional
+
+_ENTRY = struct.Struct(">8sI")
+"""スナップショットの1件分。キーのハッシュ(8バイト)と有効期限(UNIX時間の秒)"""
+
+
+def _key_of(uri: str, cid: str) -> bytes:
+    # URIとCIDを保持せず8バイトのハッシュだけを持つ。件数に対して衝突は無視できる
+    return hashlib.blake2b(f"{uri} {cid}".encode("utf-8"), digest_size=8).digest()
+
+
+class DedupCache:
+    """送信済みポストの有効期限付きLRU
+
+    max_entries を超えると最も古く登録したものから、ttl_secs を過ぎたものは参照時に削除する。
+    """
+
+    def __init__(self, max_entries: int, ttl_secs: float):
+        self._max_entries = max_entries
+        self._ttl_secs = ttl_secs
+        self._entries: OrderedDict[bytes, float] = OrderedDict()
+        self.hits = 0
+        """重複として除外した数"""
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expire(self, now: float) -> None:
+        # 登録順 = 有効期限順のため、先頭から期限切れのものだけを削除すればよい
+        while self._entries:
+            key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now:
+                return
+            del self._entries[key]
+
+    def check_and_add(self, uri: str, cid: str) -> bool:
+        """送信済みのポストであれば True を返す。未送信の場合は送信済みとして登録し False を返す"""
+        now = time.time()
+        self._expire(now)
+        key = _key_of(uri, cid)
+        if key in self._entries:
+            self.hits += 1
+            return True
+        self._entries[key] = now + self._ttl_secs
+        if len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+        return False
+
+    def dumps(self) -> str:
+        """永続化するため、有効な登録をbase64文字列にする"""
+        self._expire(time.time())
+        packed = b"".join(
+            _ENTRY.pack(key, int(expires_at)) for key, expires_at in self._entries.items()
+        )
+        return base64.b64encode(packed).decode("ascii")
+
+    def loads(self, snapshot: Optional[str]) -> None:
+        """dumps したスナップショットから登録を復元する。期限切れのものは読み飛ばす"""
+        if not snapshot:
+            return
+        now = time.time()
+        for key, expires_at in _ENTRY.iter_unpack(base64.b64decode(snapshot)):
+            if expires_at > now:
+                self._entries[key] = float(expires_at)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,137 @@
+"""firehoseに流れるフォロー・リスト登録の操作から、処理対象ユーザー(フォロイー)の集合を差分更新する"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+from atproto import AtUri, models
+
+from lib.bs.car import LazyCAR
+
+FOLLOW_COLLECTION = models.ids.AppBskyGraphFollow
+LISTITEM_COLLECTION = models.ids.AppBskyGraphListitem
+
+
+@dataclass
+class FollowSnapshot:
+    """APIから取得したフォロー・リスト登録の一覧。いずれもレコードのAT URIから対象DIDへの対応"""
+
+    bot_did: str
+    follows: Dict[str, str] = field(default_factory=dict)
+    whitelist: Dict[str, str] = field(default_factory=dict)
+    ignores: Dict[str, str] = field(default_factory=dict)
+
+
+class FollowSet:
+    """botのフォローと whitelist / 無視リストから、処理対象ユーザーの集合を保持する
+
+    whitelistに登録がある場合はwhitelistに含まれるユーザーのみを、
+    そうでない場合はフォローから無視リストのユーザーを除外したものを処理対象とする。
+    """
+
+    def __init__(
+        self,
+        snapshot: FollowSnapshot,
+        white_list_aturi: Optional[str],
+        ignore_list_aturi: Optional[str],
+    ):
+        self._white_list_aturi = white_list_aturi
+        self._ignore_list_aturi = ignore_list_aturi
+        self._journal: Optional[List[dict]] = None
+        self._load(snapshot)
+
+    @property
+    def current(self) -> Set[str]:
+        """処理対象ユーザーのDID"""
+        return self._current
+
+    @property
+    def watched_repos(self) -> Set[str]:
+        """フォロー・リスト登録の操作を監視するリポジトリのDID"""
+        return self._watched_repos
+
+    def _load(self, snapshot: FollowSnapshot) -> None:
+        self._snapshot = snapshot
+        self._watched_repos = {snapshot.bot_did}
+        for list_aturi in (self._white_list_aturi, self._ignore_list_aturi):
+            if list_aturi:
+                self._watched_repos.add(AtUri.from_str(list_aturi).host)
+        self._refresh()
+
+    def _refresh(self) -> None:
+        whitelist = set(self._snapshot.whitelist.values())
+        if len(whitelist) > 0:
+            self._current = whitelist
+        else:
+            self._current = set(self._snapshot.follows.values()).difference(
+                self._snapshot.ignores.values()
+            )
+
+    def _records_of(self, repo: str, collection: str, record: dict) -> Optional[Dict]:
+        """作成されたレコードを登録するスナップショット内の対応表を返す。対象外の場合は None"""
+        if collection == FOLLOW_COLLECTION:
+            return self._snapshot.follows if repo == self._snapshot.bot_did else None
+        if record.get("list") == self._white_list_aturi:
+            return self._snapshot.whitelist
+        if record.get("list") == self._ignore_list_aturi:
+            return self._snapshot.ignores
+        return None
+
+    def _apply_op(self, repo: str, op: dict, car: Optional[LazyCAR]) -> bool:
+        collection = op["path"].split("/", 1)[0]
+        if collection not in (FOLLOW_COLLECTION, LISTITEM_COLLECTION):
+            return False
+        uri = f"at://{repo}/{op['path']}"
+
+        if op["action"] == "create":
+            record = car.get(op["cid"]) if car is not None and op.get("cid") else None
+            if record is None or not isinstance(record.get("subject"), str):
+                return False
+            records = self._records_of(repo, collection, record)
+            if records is None:
+                return False
+            records[uri] = record["subject"]
+            return True
+
+        if op["action"] == "delete":
+            # 削除時はレコードが無いため、登録済みの一覧から探す
+            for records in (
+                self._snapshot.follows,
+                self._snapshot.whitelist,
+                self._snapshot.ignores,
+            ):
+                if records.pop(uri, None) is not None:
+                    return True
+        return False
+
+    def apply_commit(self, body: dict) -> bool:
+        """`#commit` フレームのbodyに含まれるフォロー・リスト登録の操作を反映し、変更の有無を返す"""
+        repo = body.get("repo")
+        if repo not in self._watched_repos:
+            return False
+        car = LazyCAR(body["blocks"]) if body.get("blocks") else None
+        changed = False
+        for op in body.get("ops") or ():
+            if self._apply_op(repo, op, car):
+                changed = True
+            # 現在の一覧に変更が無い操作も、再取得した一覧では有効な場合があるため記録する
+            if self._journal is not None:
+                self._journal.append({"repo": repo, "op": op, "car": car})
+        if changed:
+            self._refresh()
+        return changed
+
+    def begin_resync(self) -> None:
+        """APIからの再取得を始める。完了までに反映した操作は再取得した一覧にも適用する"""
+        self._journal = []
+
+    def cancel_resync(self) -> None:
+        self._journal = None
+
+    def finish_resync(self, snapshot: FollowSnapshot) -> None:
+        """再取得した一覧に置き換え、取得中に反映した操作を適用し直す"""
+        journal = self._journal or []
+        self._journal = None
+        self._load(snapshot)
+        for entry in journal:
+            self._apply_op(entry["repo"], entry["op"], entry["car"])
+        self._refresh()
@@ -0,0 +1,111 @@
+"""websocketの受信と処理の間に置く有界キューと、処理の遅れ(ラグ)の計測
+
+受信側はキューに積むだけにして、後段の処理が遅れても websocket の読み出しを止めないようにする。
+"""
+
+import asyncio
+import statistics
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+OVERFLOW_BLOCK = "block"
+"""キューが満杯の場合は空きが出るまで受信を待たせる。取りこぼさないが、遅れが続くとリレーから切断される"""
+OVERFLOW_DROP_NEWEST = "drop_newest"
+"""キューが満杯の場合は受信したcommitを破棄する"""
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+"""キューが満杯の場合は最も古い未処理のcommitを破棄する"""
+
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST)
+
+
+class IngestQueue:
+    """受信したcommitのbodyを処理まで保持する有界キュー
+
+    破棄するポリシーではカーソルが破棄したcommitを越えて進むため、そのポストは再起動しても処理されない。
+    """
+
+    def __init__(self, maxsize: int, overflow_policy: str = OVERFLOW_BLOCK):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown overflow policy `{overflow_policy}`, expected one of {OVERFLOW_POLICIES}."
+            )
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._overflow_policy = overflow_policy
+        self.dropped = 0
+        """満杯のため破棄したcommitの数"""
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def put(self, body: dict) -> None:
+        if self._overflow_policy == OVERFLOW_BLOCK:
+            await self._queue.put(body)
+            return
+        if self._queue.full():
+            self.dropped += 1
+            if self._overflow_policy == OVERFLOW_DROP_NEWEST:
+                return
+            self._queue.get_nowait()
+            self._queue.task_done()
+        self._queue.put_nowait(body)
+
+    async def get(self) -> dict:
+        return await self._queue.get()
+
+    def task_done(self) -> None:
+        self._queue.task_done()
+
+    async def join(self) -> None:
+        """積まれたcommitがすべて処理されるまで待つ"""
+        await self._queue.join()
+
+
+def _parse_created_at(created_at: str) -> Optional[float]:
+    """レコードの createdAt をUNIX時間に変換する。解釈できない場合は None"""
+    try:
+        parsed = datetime.fromisoformat(created_at)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+class LagMonitor:
+    """リレーから受信したseqと処理し終えたseqの差、現在時刻とレコードの作成時刻の差を集計する"""
+
+    def __init__(self):
+        self.received_seq: Optional[int] = None
+        self.processed_seq: Optional[int] = None
+        self._record_lags: List[float] = []
+
+    def on_received(self, seq: int) -> None:
+        self.received_seq = seq
+
+    def on_processed(self, seq: int) -> None:
+        self.processed_seq = seq
+
+    def on_post(self, created_at: str) -> None:
+        created = _parse_created_at(created_at)
+        if created is not None:
+            self._record_lags.append(time.time() - created)
+
+    def snapshot(self, queue: IngestQueue) -> dict:
+        """前回からの集計を返し、レコードのラグをリセットする
+
+        createdAt はクライアントが設定するため、過去の日時で投稿されたものに引きずられないよう中央値も返す
+        """
+        seq_lag = None
+        if self.received_seq is not None and self.processed_seq is not None:
+            seq_lag = self.received_seq - self.processed_seq
+        record_lags, self._record_lags = self._record_lags, []
+        return {
+            "received_seq": self.received_seq,
+            "processed_seq": self.processed_seq,
+            "seq_lag": seq_lag,
+            "record_lag_p50_secs": statistics.median(record_lags) if record_lags else None,
+            "record_lag_max_secs": max(record_lags) if record_lags else None,
+            "ingest_queue_depth": queue.qsize(),
+            "ingest_dropped": queue.dropped,
+        }
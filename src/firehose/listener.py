@@ -3,29 +3,66 @@ import json
 import os
 import signal
 import time
-from collections import defaultdict
 from types import FrameType
-from typing import Any
-
-from atproto import (
-    CAR,
-    AsyncFirehoseSubscribeReposClient,
-    AtUri,
-    Client,
-    firehose_models,
-    models,
-    parse_subscribe_repos_message,
-)
 
-from lib.aws.sqs import get_sqs_client
+from atproto import AsyncFirehoseSubscribeReposClient, firehose_models, models
+
+from firehose import metrics
+from firehose.checkpoint import (
+    Checkpoint,
+    get_checkpoint_store,
+    get_resume_cursor,
+    load_checkpoint,
+    load_dedup,
+)
+from firehose.decoder import DecodedCommit, DecodeStage, PostDescriptor
+from firehose.dedup import DedupCache
+from firehose.follows import FollowSet, FollowSnapshot
+from firehose.ingest import OVERFLOW_BLOCK, IngestQueue, LagMonitor
+from firehose.pipeline import STAGE_DECODE, STAGE_PREDICATES, FilterPipeline
+from lib.aws.sqs import AsyncSqsBatchProducer, get_sqs_client
 from lib.bs.client import get_client
-from lib.bs.graph import get_follows, get_list_members
+from lib.bs.graph import get_follow_records, get_list_aturi, get_list_item_records
 from lib.log import get_logger
+from lib.metrics import emit_emf, start_http_server
 from settings import settings
 
-_INTERESTED_RECORDS = {models.ids.AppBskyFeedPost: models.AppBskyFeedPost}
 FOLLOWED_LIST_UPDATE_INTERVAL_SECS = 600
-"""フォロイーテーブルを更新する間隔"""
+"""フォロイーテーブルをAPIから取得し直す間隔。通常はfirehoseのイベントで差分更新する"""
+CURSOR_UPDATE_INTERVAL_SEQS = 20
+"""再接続時に使うカーソルを更新する間隔"""
+DECODE_WORKERS = int(os.getenv("FIREHOSE_DECODE_WORKERS", default="0"))
+"""commitをデコードするワーカープロセス数。0の場合はイベントループ上でデコードする"""
+DECODE_MAX_PENDING = int(os.getenv("FIREHOSE_DECODE_MAX_PENDING", default="256"))
+"""デコード待ちにできるcommitの最大数"""
+FILTER_STATS_LOG_INTERVAL_SECS = 60
+"""フィルタパイプラインの集計をログ出力する間隔"""
+SQS_FLUSH_INTERVAL_SECS = float(os.getenv("SQS_FLUSH_INTERVAL_SECS", default="0.5"))
+"""キューへのバッチ送信を待ち合わせる最大秒数"""
+CHECKPOINT_INTERVAL_SECS = float(os.getenv("FIREHOSE_CHECKPOINT_INTERVAL_SECS", default="10"))
+"""処理済みカーソルを永続化する間隔"""
+MAX_REWIND_SECS = float(os.getenv("FIREHOSE_MAX_REWIND_SECS", default=str(24 * 60 * 60)))
+"""再起動時に遡って再開する最大秒数。これより古いチェックポイントは使わず最新から購読する"""
+INGEST_QUEUE_SIZE = int(os.getenv("FIREHOSE_INGEST_QUEUE_SIZE", default="4096"))
+"""受信してから処理するまで保持できるcommitの最大数"""
+INGEST_OVERFLOW_POLICY = os.getenv("FIREHOSE_INGEST_OVERFLOW_POLICY", default=OVERFLOW_BLOCK)
+"""受信キューが満杯になった場合の扱い。`block`, `drop_newest`, `drop_oldest` のいずれか"""
+DRAIN_TIMEOUT_SECS = float(os.getenv("FIREHOSE_DRAIN_TIMEOUT_SECS", default="10"))
+"""停止時に受信済みのcommitを処理し終えるまで待つ最大秒数"""
+DEDUP_MAX_ENTRIES = int(os.getenv("FIREHOSE_DEDUP_MAX_ENTRIES", default="20000"))
+"""重複排除のために記録する送信済みポストの最大数"""
+DEDUP_TTL_SECS = float(os.getenv("FIREHOSE_DEDUP_TTL_SECS", default=str(MAX_REWIND_SECS)))
+"""送信済みポストを記録しておく秒数。カーソルを巻き戻しうる範囲を覆うようにする"""
+DEDUP_PERSIST = os.getenv("FIREHOSE_DEDUP_PERSIST", default="false").lower() == "true"
+"""重複排除キャッシュをチェックポイントの保存先に永続化し、再起動後に再送されるポストも除外するか"""
+DEDUP_SAVE_INTERVAL_SECS = float(os.getenv("FIREHOSE_DEDUP_SAVE_INTERVAL_SECS", default="5"))
+"""重複排除キャッシュを永続化する間隔。停止前のこの秒数に送ったポストは、再起動後に再送されうる"""
+LAG_LOG_INTERVAL_SECS = float(os.getenv("FIREHOSE_LAG_LOG_INTERVAL_SECS", default="15"))
+"""処理の遅れをログ出力する間隔"""
+METRICS_INTERVAL_SECS = float(os.getenv("FIREHOSE_METRICS_INTERVAL_SECS", default="60"))
+"""メトリクスをEMFとして出力する間隔"""
+METRICS_HTTP_PORT = os.getenv("METRICS_HTTP_PORT")
+"""設定した場合、このポートでPrometheus形式のメトリクスを公開する"""
 
 SET_WATERMARK_IMG_QUEUE_URL = os.getenv("SET_WATERMARK_IMG_QUEUE_URL")
 WATERMARKING_QUEUE_URL = os.getenv("WATERMARKING_QUEUE_URL")
@@ -33,72 +70,54 @@ ALT_OF_SKIP_WATERMARKING = settings.ALT_OF_SKIP_WATERMARKING
 
 logger = get_logger(__name__)
 
+filter_pipeline = FilterPipeline()
+lag_monitor = LagMonitor()
+dedup_cache = DedupCache(DEDUP_MAX_ENTRIES, DEDUP_TTL_SECS)
 
-def _get_current_follows(bsclient: Client) -> set:
-    whitelist = get_list_members(bsclient, settings.WHITE_LIST_URI)
-    if len(whitelist) > 0:
-        # whitelistに登録がある場合は
-        # whitelistに含まれるユーザーのみをフォローしているとみなす
-        return whitelist
-    follows = get_follows(bsclient)
-    ignores = get_list_members(bsclient, settings.IGNORE_LIST_URI)
-    # 無視リストに登録されているユーザーを除外して返す
-    return follows.difference(ignores)
-
-
-def _get_ops_by_type(commit: models.ComAtprotoSyncSubscribeRepos.Commit) -> defaultdict:
-    operation_by_type = defaultdict(lambda: {"created": [], "deleted": []})
 
-    car = CAR.from_bytes(commit.blocks)
-    for op in commit.ops:
-        if op.action == "update":
-            # not supported yet
+def _get_follow_snapshot() -> FollowSnapshot:
+    """フォロー・whitelist・無視リストをAPIから取得する"""
+    bsclient = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
+    return FollowSnapshot(
+        bot_did=bsclient.me.did,
+        follows=get_follow_records(bsclient),
+        whitelist=get_list_item_records(bsclient, settings.WHITE_LIST_URI),
+        ignores=get_list_item_records(bsclient, settings.IGNORE_LIST_URI),
+    )
+
+
+async def resync_follows_periodically() -> None:
+    """イベントで差分更新しているフォロイーテーブルを、APIから取得した一覧で定期的に補正する"""
+    while True:
+        await asyncio.sleep(FOLLOWED_LIST_UPDATE_INTERVAL_SECS)
+        follow_set.begin_resync()
+        try:
+            # API呼び出しはイベントループを止めないようスレッドで行う
+            snapshot = await asyncio.to_thread(_get_follow_snapshot)
+        except Exception as e:
+            follow_set.cancel_resync()
+            logger.warning(f"Failed to resync Follows table: `{str(e)}`")
             continue
+        follow_set.finish_resync(snapshot)
+        logger.debug(f"Resync in memory Follows table, {len(follow_set.current)} follows.")
 
-        uri = AtUri.from_str(f"at://{commit.repo}/{op.path}")
-
-        if op.action == "create":
-            if not op.cid:
-                continue
 
-            create_info = {"uri": str(uri), "cid": str(op.cid), "author": commit.repo}
+async def log_lag_periodically(ingest_queue: IngestQueue) -> None:
+    """処理が止まっていても遅れを検知できるよう、処理とは別のタスクで出力する"""
+    while True:
+        await asyncio.sleep(LAG_LOG_INTERVAL_SECS)
+        lag = lag_monitor.snapshot(ingest_queue)
+        logger.info(f"Firehose lag: {json.dumps(lag)}")
+        metrics.seq_lag.set(lag["seq_lag"])
+        metrics.record_lag.set(lag["record_lag_p50_secs"])
+        metrics.ingest_queue_depth.set(lag["ingest_queue_depth"])
+        metrics.ingest_dropped.set(lag["ingest_dropped"])
 
-            record_raw_data = car.blocks.get(op.cid)
-            if not record_raw_data:
-                continue
-
-            record = models.get_or_create(record_raw_data, strict=False)
-            record_type = _INTERESTED_RECORDS.get(uri.collection)
-            if record_type and models.is_record_type(record, record_type):
-                operation_by_type[uri.collection]["created"].append(
-                    {"record": record, **create_info}
-                )
 
-        if op.action == "delete":
-            operation_by_type[uri.collection]["deleted"].append({"uri": str(uri)})
-
-    return operation_by_type
-
-
-def intervaled_events(func: callable) -> callable:
-    def wrapper(*args) -> Any:
-        wrapper.calls += 1
-        cur_time = time.time()
-
-        if cur_time - wrapper.start_time >= FOLLOWED_LIST_UPDATE_INTERVAL_SECS:
-            bsclient = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
-            global current_follows
-            current_follows = _get_current_follows(bsclient)
-            logger.debug(f"Update in memory Follows table, {len(current_follows)} follows.")
-            wrapper.start_time = cur_time
-            wrapper.calls = 0
-
-        return func(*args)
-
-    wrapper.calls = 0
-    wrapper.start_time = time.time()
-
-    return wrapper
+async def export_metrics_periodically() -> None:
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL_SECS)
+        emit_emf(metrics.registry)
 
 
 async def signal_handler(_: int, __: FrameType) -> None:
@@ -108,24 +127,24 @@ async def signal_handler(_: int, __: FrameType) -> None:
     await client.stop()
 
 
-async def _is_post_has_image(record) -> bool:
+async def _is_post_has_image(post: PostDescriptor) -> bool:
     """画像を含む投稿であることを判定する"""
     try:
-        if record.embed.images[0].image.mime_type.startswith("image/"):
+        if post.image_mime_types[0].startswith("image/"):
             return True
     except Exception:
         pass
     return False
 
 
-async def _is_follows_post(post, current_follows) -> bool:
+async def _is_follows_post(post: PostDescriptor, current_follows) -> bool:
     """followsによる投稿であることを判定する"""
-    return post["author"] in current_follows
+    return post.author in current_follows
 
 
-async def _is_watermarking_skip(record, desired_alt) -> bool:
+async def _is_watermarking_skip(post: PostDescriptor, desired_alt) -> bool:
     """ウォーターマーク付与を拒否するAltが含まれている事を判定する"""
-    images_alts = {i.alt for i in record.embed.images if "alt" in i.model_fields_set}
+    images_alts = set(post.image_alts)
     contains = []
     for alt in images_alts:
         if isinstance(desired_alt, str):
@@ -133,79 +152,268 @@ async def _is_watermarking_skip(record, desired_alt) -> bool:
     return any(contains)
 
 
-async def _is_set_watermark_img_post(record) -> bool:
+async def _is_set_watermark_img_post(post: PostDescriptor) -> bool:
     """ウォーターマーク画像の投稿であることを判定する"""
-    images_alts = {i.alt for i in record.embed.images if "alt" in i.model_fields_set}
+    images_alts = set(post.image_alts)
     if settings.ALT_OF_SET_WATERMARK_IMG in images_alts:
         return True
     else:
         return False
 
 
-async def main(firehose_client: AsyncFirehoseSubscribeReposClient) -> None:
-    @intervaled_events
-    async def on_message_handler(message: firehose_models.MessageFrame) -> None:
-        global current_follows
-        commit = parse_subscribe_repos_message(message)
-        if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
-            return
+async def _get_destination_queue_url(post: PostDescriptor) -> str | None:
+    """ポストの送り先キューを判定する。処理対象外のポストは None を返す"""
+    if not await _is_follows_post(post, follow_set.current):
+        # フォロイーの投稿ではない場合はスキップ
+        return None
+    metrics.follows_post_matches.inc()
+    if not await _is_post_has_image(post):
+        # 画像投稿ではない場合はスキップ
+        return None
+    metrics.has_image_matches.inc()
+    # ウォーターマーク画像の投稿を検知
+    if await _is_set_watermark_img_post(post):
+        metrics.set_watermark_img_matches.inc()
+        return SET_WATERMARK_IMG_QUEUE_URL
+    # ウォーターマーク拒否ではないコンテンツ画像の投稿を検知
+    if await _is_watermarking_skip(post, ALT_OF_SKIP_WATERMARKING) is False:
+        return WATERMARKING_QUEUE_URL
+    metrics.watermarking_skip_matches.inc()
+    return None
+
+
+async def _enqueue_decoded_commit(decoded: DecodedCommit) -> None:
+    """デコード済みcommitに含まれるポストを判定し、対象のものをキューに送る"""
+    for post in decoded.posts:
+        started = time.perf_counter()
+        queue_url = await _get_destination_queue_url(post)
+        filter_pipeline.record(
+            STAGE_PREDICATES, queue_url is not None, time.perf_counter() - started
+        )
+        if queue_url is None:
+            continue
+        if dedup_cache.check_and_add(post.uri, post.cid):
+            # 再接続やチェックポイントからの再開で、送信済みのポストを再度受信した
+            logger.info(f"Skip already enqueued post: `{post.uri}`")
+            metrics.posts_duplicated.inc()
+            continue
+        msg_body = json.dumps(post.message, ensure_ascii=False, separators=(",", ":"))
+        if queue_url == SET_WATERMARK_IMG_QUEUE_URL:
+            logger.info(f"Watermark Set Request Received: `{msg_body}`")
+        else:
+            logger.info(f"Image Post Received: {msg_body}")
+        started = time.perf_counter()
+        await sqs_producer.send(queue_url, msg_body)
+        metrics.enqueue_latency.observe((time.perf_counter() - started) * 1000)
+        metrics.posts_enqueued.inc()
+
+
+async def _save_dedup() -> bool:
+    """キューへ送り終えたポストの重複排除キャッシュを保存する
+
+    カーソルより先まで送ったポストも含まれるため、再起動後にチェックポイントから再送されるポストを除外できる
+
+    Returns:
+        bool: 送れなかったメッセージがあり、保存しなかった場合は False
+    """
+    # 送信待ちのポストも登録済みのため、送り切る前の登録を取り、送り切ってから保存する。
+    # 送る前に保存すると、停止した場合にそのポストを再送できなくなる
+    snapshot = dedup_cache.dumps()
+    dropped = await sqs_producer.flush()
+    if dropped:
+        logger.error(f"Not saving dedup snapshot: {dropped} messages were not delivered.")
+        return False
+    try:
+        await asyncio.to_thread(checkpoint_store.save_dedup, snapshot)
+    except Exception as e:
+        logger.warning(f"Failed to save dedup snapshot: `{str(e)}`")
+    return True
+
+
+async def _save_checkpoint(seq: int) -> bool:
+    """seqまでのポストをキューへ送り終えてから、チェックポイントとして保存する
+
+    Returns:
+        bool: 送れなかったメッセージがあり、保存しなかった場合は False
+    """
+    # 送信待ちのメッセージが残ったままカーソルを進めると、再起動時にそのポストを取りこぼす
+    dropped = await sqs_producer.flush()
+    if dropped:
+        logger.error(f"Not saving checkpoint seq `{seq}`: {dropped} messages were not delivered.")
+        return False
+    try:
+        checkpoint = Checkpoint(seq=seq, saved_at=time.time())
+        await asyncio.to_thread(checkpoint_store.save, checkpoint)
+    except Exception as e:
+        logger.warning(f"Failed to save checkpoint seq `{seq}`: `{str(e)}`")
+    return True
 
-        if commit.seq % 20 == 0:
-            firehose_client.update_params(
-                models.ComAtprotoSyncSubscribeRepos.Params(cursor=commit.seq)
-            )
 
-        if not commit.blocks:
-            return
+async def main(
+    firehose_client: AsyncFirehoseSubscribeReposClient, decode_stage: DecodeStage
+) -> None:
+    ingest_queue = IngestQueue(INGEST_QUEUE_SIZE, INGEST_OVERFLOW_POLICY)
 
-        ops = _get_ops_by_type(commit)
-        for created_post in ops[models.ids.AppBskyFeedPost]["created"]:
-            # https://atproto.blue/en/latest/atproto/atproto_client.models.app.bsky.feed.post.html
-            record = created_post["record"]
-
-            if not await _is_follows_post(created_post, current_follows):
-                # フォロイーの投稿ではない場合はスキップ
-                continue
-            if not await _is_post_has_image(record):
-                # 画像投稿ではない場合はスキップ
-                continue
-            msg_body = json.dumps(
-                {
-                    "cid": created_post["cid"],
-                    "uri": created_post["uri"],
-                    "author_did": created_post["author"],
-                    "created_at": record.created_at,
-                }
+    async def on_message_handler(message: firehose_models.MessageFrame) -> None:
+        started = time.perf_counter()
+        metrics.frames_received.inc()
+        if message.type != "#commit":
+            return
+        lag_monitor.on_received(message.body["seq"])
+        # 受信側はキューに積むだけにし、後段が遅れても websocket の読み出しを止めない
+        await ingest_queue.put(message.body)
+        metrics.handler_latency.observe((time.perf_counter() - started) * 1000)
+
+    async def on_ingested_commits() -> None:
+        while True:
+            body = await ingest_queue.get()
+            started = time.perf_counter()
+            try:
+                if follow_set.apply_commit(body):
+                    logger.info(
+                        f"Update in memory Follows table, {len(follow_set.current)} follows."
+                    )
+                if not filter_pipeline.accepts(body, follow_set.current):
+                    # デコード不要なcommitもカーソルを進めるため順序どおりに積む
+                    await decode_stage.skip(body["seq"])
+                else:
+                    # デコードはワーカーに任せ、結果は受信順に on_decoded_commits で処理する
+                    await decode_stage.submit(body)
+            except Exception as e:
+                logger.error(f"Failed to process seq `{body.get('seq')}`: `{str(e)}`")
+            finally:
+                ingest_queue.task_done()
+            metrics.process_latency.observe((time.perf_counter() - started) * 1000)
+
+    # 処理し終えた最後のseq
+    processed_seq = None
+    # キューへ送れなかったポストがある場合は、再起動時にそのポストから再開するようチェックポイントを進めない
+    checkpoint_held = False
+
+    def hold_checkpoint() -> None:
+        nonlocal checkpoint_held
+        if not checkpoint_held:
+            logger.error(
+                "Stop saving checkpoints until restart to redeliver posts that were not enqueued."
             )
-            # ウォーターマーク画像の投稿を検知
-            if await _is_set_watermark_img_post(record):
-                logger.info(f"Watermark Set Request Received: `{msg_body}`")
-                sqs_client.send_message(QueueUrl=SET_WATERMARK_IMG_QUEUE_URL, MessageBody=msg_body)
-                continue
-            # ウォーターマーク拒否ではないコンテンツ画像の投稿を検知
-            if await _is_watermarking_skip(record, ALT_OF_SKIP_WATERMARKING) is False:
-                logger.info(f"Image Post Received: {msg_body}")
-                sqs_client.send_message(QueueUrl=WATERMARKING_QUEUE_URL, MessageBody=msg_body)
-                continue
-
-    await client.start(on_message_handler)
+        checkpoint_held = True
+
+    async def on_decoded_commits() -> None:
+        nonlocal processed_seq
+        stats_logged_at = time.monotonic()
+        checkpointed_at = time.monotonic()
+        async for decoded in decode_stage.results():
+            if not decoded.skipped:
+                filter_pipeline.record(STAGE_DECODE, len(decoded.posts) > 0, decoded.elapsed)
+                metrics.commits_decoded.inc()
+                metrics.posts_decoded.inc(len(decoded.posts))
+                metrics.decode_latency.observe(decoded.elapsed * 1000)
+            try:
+                await _enqueue_decoded_commit(decoded)
+            except Exception as e:
+                logger.error(f"Failed to enqueue posts of seq `{decoded.seq}`: `{str(e)}`")
+                hold_checkpoint()
+            # 処理し終えたseqだけをカーソルとして扱う
+            if decoded.seq % CURSOR_UPDATE_INTERVAL_SEQS == 0:
+                firehose_client.update_params(
+                    models.ComAtprotoSyncSubscribeRepos.Params(cursor=decoded.seq)
+                )
+            if not checkpoint_held:
+                processed_seq = decoded.seq
+            lag_monitor.on_processed(decoded.seq)
+            for post in decoded.posts:
+                lag_monitor.on_post(post.created_at)
+            if (
+                checkpoint_store is not None
+                and not checkpoint_held
+                and time.monotonic() - checkpointed_at >= CHECKPOINT_INTERVAL_SECS
+            ):
+                if not await _save_checkpoint(processed_seq):
+                    hold_checkpoint()
+                checkpointed_at = time.monotonic()
+            if time.monotonic() - stats_logged_at >= FILTER_STATS_LOG_INTERVAL_SECS:
+                logger.info(f"Filter pipeline stats: {json.dumps(filter_pipeline.snapshot())}")
+                logger.info(
+                    f"Dedup cache stats: {len(dedup_cache)} entries, {dedup_cache.hits} duplicates."
+                )
+                stats_logged_at = time.monotonic()
+
+    async def save_dedup_periodically() -> None:
+        while True:
+            await asyncio.sleep(DEDUP_SAVE_INTERVAL_SECS)
+            if not checkpoint_held and not await _save_dedup():
+                hold_checkpoint()
+
+    async def drain() -> None:
+        await ingest_queue.join()
+        await decode_stage.join()
+
+    sqs_producer.start()
+    processor = asyncio.create_task(on_ingested_commits())
+    consumer = asyncio.create_task(on_decoded_commits())
+    resync = asyncio.create_task(resync_follows_periodically())
+    lag_logger = asyncio.create_task(log_lag_periodically(ingest_queue))
+    metrics_exporter = asyncio.create_task(export_metrics_periodically())
+    dedup_saver = None
+    if checkpoint_store is not None and DEDUP_PERSIST:
+        dedup_saver = asyncio.create_task(save_dedup_periodically())
+    try:
+        await firehose_client.start(on_message_handler)
+    finally:
+        resync.cancel()
+        try:
+            # 受信済みのcommitを処理し終えてから停止する
+            await asyncio.wait_for(drain(), DRAIN_TIMEOUT_SECS)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out draining received commits.")
+        lag_logger.cancel()
+        metrics_exporter.cancel()
+        processor.cancel()
+        consumer.cancel()
+        decode_stage.close()
+        if dedup_saver is not None:
+            dedup_saver.cancel()
+            if not checkpoint_held and not await _save_dedup():
+                hold_checkpoint()
+        if checkpoint_store is not None and processed_seq is not None and not checkpoint_held:
+            await _save_checkpoint(processed_seq)
+        # 送信待ちのメッセージを送り切ってから終了する
+        await sqs_producer.close()
+        emit_emf(metrics.registry)
 
 
 if __name__ == "__main__":
-    global current_follows
-    global sqs_client
-    sqs_client = get_sqs_client()
-    bsclient = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
-    current_follows = _get_current_follows(bsclient)
-    logger.info(f"Update in memory Follows table, {len(current_follows)} follows.")
+    global follow_set
+    global sqs_producer
+    global checkpoint_store
+    # ワーカープロセスを fork するため、メトリクスのサーバーなどのスレッドより先に起動する
+    decode_stage = DecodeStage(DECODE_WORKERS, DECODE_MAX_PENDING)
+    sqs_producer = AsyncSqsBatchProducer(get_sqs_client(), flush_interval=SQS_FLUSH_INTERVAL_SECS)
+    follow_set = FollowSet(
+        _get_follow_snapshot(),
+        get_list_aturi(settings.WHITE_LIST_URI),
+        get_list_aturi(settings.IGNORE_LIST_URI),
+    )
+    logger.info(f"Update in memory Follows table, {len(follow_set.current)} follows.")
+
+    if METRICS_HTTP_PORT:
+        start_http_server(metrics.registry, int(METRICS_HTTP_PORT), prefix="firehose")
+        logger.info(f"Serving Prometheus metrics on port {METRICS_HTTP_PORT}.")
 
     signal.signal(signal.SIGINT, lambda _, __: asyncio.create_task(signal_handler(_, __)))
+    # ECSのタスク停止時にもチェックポイントを保存してから終了する
+    signal.signal(signal.SIGTERM, lambda _, __: asyncio.create_task(signal_handler(_, __)))
 
-    start_cursor = None
+    checkpoint_store = get_checkpoint_store()
+    checkpoint = load_checkpoint(checkpoint_store)
+    start_cursor = get_resume_cursor(checkpoint, MAX_REWIND_SECS)
+    if DEDUP_PERSIST:
+        dedup_cache.loads(load_dedup(checkpoint_store))
+        logger.info(f"Restored {len(dedup_cache)} enqueued posts from dedup snapshot.")
 
     params = None
     if start_cursor is not None:
         params = models.ComAtprotoSyncSubscribeRepos.Params(cursor=start_cursor)
 
     client = AsyncFirehoseSubscribeReposClient(params)
-    asyncio.run(main(client))
+    asyncio.run(main(client, decode_stage))
@@ -0,0 +1,50 @@
+"""firehose listener が処理中に更新するメトリクス
+
+定期的にCloudWatch EMFのログとして出力し、METRICS_HTTP_PORT を設定した場合はPrometheus形式でも公開する。
+"""
+
+import os
+
+from lib.metrics import MetricsRegistry
+
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", default="firehose")
+"""CloudWatchメトリクスの名前空間"""
+
+registry = MetricsRegistry(METRICS_NAMESPACE, {"Service": "firehose"})
+
+frames_received = registry.counter("frames_received")
+"""websocketから受信したフレーム数"""
+commits_decoded = registry.counter("commits_decoded")
+"""フィルタを通過しデコードしたcommit数"""
+posts_decoded = registry.counter("posts_decoded")
+"""デコードした画像付きポスト数"""
+follows_post_matches = registry.counter("predicate_follows_post")
+"""`_is_follows_post` に該当したポスト数"""
+has_image_matches = registry.counter("predicate_has_image")
+"""`_is_post_has_image` に該当したポスト数"""
+set_watermark_img_matches = registry.counter("predicate_set_watermark_img_post")
+"""`_is_set_watermark_img_post` に該当したポスト数"""
+watermarking_skip_matches = registry.counter("predicate_watermarking_skip")
+"""`_is_watermarking_skip` に該当したポスト数"""
+posts_enqueued = registry.counter("posts_enqueued")
+"""キューに送ったポスト数"""
+posts_duplicated = registry.counter("posts_duplicated")
+"""送信済みのため除外したポスト数"""
+
+handler_latency = registry.histogram("handler_latency_ms")
+"""websocketの受信ハンドラの所要時間"""
+process_latency = registry.histogram("process_latency_ms")
+"""受信キューから取り出したcommitのフォロー反映・フィルタ・デコード投入の所要時間"""
+decode_latency = registry.histogram("decode_latency_ms")
+"""commitのデコードの所要時間"""
+enqueue_latency = registry.histogram("enqueue_latency_ms")
+"""ポストをキューへの送信待ちに積むまでの所要時間。送信が詰まるとここが伸びる"""
+
+seq_lag = registry.gauge("seq_lag", "Count")
+"""リレーから受信したseqと処理し終えたseqの差"""
+record_lag = registry.gauge("record_lag_p50", "Seconds")
+"""処理したポストの作成時刻から処理までの秒数の中央値"""
+ingest_queue_depth = registry.gauge("ingest_queue_depth", "Count")
+"""受信キューに積まれているcommit数"""
+ingest_dropped = registry.gauge("ingest_dropped", "Count")
+"""受信キューが満杯のため破棄したcommitの累計"""
@@ -0,0 +1,73 @@
+"""firehoseのcommitを安価な判定から順に絞り込むフィルタパイプライン
+
+各ステージの通過数(hits)、除外数(misses)、所要時間(seconds)を集計する。
+"""
+
+import time
+from dataclasses import asdict, dataclass
+
+from atproto import models
+
+STAGE_REPO = "repo"
+"""commitのリポジトリがフォロイーのものか"""
+STAGE_COLLECTION = "collection"
+"""対象コレクションへのcreateが含まれるか"""
+STAGE_DECODE = "decode"
+"""ブロックをデコードした結果、画像付きポストが含まれるか"""
+STAGE_PREDICATES = "predicates"
+"""画像・Altの判定を通過しキューに送られたか"""
+
+STAGES = (STAGE_REPO, STAGE_COLLECTION, STAGE_DECODE, STAGE_PREDICATES)
+
+INTERESTED_PATH_PREFIX = f"{models.ids.AppBskyFeedPost}/"
+
+
+@dataclass
+class StageStats:
+    hits: int = 0
+    misses: int = 0
+    seconds: float = 0.0
+
+
+def is_followed_repo(body: dict, follows: set) -> bool:
+    """commitのリポジトリがフォロイーのものであることを判定する"""
+    return body.get("repo") in follows
+
+
+def has_interested_op(body: dict) -> bool:
+    """commitに対象コレクションへのcreateが含まれることを判定する"""
+    for op in body.get("ops") or ():
+        if op.get("action") == "create" and op.get("path", "").startswith(INTERESTED_PATH_PREFIX):
+            return True
+    return False
+
+
+class FilterPipeline:
+    """ステージごとの判定結果を集計する"""
+
+    def __init__(self):
+        self.stats = {stage: StageStats() for stage in STAGES}
+
+    def record(self, stage: str, hit: bool, seconds: float) -> None:
+        stats = self.stats[stage]
+        if hit:
+            stats.hits += 1
+        else:
+            stats.misses += 1
+        stats.seconds += seconds
+
+    def accepts(self, body: dict, follows: set) -> bool:
+        """デコード前の安価な判定(repo, collection)を順に行い、通過したかを返す"""
+        started = time.perf_counter()
+        hit = is_followed_repo(body, follows)
+        checked = time.perf_counter()
+        self.record(STAGE_REPO, hit, checked - started)
+        if not hit:
+            return False
+
+        hit = has_interested_op(body)
+        self.record(STAGE_COLLECTION, hit, time.perf_counter() - checked)
+        return hit
+
+    def snapshot(self) -> dict:
+        return {stage: asdict(stats) for stage, stats in self.stats.items()}
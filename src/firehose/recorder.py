@@ -0,0 +1,127 @@
+"""firehoseのフレームを追記専用ファイルに記録し、読み出す
+
+フォーマット:
+    フレームごとに 4バイトのビッグエンディアン長 + フレーム(DAG-CBORのヘッダとボディ) を連結したもの。
+    拡張子が `.zst` の場合はzstdで圧縮する。追記するたびにzstdフレームが1つ増える。
+
+Usage:
+    ```
+    # 60秒間のフレームを記録する
+    python firehose/recorder.py frames.bin.zst --seconds 60
+    ```
+"""
+
+import argparse
+import asyncio
+import struct
+import time
+from typing import BinaryIO, Iterator, Optional
+
+import libipld
+from atproto import AsyncFirehoseSubscribeReposClient, firehose_models
+
+from lib.log import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = get_logger(__name__)
+
+_LENGTH = struct.Struct(">I")
+
+
+def _is_compressed(path: str) -> bool:
+    if not path.endswith(".zst"):
+        return False
+    if zstandard is None:
+        raise RuntimeError("`zstandard` is required to read or write `.zst` frame recordings.")
+    return True
+
+
+def encode_frame(message: firehose_models.MessageFrame) -> bytes:
+    """受信したフレームを、websocketで受信した形式のバイト列に戻す"""
+    header = {"op": message.header.op.value, "t": message.type}
+    return libipld.encode_dag_cbor(header) + libipld.encode_dag_cbor(message.body)
+
+
+class FrameRecorder:
+    """フレームをファイルに追記する"""
+
+    def __init__(self, path: str):
+        self._file: BinaryIO = open(path, "ab")
+        self._writer: BinaryIO = self._file
+        if _is_compressed(path):
+            self._writer = zstandard.ZstdCompressor().stream_writer(self._file)
+        self.frames = 0
+
+    def __enter__(self) -> "FrameRecorder":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def write(self, frame: bytes) -> None:
+        self._writer.write(_LENGTH.pack(len(frame)))
+        self._writer.write(frame)
+        self.frames += 1
+
+    def close(self) -> None:
+        self._writer.close()
+        if not self._file.closed:
+            self._file.close()
+
+
+def _read_exact(reader: BinaryIO, size: int) -> bytes:
+    """sizeバイト読み出す。ファイル末尾に達した場合はそこまでを返す"""
+    chunks = []
+    while size > 0:
+        chunk = reader.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frames(path: str) -> Iterator[bytes]:
+    """記録したフレームを記録順に返す"""
+    with open(path, "rb") as f:
+        reader: BinaryIO = f
+        if _is_compressed(path):
+            reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True)
+        while True:
+            prefix = _read_exact(reader, _LENGTH.size)
+            if len(prefix) < _LENGTH.size:
+                return
+            (length,) = _LENGTH.unpack(prefix)
+            yield _read_exact(reader, length)
+
+
+async def record(path: str, seconds: Optional[float], max_frames: Optional[int]) -> int:
+    """firehoseを購読し、指定した秒数またはフレーム数だけ記録する"""
+    client = AsyncFirehoseSubscribeReposClient()
+    started = time.monotonic()
+
+    with FrameRecorder(path) as recorder:
+
+        async def on_message_handler(message: firehose_models.MessageFrame) -> None:
+            recorder.write(encode_frame(message))
+            if (seconds is not None and time.monotonic() - started >= seconds) or (
+                max_frames is not None and recorder.frames >= max_frames
+            ):
+                await client.stop()
+
+        await client.start(on_message_handler)
+        return recorder.frames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record firehose frames to a file.")
+    parser.add_argument("path", help="output path, compressed with zstd if it ends with `.zst`")
+    parser.add_argument("--seconds", type=float, default=None)
+    parser.add_argument("--frames", type=int, default=None)
+    args = parser.parse_args()
+    recorded = asyncio.run(record(args.path, args.seconds, args.frames))
+    logger.info(f"Recorded {recorded} frames to `{args.path}`")
@@ -0,0 +1,169 @@
+"""記録したフレームを listener の処理にできるだけ速く流し込み、スループットを計測する
+
+SQSへの送信はメモリ上のシンクに置き換える。listener と同じく settings を読み込むため SECRET_NAME が必要。
+
+Usage:
+    ```
+    python firehose/replay.py frames.bin.zst --workers 2
+    ```
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from atproto import firehose_models
+
+import firehose.listener as listener
+from firehose.decoder import DecodeStage
+from firehose.follows import FollowSet, FollowSnapshot
+from firehose.ingest import LagMonitor
+from firehose.recorder import read_frames
+
+
+class InMemorySqsProducer:
+    """`AsyncSqsBatchProducer` の代わりに、送信したメッセージをメモリに保持する"""
+
+    def __init__(self):
+        self.messages: List[Tuple[str, str]] = []
+
+    def start(self) -> None:
+        pass
+
+    async def send(self, queue_url: str, body: str) -> None:
+        self.messages.append((queue_url, body))
+
+    async def flush(self) -> int:
+        return 0
+
+    async def close(self) -> int:
+        return 0
+
+
+class LatencyRecorder(LagMonitor):
+    """commitのフレームを読み込んでから、そのseqをデコード・判定・送信し終えるまでの秒数を記録する
+
+    handler は受信キューに積むだけのため、listener が処理し終えたseqを通知する on_processed で計測する
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.read_at: Dict[int, float] = {}
+        self.latencies: List[float] = []
+
+    def on_processed(self, seq: int) -> None:
+        super().on_processed(seq)
+        read_at = self.read_at.pop(seq, None)
+        if read_at is not None:
+            self.latencies.append(time.perf_counter() - read_at)
+
+
+class ReplayFirehoseClient:
+    """記録したフレームを受信順に handler へ渡す、firehose client の代替"""
+
+    def __init__(self, frames: Iterable[bytes], recorder: LatencyRecorder):
+        self._frames = frames
+        self._recorder = recorder
+        self._stopped = False
+        self.frames = 0
+
+    def update_params(self, params) -> None:
+        pass
+
+    async def start(self, on_message_callback) -> None:
+        for raw_frame in self._frames:
+            if self._stopped:
+                break
+            read_at = time.perf_counter()
+            frame = firehose_models.Frame.from_bytes(raw_frame)
+            if isinstance(frame, firehose_models.MessageFrame):
+                if frame.type == "#commit":
+                    self._recorder.read_at[frame.body["seq"]] = read_at
+                await on_message_callback(frame)
+            self.frames += 1
+
+    async def stop(self) -> None:
+        self._stopped = True
+
+
+def _get_repos(path: str) -> Set[str]:
+    """記録に含まれるcommitのリポジトリをすべて返す"""
+    repos = set()
+    for raw_frame in read_frames(path):
+        frame = firehose_models.Frame.from_bytes(raw_frame)
+        if isinstance(frame, firehose_models.MessageFrame) and frame.type == "#commit":
+            repos.add(frame.body["repo"])
+    return repos
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def replay(path: str, follows: Set[str], workers: int) -> dict:
+    """記録したフレームを listener.main に流し込み、計測結果を返す"""
+    # スレッドを使う処理より先にワーカープロセスを fork する
+    decode_stage = DecodeStage(workers, listener.DECODE_MAX_PENDING)
+    # 計測中にAPIからフォロイーを取得し直さない
+    listener.FOLLOWED_LIST_UPDATE_INTERVAL_SECS = 10**9
+    listener.checkpoint_store = None
+    listener.sqs_producer = InMemorySqsProducer()
+    listener.follow_set = FollowSet(
+        FollowSnapshot(bot_did="", follows={did: did for did in follows}), None, None
+    )
+    recorder = LatencyRecorder()
+    listener.lag_monitor = recorder
+    client = ReplayFirehoseClient(read_frames(path), recorder)
+    listener.client = client
+
+    started = time.perf_counter()
+    await listener.main(client, decode_stage)
+    elapsed = time.perf_counter() - started
+
+    frames = client.frames
+    return {
+        "frames": frames,
+        "workers": workers,
+        "elapsed_secs": elapsed,
+        "events_per_sec": frames / elapsed if elapsed > 0 else 0.0,
+        # commitのフレームを読み込んでから処理し終えるまで
+        "latency_p50_ms": _percentile(recorder.latencies, 0.50) * 1000,
+        "latency_p99_ms": _percentile(recorder.latencies, 0.99) * 1000,
+        "enqueued": len(listener.sqs_producer.messages),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # listener.main はワーカーを終了するまで待つため、終了したワーカーの最大値が含まれる
+        "peak_rss_workers_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        "filter_pipeline": listener.filter_pipeline.snapshot(),
+    }
+
+
+def _load_follows(path: Optional[str]) -> Optional[Set[str]]:
+    if path is None:
+        return None
+    with open(path, "r", encoding="UTF-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded firehose frames.")
+    parser.add_argument("path", help="recording written by firehose/recorder.py")
+    parser.add_argument(
+        "--follows",
+        default=None,
+        help="file of followed DIDs, one per line. all repos in the recording by default",
+    )
+    parser.add_argument("--workers", type=int, default=listener.DECODE_WORKERS)
+    args = parser.parse_args()
+
+    follows = _load_follows(args.follows)
+    if follows is None:
+        # 全リポジトリをフォローしている最悪ケースで計測する
+        follows = _get_repos(args.path)
+    print(json.dumps(asyncio.run(replay(args.path, follows, args.workers)), indent=2))
@@ -20,6 +20,48 @@ def get_object(bucket_name, key):
     return s3.get_object(Bucket=bucket_name, Key=key)
 
 
+def head_object(bucket_name, key):
+    """Get metadata of the object, such as ETag, without its body"""
+    return s3.head_object(Bucket=bucket_name, Key=key)
+
+
+def copy_object(bucket_name, src_key, dst_key, metadata=None, content_type=None):
+    """Copy the object within the bucket on the S3 side, without downloading it
+
+    Args:
+        metadata (Optional[dict]): User metadata of the copy, replacing that of the source if given
+        content_type (Optional[str]): Content-Type of the copy, used only with `metadata`
+    """
+    kwargs = {}
+    if metadata is not None:
+        kwargs = {"Metadata": metadata, "MetadataDirective": "REPLACE"}
+        if content_type is not None:
+            kwargs["ContentType"] = content_type
+    return s3.copy_object(
+        Bucket=bucket_name,
+        Key=dst_key,
+        CopySource={"Bucket": bucket_name, "Key": src_key},
+        **kwargs,
+    )
+
+
+def list_objects(bucket_name, prefix):
+    """Get all objects under the prefix"""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def delete_objects(bucket_name, keys):
+    """Delete the objects in batches of 1000, the maximum of a request"""
+    keys = list(keys)
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in keys[i : i + 1000]], "Quiet": True},
+        )
+
+
 def get_object_keys(bucket_name, regex):
     regex += "$"  # 末尾文字を付与
     obj_list = get_all_objects(bucket_name)
@@ -75,6 +117,24 @@ def post_bytes_object(bucket_name: str, key: str, body: BytesIO):
     s3.upload_fileobj(body, bucket_name, key)
 
 
+def put_bytes_object_if(bucket_name: str, key: str, body: bytes, etag=None):
+    """Create the object only if it does not exist, or replace it only if its ETag is `etag`
+
+    Returns:
+        Optional[str]: ETag of the written object, or None if the condition failed
+    See:
+        https://docs.aws.amazon.com/AmazonS3/latest/userguide/conditional-writes.html
+    """
+    condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+    try:
+        return s3.put_object(Bucket=bucket_name, Key=key, Body=body, **condition)["ETag"]
+    except s3.exceptions.ClientError as e:
+        # 412: 条件を満たさない, 409: 同じキーへの条件付き書き込みが競合した
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+            return None
+        raise
+
+
 def post_string_object(bucket_name: str, key: str, body: str):
     bytes_body = BytesIO(body.encode("utf-8"))
     s3.upload_fileobj(bytes_body, bucket_name, key)
@@ -1,7 +1,18 @@
+import asyncio
 import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
 
 import boto3
 
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+MAX_BATCH_SIZE = 10
+"""Maximum number of entries accepted by SendMessageBatch"""
+
 
 def send_followed_to_queue(client: boto3.client, queue_url: str, message: str) -> None:
     try:
@@ -17,3 +28,201 @@ def get_sqs_client() -> boto3.client:
         boto3.client: SQS client
     """
     return boto3.client("sqs", region_name=os.getenv("AWS_REGION"))
+
+
+def send_message_batch(
+    client: boto3.client, queue_url: str, bodies: List[str], max_attempts: int = 3
+) -> List[str]:
+    """Send up to 10 messages with SendMessageBatch, retrying entries that failed on the AWS side
+
+    Args:
+        client (boto3.client): SQS client
+        queue_url (str): Destination queue URL
+        bodies (List[str]): Message bodies, at most `MAX_BATCH_SIZE`
+        max_attempts (int): Attempts for each entry, including the first one
+
+    Returns:
+        List[str]: Message bodies that could not be sent
+    """
+    entries = [{"Id": str(i), "MessageBody": body} for i, body in enumerate(bodies)]
+    undeliverable: List[str] = []
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            time.sleep(0.1 * 2**attempt)
+        resp = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed = resp.get("Failed", [])
+        if not failed:
+            return undeliverable
+        failed_ids = {f["Id"] for f in failed if not f.get("SenderFault")}
+        for f in failed:
+            logger.warning(f"Failed to send message to `{queue_url}`: `{f.get('Message')}`")
+            if f.get("SenderFault"):
+                # 送信内容に問題がある場合は再送しても成功しない
+                undeliverable.extend(e["MessageBody"] for e in entries if e["Id"] == f["Id"])
+        entries = [e for e in entries if e["Id"] in failed_ids]
+        if not entries:
+            return undeliverable
+    return undeliverable + [e["MessageBody"] for e in entries]
+
+
+class SqsBatchProducer:
+    """Buffer messages per queue and send them with SendMessageBatch
+
+    Buffered messages are sent when a queue has `MAX_BATCH_SIZE` messages, when the oldest one
+    has waited `flush_interval` seconds, or when the producer is closed.
+
+    Usage:
+        ```
+        with SqsBatchProducer(get_sqs_client()) as producer:
+            for did in dids:
+                producer.send(queue_url, json.dumps({"did": did}))
+        ```
+    """
+
+    def __init__(self, client: boto3.client, flush_interval: float = 1.0, max_attempts: int = 3):
+        self._client = client
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._buffers: Dict[str, List[str]] = defaultdict(list)
+        self._oldest_at: Optional[float] = None
+
+    def __enter__(self) -> "SqsBatchProducer":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.flush()
+
+    def send(self, queue_url: str, body: str) -> None:
+        buffer = self._buffers[queue_url]
+        buffer.append(body)
+        if self._oldest_at is None:
+            self._oldest_at = time.monotonic()
+        if len(buffer) >= MAX_BATCH_SIZE:
+            self._flush_queue(queue_url)
+        elif time.monotonic() - self._oldest_at >= self._flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        for queue_url in list(self._buffers):
+            self._flush_queue(queue_url)
+        self._oldest_at = None
+
+    def _flush_queue(self, queue_url: str) -> None:
+        bodies = self._buffers.pop(queue_url, [])
+        if not bodies:
+            return
+        try:
+            undeliverable = send_message_batch(self._client, queue_url, bodies, self._max_attempts)
+        except Exception as e:
+            logger.error(f"Failed to send {len(bodies)} messages to `{queue_url}`: {e}")
+            return
+        if undeliverable:
+            logger.error(f"Dropped {len(undeliverable)} messages to `{queue_url}`")
+
+
+class AsyncSqsBatchProducer:
+    """asyncio version of `SqsBatchProducer` that never blocks the event loop
+
+    `send` waits while `max_buffer` messages are waiting to be sent, so a slow SQS
+    slows the caller down instead of growing memory without bound.
+    SendMessageBatch calls run in a worker thread from a background task.
+    `flush` and `close` return the number of messages given up since the previous call, so that
+    callers can avoid acknowledging input whose messages were not delivered.
+
+    Usage:
+        ```
+        async with AsyncSqsBatchProducer(get_sqs_client()) as producer:
+            await producer.send(queue_url, body)
+        ```
+    """
+
+    def __init__(
+        self,
+        client: boto3.client,
+        flush_interval: float = 1.0,
+        max_buffer: int = 1000,
+        max_attempts: int = 3,
+    ):
+        self._client = client
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_buffer)
+        self._flusher: Optional[asyncio.Task] = None
+        self._dropped = 0
+
+    async def __aenter__(self) -> "AsyncSqsBatchProducer":
+        self.start()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def send(self, queue_url: str, body: str) -> None:
+        await self._queue.put((queue_url, body))
+
+    async def flush(self) -> int:
+        """Wait until every message passed to `send` so far has been sent or given up
+
+        Returns:
+            int: Number of messages given up since the previous `flush`
+        """
+        if self._flusher is not None:
+            # the marker makes the background task send without waiting for `flush_interval`
+            await self._queue.put(None)
+            await self._queue.join()
+        dropped, self._dropped = self._dropped, 0
+        return dropped
+
+    async def close(self) -> int:
+        """Send all buffered messages and stop the background task
+
+        Returns:
+            int: Number of messages given up since the previous `flush`
+        """
+        dropped = await self.flush()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        return dropped
+
+    async def _run(self) -> None:
+        while True:
+            buffers: Dict[str, List[str]] = defaultdict(list)
+            taken = 0
+            deadline = None
+            while True:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                taken += 1
+                if item is None:
+                    # flush requested
+                    break
+                queue_url, body = item
+                buffers[queue_url].append(body)
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+                if len(buffers[queue_url]) >= MAX_BATCH_SIZE:
+                    break
+
+            for url, bodies in buffers.items():
+                try:
+                    undeliverable = await asyncio.to_thread(
+                        send_message_batch, self._client, url, bodies, self._max_attempts
+                    )
+                    if undeliverable:
+                        self._dropped += len(undeliverable)
+                        logger.error(f"Dropped {len(undeliverable)} messages to `{url}`")
+                except Exception as e:
+                    self._dropped += len(bodies)
+                    logger.error(f"Failed to send {len(bodies)} messages to `{url}`: {e}")
+            for _ in range(taken):
+                self._queue.task_done()
@@ -0,0 +1,84 @@
+from typing import Dict, Optional, Tuple
+
+import libipld
+from atproto.exceptions import InvalidCARFile
+
+_CIDV0_PREFIX = b"\x12\x20"
+_CIDV0_LENGTH = 34
+
+
+def _read_varint(view: memoryview, pos: int) -> Tuple[int, int]:
+    """Read an unsigned LEB128 varint and return it with the position after it"""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(view):
+            raise InvalidCARFile("Unexpected end of CAR file while reading varint.")
+        byte = view[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _read_cid_length(view: memoryview, pos: int) -> int:
+    """Return the byte length of the binary CID starting at `pos`"""
+    if view[pos : pos + 2] == _CIDV0_PREFIX:
+        return _CIDV0_LENGTH
+    end = pos
+    _, end = _read_varint(view, end)  # version
+    _, end = _read_varint(view, end)  # codec
+    _, end = _read_varint(view, end)  # multihash code
+    digest_size, end = _read_varint(view, end)
+    return end + digest_size - pos
+
+
+class LazyCAR:
+    """CAR file reader that decodes blocks only when requested
+
+    Unlike `atproto.CAR.from_bytes`, which decodes every block of the CAR file up front,
+    this only indexes block offsets in a single pass over a memoryview of `data`.
+
+    Usage:
+        ```
+        car = LazyCAR(commit_body["blocks"])
+        record = car.get(op["cid"])
+        ```
+    """
+
+    def __init__(self, data: bytes):
+        self._view = memoryview(data)
+        self._offsets: Dict[bytes, Tuple[int, int]] = {}
+
+        header_length, pos = _read_varint(self._view, 0)
+        pos += header_length  # roots are not needed to look up blocks
+        if pos > len(self._view):
+            raise InvalidCARFile("Unexpected end of CAR file while reading header.")
+        while pos < len(self._view):
+            block_length, pos = _read_varint(self._view, pos)
+            block_end = pos + block_length
+            if block_end > len(self._view):
+                raise InvalidCARFile("Unexpected end of CAR file while reading block.")
+            cid_end = pos + _read_cid_length(self._view, pos)
+            if cid_end > block_end:
+                raise InvalidCARFile("Block CID exceeds the block length.")
+            self._offsets[self._view[pos:cid_end].tobytes()] = (cid_end, block_end)
+            pos = block_end
+
+    def __contains__(self, cid: bytes) -> bool:
+        return cid in self._offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get(self, cid: bytes) -> Optional[dict]:
+        """Decode the block of the binary CID, or return None if it is not in the CAR file
+
+        Only the requested block is copied out of the CAR file, as libipld requires `bytes`.
+        """
+        offset = self._offsets.get(cid)
+        if offset is None:
+            return None
+        start, end = offset
+        return libipld.decode_dag_cbor(self._view[start:end].tobytes())
@@ -1,37 +1,76 @@
-import tempfile
 from typing import Optional
 
 from atproto import Client, Session, SessionEvent
 
-temp_file_name = "saved_session.txt"
+from lib.bs.session_store import get_session_store
+from lib.log import get_logger
 
+logger = get_logger(__name__)
 
-def get_session() -> Optional[str]:
-    try:
-        with open(temp_file_name, "r", encoding="UTF-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        return None
-    except Exception:
-        return None
+session_store = get_session_store()
 
 
-def save_session(session_string: str) -> None:
-    with tempfile.NamedTemporaryFile(mode="w", encoding="UTF-8", delete=False) as f:
-        temp_file_name = f.name  # noqa
-        f.write(session_string)
+class StoredSessionClient(Client):
+    """Client whose session is kept in the session store
 
+    Sessions created or refreshed by the client are saved to the store, and refreshes are done
+    under the lease of the identity. The holder first adopts a session another process has rotated
+    in the meantime, so that the spent refresh token is not used.
 
-def on_session_change(event: SessionEvent, session: Session) -> None:
-    print("Session changed:", event, repr(session))
-    if event in (SessionEvent.CREATE, SessionEvent.REFRESH):
-        print("Saving changed session")
-        save_session(session.export())
+    Args:
+        identifier (str): Bluesky User Handle or DID, the key of the session in the store
+    """
+
+    def __init__(self, *args, identifier: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.identifier = identifier
+
+        # The dispatcher only accepts plain functions, not bound methods
+        def on_session_change(event: SessionEvent, session: Session) -> None:
+            self._save_session(event, session)
+
+        self.on_session_change(on_session_change)
+
+    def clone(self) -> "StoredSessionClient":
+        cloned_client = super().clone()
+        cloned_client.identifier = self.identifier
+        return cloned_client
+
+    def _save_session(self, event: SessionEvent, session: Session) -> None:
+        logger.debug(f"Session changed: {event} {repr(session)}")
+        if self.identifier and event in (SessionEvent.CREATE, SessionEvent.REFRESH):
+            session_store.save(self.identifier, session.export())
+
+    def _refresh_and_set_session(self):
+        if not self.identifier:
+            return super()._refresh_and_set_session()
+        with session_store.lease(self.identifier):
+            stored = session_store.get(self.identifier, reload=True)
+            if stored and self._session and stored != self._session.export():
+                self._import_session_string(stored)
+                if not self._should_refresh_session():
+                    logger.info("Adopted the session refreshed by another process")
+                    return None
+            return super()._refresh_and_set_session()
+
+
+def _login_with_session(client: Client, session_string: Optional[str]) -> bool:
+    if not session_string:
+        return False
+    try:
+        client.login(session_string=session_string)
+        return True
+    except Exception as e:
+        logger.info(f"Stored session was rejected: `{str(e)}`")
+        return False
 
 
 def get_client(identifier: str, password: str) -> Client:
     """Login to the Bsky app
 
+    Reuses the session of the identity in the session store, and logs in with the password only if
+    there is none or it was rejected (e.g. the refresh token expired).
+
     Args:
         identifier (str): Bluesky User Handle
         password (str): Bluesky User App Password
@@ -41,16 +80,18 @@ def get_client(identifier: str, password: str) -> Client:
     SeeAlso:
         https://docs.bsky.app/docs/api/com-atproto-server-create-session
     """
-    client = Client()
-    # session reusing configuration
-    client.on_session_change(on_session_change)
-
-    session_string = get_session()
-    if session_string:
-        client.login(session_string=session_string)
-    else:
+    client = StoredSessionClient(identifier=identifier)
+    session_string = session_store.get(identifier)
+    if _login_with_session(client, session_string):
+        return client
+
+    with session_store.lease(identifier):
+        # Another process may have logged in while this one was waiting for the lease
+        stored = session_store.get(identifier, reload=True)
+        if stored != session_string and _login_with_session(client, stored):
+            return client
+        logger.info("Logging in with the password")
         client.login(identifier, password)
-
     return client
 
 
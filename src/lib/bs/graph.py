@@ -1,4 +1,5 @@
 import re
+from typing import Dict, Optional
 
 import atproto
 from atproto import Client, models
@@ -50,19 +51,72 @@ def get_follows(client: Client):
     return set([i.did for i in follows])
 
 
+def get_list_aturi(list_uri: str) -> Optional[str]:
+    """Convert the bsky.app URL of the list to its AT URI
+
+    See:
+        `https://bsky.app/profile/did:plc:xxx/lists/yyy` -> `at://did:plc:xxx/app.bsky.graph.list/yyy`
+    """
+    mat = re.match(
+        r"^https://bsky.app/profile/(did:plc:[a-z0-9]+)/lists/([a-z0-9]+)$", list_uri or ""
+    )
+    if mat is None:
+        return None
+    list_did, id = mat.groups()
+    return f"at://{list_did}/app.bsky.graph.list/{id}"
+
+
 def get_list_members(client: Client, list_uri: str):
     """Get the list of users in the list"""
     try:
-        mat = re.match(
-            r"^https://bsky.app/profile/(did:plc:[a-z0-9]+)/lists/([a-z0-9]+)$", list_uri
-        )
-        if mat.groups() is None:
+        aturi = get_list_aturi(list_uri)
+        if aturi is None:
             logger.warning(f"Invalid list uri: `{list_uri}`")
             return set()
-        list_did, id = mat.groups()
-        aturi = f"at://{list_did}/app.bsky.graph.list/{id}"
         ignore_list = client.app.bsky.graph.get_list(models.AppBskyGraphGetList.Params(list=aturi))
         return set([item.subject.did for item in ignore_list.items])
     except Exception as e:
         logger.warning(f"Failed to get ignore list members: `{str(e)}`")
         return set()
+
+
+def get_follow_records(client: Client) -> Dict[str, str]:
+    """Get the follow records of the bot, as pairs of the record AT URI and the followed DID"""
+    cursor = None
+    records = {}
+
+    while True:
+        fetched: models.AppBskyGraphGetFollows.Response = client.get_follows(
+            actor=client.me.did, cursor=cursor, limit=100
+        )
+        for i in fetched.follows:
+            if i.viewer and i.viewer.following:
+                records[i.viewer.following] = i.did
+        if not fetched.cursor:
+            break
+        cursor = fetched.cursor
+    return records
+
+
+def get_list_item_records(client: Client, list_uri: str) -> Dict[str, str]:
+    """Get the list items of the list, as pairs of the listitem AT URI and the member DID"""
+    aturi = get_list_aturi(list_uri)
+    if aturi is None:
+        logger.warning(f"Invalid list uri: `{list_uri}`")
+        return {}
+    cursor = None
+    records = {}
+    try:
+        while True:
+            fetched: models.AppBskyGraphGetList.Response = client.app.bsky.graph.get_list(
+                models.AppBskyGraphGetList.Params(list=aturi, cursor=cursor, limit=100)
+            )
+            for item in fetched.items:
+                records[item.uri] = item.subject.did
+            if not fetched.cursor:
+                break
+            cursor = fetched.cursor
+    except Exception as e:
+        logger.warning(f"Failed to get list items: `{str(e)}`")
+        return {}
+    return records
@@ -0,0 +1,201 @@
+"""Cache of the PDS endpoints of DIDs, and of a client per PDS endpoint
+
+Blobs are served by the PDS the author's repository lives on, which is found in the DID document.
+PDS endpoints almost never change, so they are kept in memory for `PDS_CACHE_TTL_SECS`, optionally
+backed by a persisted store shared across cold starts (the string stores of `lib.store`, under
+`PDS_CACHE_BUCKET_NAME` or `PDS_CACHE_DIR`). DIDs that do not resolve are cached for
+`PDS_NEGATIVE_CACHE_TTL_SECS` so that repeated events do not hit the PLC directory.
+
+A fetch from a cached endpoint that fails to connect, or that the PDS answers as if the repository
+had left it, re-resolves the DID and retries once if the PDS moved. Other errors, such as a missing
+blob, are raised as they are. A DID is re-resolved at most once per `PDS_REFRESH_INTERVAL_SECS`.
+Clients are kept per PDS endpoint so that their keep-alive connections are reused across calls.
+"""
+
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import httpx
+from atproto import Client, IdResolver, exceptions, models
+
+from lib.log import get_logger
+from lib.store import FileStringStore, S3StringStore
+
+logger = get_logger(__name__)
+
+PDS_CACHE_TTL_SECS = float(os.getenv("PDS_CACHE_TTL_SECS", default=str(24 * 60 * 60)))
+"""Resolved PDS endpoints are used for this long without resolving again"""
+PDS_NEGATIVE_CACHE_TTL_SECS = float(os.getenv("PDS_NEGATIVE_CACHE_TTL_SECS", default="300"))
+"""DIDs that did not resolve are not resolved again for this long"""
+PDS_REFRESH_INTERVAL_SECS = float(os.getenv("PDS_REFRESH_INTERVAL_SECS", default="60"))
+"""A failed fetch does not re-resolve a DID resolved less than this long ago"""
+PDS_CACHE_BUCKET_NAME = os.getenv("PDS_CACHE_BUCKET_NAME")
+PDS_CACHE_PREFIX = os.getenv("PDS_CACHE_PREFIX", default="pds_cache")
+PDS_CACHE_DIR = os.getenv("PDS_CACHE_DIR")
+"""Directory of the persisted store, used if PDS_CACHE_BUCKET_NAME is not set. Memory only if neither"""
+
+
+class UnresolvableDidError(Exception):
+    pass
+
+
+_MOVED_ERRORS = {"RepoNotFound", "RepoDeactivated"}
+"""XRPC errors of a PDS the repository has migrated away from"""
+
+
+def _key(did: str) -> str:
+    return hashlib.sha256(did.encode("utf-8")).hexdigest()
+
+
+def _may_have_moved(e: Exception) -> bool:
+    """Whether the error of a fetch suggests that the PDS of the repository changed"""
+    if isinstance(e, exceptions.RequestErrorBase) and e.response is not None:
+        return getattr(e.response.content, "error", None) in _MOVED_ERRORS
+    # No response: the connection failed or timed out
+    return isinstance(e, (exceptions.NetworkError, httpx.TransportError))
+
+
+class PdsResolver:
+    """Resolves DIDs to PDS endpoints and clients, with an in-memory TTL cache
+
+    Args:
+        ttl_secs (float): How long a resolved endpoint is used
+        negative_ttl_secs (float): How long a DID that did not resolve is not resolved again
+        backend (FileStringStore | S3StringStore | None): Persisted store of the endpoints
+        refresh_interval_secs (float): Minimum age of an endpoint re-resolved after a failed fetch
+
+    Usage:
+        ```
+        resolver = PdsResolver(PDS_CACHE_TTL_SECS, PDS_NEGATIVE_CACHE_TTL_SECS)
+        blob = resolver.get_blob(author_did, blob_cid)
+        ```
+    """
+
+    def __init__(
+        self,
+        ttl_secs: float,
+        negative_ttl_secs: float,
+        backend: FileStringStore | S3StringStore | None = None,
+        refresh_interval_secs: float = PDS_REFRESH_INTERVAL_SECS,
+    ):
+        self._ttl_secs = ttl_secs
+        self._negative_ttl_secs = negative_ttl_secs
+        self._backend = backend
+        self._refresh_interval_secs = refresh_interval_secs
+        # One resolver for all DIDs, so that the connection to the PLC directory is kept alive
+        self._id_resolver = IdResolver()
+        self._entries: Dict[str, Tuple[float, Optional[str]]] = {}
+        self._clients: Dict[str, Client] = {}
+        self._lock = Lock()
+
+    def _load(self, did: str) -> Optional[Tuple[float, str]]:
+        if self._backend is None:
+            return None
+        try:
+            value = self._backend.load(_key(did))
+        except Exception as e:
+            logger.warning(f"Failed to load the PDS endpoint of `{did}`: `{str(e)}`")
+            return None
+        if not value:
+            return None
+        entry = json.loads(value)
+        return entry["resolved_at"], entry["endpoint"]
+
+    def _save(self, did: str, resolved_at: float, endpoint: str) -> None:
+        if self._backend is None:
+            return
+        value = json.dumps({"resolved_at": resolved_at, "endpoint": endpoint})
+        try:
+            self._backend.save(_key(did), value)
+        except Exception as e:
+            logger.warning(f"Failed to save the PDS endpoint of `{did}`: `{str(e)}`")
+
+    def _is_fresh(self, entry: Tuple[float, Optional[str]]) -> bool:
+        ttl_secs = self._ttl_secs if entry[1] else self._negative_ttl_secs
+        # Wall clock, as persisted entries are shared between hosts
+        return time.time() - entry[0] < ttl_secs
+
+    def resolve(self, did: str, refresh: bool = False) -> str:
+        """PDS endpoint of the DID
+
+        Args:
+            did (str): DID of the repository
+            refresh (bool): Resolve again even if the cached endpoint is fresh
+
+        Raises:
+            UnresolvableDidError: The DID document or its PDS endpoint was not found
+        """
+        entry = self._entries.get(did)
+        if not refresh:
+            if entry is None or not self._is_fresh(entry):
+                entry = self._load(did) or entry
+            if entry is not None and self._is_fresh(entry):
+                self._entries[did] = entry
+                if entry[1] is None:
+                    raise UnresolvableDidError(f"DID `{did}` did not resolve (cached)")
+                return entry[1]
+
+        try:
+            did_doc = self._id_resolver.did.resolve(did)
+        except Exception as e:
+            if entry is not None and entry[1]:
+                logger.warning(f"Failed to resolve `{did}`, using the stale PDS endpoint: `{e}`")
+                return entry[1]
+            raise
+        endpoint = did_doc.get_pds_endpoint() if did_doc else None
+        resolved_at = time.time()
+        self._entries[did] = (resolved_at, endpoint)
+        if endpoint is None:
+            raise UnresolvableDidError(f"DID `{did}` has no PDS endpoint")
+        self._save(did, resolved_at, endpoint)
+        return endpoint
+
+    def get_client(self, did: str, refresh: bool = False) -> Client:
+        """Client of the PDS of the DID, shared by all DIDs on the same PDS"""
+        endpoint = self.resolve(did, refresh)
+        with self._lock:
+            client = self._clients.get(endpoint)
+            if client is None:
+                client = self._clients[endpoint] = Client(base_url=endpoint)
+        return client
+
+    def _may_refresh(self, did: str) -> bool:
+        """Whether the endpoint of the DID is old enough to be re-resolved after a failed fetch"""
+        entry = self._entries.get(did)
+        return entry is None or time.time() - entry[0] >= self._refresh_interval_secs
+
+    def get_blob(self, did: str, cid: str, **kwargs) -> bytes:
+        """Fetch the blob from the PDS of the DID, re-resolving the DID once if the PDS moved
+
+        Args:
+            kwargs: Arguments of the HTTP request, such as `timeout`
+        """
+        params = models.ComAtprotoSyncGetBlob.Params(cid=cid, did=did)
+        endpoint = self.resolve(did)
+        try:
+            return self.get_client(did).com.atproto.sync.get_blob(params, **kwargs)
+        except Exception as e:
+            if not _may_have_moved(e) or not self._may_refresh(did):
+                raise
+            try:
+                moved = self.resolve(did, refresh=True) != endpoint
+            except Exception:
+                moved = False
+            if not moved:
+                raise
+            logger.info(f"PDS of `{did}` moved, retrying the blob fetch: `{str(e)}`")
+            return self.get_client(did).com.atproto.sync.get_blob(params, **kwargs)
+
+
+def get_pds_resolver() -> PdsResolver:
+    """PDS resolver with the persisted store configured by the environment variables"""
+    backend = None
+    if PDS_CACHE_BUCKET_NAME:
+        backend = S3StringStore(PDS_CACHE_BUCKET_NAME, PDS_CACHE_PREFIX)
+    elif PDS_CACHE_DIR:
+        backend = FileStringStore(PDS_CACHE_DIR)
+    return PdsResolver(PDS_CACHE_TTL_SECS, PDS_NEGATIVE_CACHE_TTL_SECS, backend)
@@ -0,0 +1,121 @@
+"""Versioned queue message of an image post, carrying the record fields the pipeline needs
+
+The firehose listener has the decoded `app.bsky.feed.post` record, so it sends the fields used by
+the watermarking and watermark registration steps along with the post reference. The consumers then
+rebuild the record without logging in and fetching the post from the AppView again.
+
+Version 1 (no `v`) carries only `cid`, `uri`, `author_did` and `created_at`. Version 2 adds:
+
+- `text`: Post text
+- `langs`, `facets`, `reply`: Omitted if not set. Facets and reply are in the lexicon JSON form
+- `images`: `cid`, `mime_type` and `size` of the blob, `alt` and `aspect_ratio` as `[width, height]`
+  (both omitted if not set)
+
+The version 1 fields are kept, so consumers of either version can read both.
+
+Imported by the firehose decoder workers: do not import modules that call external services on import,
+such as settings.
+"""
+
+from typing import Optional
+
+from atproto import models
+from atproto_client.models.utils import get_model_as_dict
+
+POST_MESSAGE_VERSION = 2
+
+
+def _encode_image(image: models.AppBskyEmbedImages.Image) -> dict:
+    encoded = {
+        "cid": image.image.cid.encode(),
+        "mime_type": image.image.mime_type,
+        "size": image.image.size,
+    }
+    if "alt" in image.model_fields_set:
+        encoded["alt"] = image.alt
+    if image.aspect_ratio is not None:
+        encoded["aspect_ratio"] = [image.aspect_ratio.width, image.aspect_ratio.height]
+    return encoded
+
+
+def _decode_image(image: dict) -> models.AppBskyEmbedImages.Image:
+    aspect_ratio = None
+    if "aspect_ratio" in image:
+        width, height = image["aspect_ratio"]
+        aspect_ratio = models.AppBskyEmbedDefs.AspectRatio(width=width, height=height)
+    return models.AppBskyEmbedImages.Image(
+        alt=image.get("alt", ""),
+        image=models.blob_ref.BlobRef(
+            mime_type=image["mime_type"],
+            size=image["size"],
+            ref=models.blob_ref.IpldLink(link=image["cid"]),
+        ),
+        aspect_ratio=aspect_ratio,
+    )
+
+
+def encode_post_message(
+    cid: str, uri: str, author_did: str, record: models.AppBskyFeedPost.Record
+) -> dict:
+    """Message of an image post
+
+    Args:
+        cid (str): CID of the post record
+        uri (str): AT URI of the post
+        author_did (str): DID of the author
+        record (models.AppBskyFeedPost.Record): Post record with an `app.bsky.embed.images` embed
+
+    Returns:
+        dict: Message to be sent as JSON
+    """
+    message = {
+        "v": POST_MESSAGE_VERSION,
+        "cid": cid,
+        "uri": uri,
+        "author_did": author_did,
+        "created_at": record.created_at,
+        "text": record.text,
+        "images": [_encode_image(image) for image in record.embed.images],
+    }
+    if record.langs:
+        message["langs"] = list(record.langs)
+    if record.facets:
+        message["facets"] = [get_model_as_dict(facet) for facet in record.facets]
+    if record.reply is not None:
+        message["reply"] = get_model_as_dict(record.reply)
+    return message
+
+
+def decode_post_message(message: dict) -> Optional[models.AppBskyFeedPost.GetRecordResponse]:
+    """Rebuild the post from the message, as returned by `Client.get_post`
+
+    Returns:
+        Optional[models.AppBskyFeedPost.GetRecordResponse]: None for version 1 messages, which do
+            not carry the record
+    """
+    if message.get("v", 1) < POST_MESSAGE_VERSION:
+        return None
+    facets = None
+    if "facets" in message:
+        facets = [
+            models.get_or_create(facet, models.AppBskyRichtextFacet.Main, strict=False)
+            for facet in message["facets"]
+        ]
+    reply = None
+    if "reply" in message:
+        reply = models.get_or_create(
+            message["reply"], models.AppBskyFeedPost.ReplyRef, strict=False
+        )
+    record = models.AppBskyFeedPost.Record(
+        text=message["text"],
+        created_at=message["created_at"],
+        embed=models.AppBskyEmbedImages.Main(
+            images=[_decode_image(image) for image in message["images"]]
+        ),
+        langs=message.get("langs"),
+        facets=facets,
+        reply=reply,
+    )
+    return models.AppBskyFeedPost.GetRecordResponse(
+        uri=message["uri"], cid=message["cid"], value=record
+    )
@@ -0,0 +1,197 @@
+"""Persistent store of Bluesky sessions keyed by identity
+
+A password login (`createSession`) is slow and rate limited by the PDS per handle (30 per 5 minutes,
+300 per day), so the session of each identity is kept in an in-process warm cache backed by a
+Fernet-encrypted store shared across invocations: an S3 object under `BSKY_SESSION_PREFIX` when
+`BSKY_SESSION_BUCKET_NAME` is set, otherwise a file under `BSKY_SESSION_DIR`.
+
+The PDS rotates the refresh token on every refresh and rejects the previous one, so two processes
+refreshing the same session invalidate each other. Refreshes and logins of an identity are
+therefore done under a lease (a thread lock in the process plus a lock file or a conditionally
+written S3 object across processes), and the holder reloads the stored session first to adopt a
+session another process has just rotated.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+
+from lib.aws.s3 import delete_object, get_object, head_object, put_bytes_object_if
+from lib.fernet import decrypt, encrypt
+from lib.log import get_logger
+from lib.store import FileStringStore, S3StringStore
+
+logger = get_logger(__name__)
+
+BSKY_SESSION_BUCKET_NAME = os.getenv("BSKY_SESSION_BUCKET_NAME")
+"""Bucket of the shared session store. The file store is used if not set"""
+BSKY_SESSION_PREFIX = os.getenv("BSKY_SESSION_PREFIX", default="bsky_sessions")
+BSKY_SESSION_DIR = os.getenv("BSKY_SESSION_DIR", default="/tmp/bsky_sessions")
+LEASE_TTL_SECS = float(os.getenv("BSKY_SESSION_LEASE_TTL_SECS", default="30"))
+"""Lease left by a holder that died is taken over after this"""
+LEASE_WAIT_SECS = float(os.getenv("BSKY_SESSION_LEASE_WAIT_SECS", default="15"))
+"""Maximum wait for a lease, after which the caller goes on without it"""
+LEASE_POLL_SECS = 0.2
+
+
+class FileSessionBackend(FileStringStore):
+    """Stores encrypted sessions as files, shared by the invocations of a warm container"""
+
+    @contextmanager
+    def lease(self, key: str) -> Iterator[bool]:
+        """Hold an exclusive lock on the lock file of the key, yielding whether it was acquired"""
+        self._directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        with open(self._directory / f"{key}.lock", "w") as f:
+            deadline = time.monotonic() + LEASE_WAIT_SECS
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        yield False
+                        return
+                    time.sleep(LEASE_POLL_SECS)
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class S3SessionBackend(S3StringStore):
+    """Stores encrypted sessions as S3 objects, shared by all Lambdas and containers
+
+    The lease is an object created with a conditional write. A lease older than `LEASE_TTL_SECS`
+    is taken over by replacing it on the condition of its ETag, so only one waiter wins.
+    """
+
+    def _take_over_expired(self, lease_key: str, body: bytes) -> bool:
+        try:
+            head = head_object(self._bucket_name, lease_key)
+        except Exception:
+            # Released in the meantime
+            return put_bytes_object_if(self._bucket_name, lease_key, body) is not None
+        age = (datetime.now(timezone.utc) - head["LastModified"]).total_seconds()
+        if age < LEASE_TTL_SECS:
+            return False
+        logger.warning(f"Taking over the session lease {lease_key} expired {age:.0f} seconds ago")
+        return put_bytes_object_if(self._bucket_name, lease_key, body, head["ETag"]) is not None
+
+    @contextmanager
+    def lease(self, key: str) -> Iterator[bool]:
+        """Hold the lease object of the key, yielding whether it was acquired"""
+        lease_key = f"{self._prefix}/{key}.lease"
+        owner = uuid.uuid4().hex
+        body = json.dumps({"owner": owner}).encode("utf-8")
+        deadline = time.monotonic() + LEASE_WAIT_SECS
+        while put_bytes_object_if(self._bucket_name, lease_key, body) is None:
+            if self._take_over_expired(lease_key, body):
+                break
+            if time.monotonic() >= deadline:
+                yield False
+                return
+            time.sleep(LEASE_POLL_SECS)
+        try:
+            yield True
+        finally:
+            try:
+                # Do not delete a lease taken over after ours expired
+                current = json.loads(get_object(self._bucket_name, lease_key)["Body"].read())
+                if current.get("owner") == owner:
+                    delete_object(self._bucket_name, lease_key)
+            except Exception as e:
+                logger.warning(f"Failed to release the session lease {lease_key}: `{str(e)}`")
+
+
+class SessionStore:
+    """Sessions keyed by identity, with an in-process warm cache over an encrypted backend
+
+    Args:
+        backend (FileSessionBackend | S3SessionBackend): Persistent store of the encrypted sessions
+
+    Usage:
+        ```
+        store = SessionStore(FileSessionBackend("/tmp/bsky_sessions"))
+        with store.lease(identifier):
+            session_string = store.get(identifier, reload=True)
+            ...
+            store.save(identifier, client.export_session_string())
+        ```
+    """
+
+    def __init__(self, backend: FileSessionBackend | S3SessionBackend):
+        self._backend = backend
+        self._cache: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._leases: Dict[str, threading.RLock] = {}
+        self._held: Dict[str, bool] = {}
+
+    @staticmethod
+    def _key(identifier: str) -> str:
+        # Handles and DIDs are not used as names as they are, to keep them out of file and key names
+        return hashlib.sha256(identifier.encode("utf-8")).hexdigest()
+
+    def get(self, identifier: str, reload: bool = False) -> Optional[str]:
+        """Session string of the identity, or None if not stored or unreadable
+
+        Args:
+            identifier (str): Bluesky User Handle or DID
+            reload (bool): Read the backend even if the session is in the warm cache
+        """
+        if not reload and identifier in self._cache:
+            return self._cache[identifier]
+        try:
+            token = self._backend.load(self._key(identifier))
+            session_string = decrypt(token) if token else None
+        except Exception as e:
+            logger.warning(f"Failed to load the stored session: `{str(e)}`")
+            return self._cache.get(identifier)
+        if session_string:
+            self._cache[identifier] = session_string
+        return session_string
+
+    def save(self, identifier: str, session_string: str) -> None:
+        """Store the session of the identity. A failure to persist it is only logged"""
+        self._cache[identifier] = session_string
+        try:
+            self._backend.save(self._key(identifier), encrypt(session_string))
+        except Exception as e:
+            logger.warning(f"Failed to save the session: `{str(e)}`")
+
+    @contextmanager
+    def lease(self, identifier: str) -> Iterator[None]:
+        """Serialize logins and refreshes of the identity across threads and processes
+
+        Reentrant in the holding thread. If the lease cannot be acquired within `LEASE_WAIT_SECS`,
+        the caller goes on without it rather than failing.
+        """
+        with self._lock:
+            lock = self._leases.setdefault(identifier, threading.RLock())
+        with lock:
+            if self._held.get(identifier):
+                yield
+                return
+            self._held[identifier] = True
+            try:
+                with self._backend.lease(self._key(identifier)) as acquired:
+                    if not acquired:
+                        logger.warning(
+                            "Timed out waiting for the session lease, going on without it"
+                        )
+                    yield
+            finally:
+                self._held[identifier] = False
+
+
+def get_session_store() -> SessionStore:
+    """Session store of the backend configured by the environment variables"""
+    if BSKY_SESSION_BUCKET_NAME:
+        return SessionStore(S3SessionBackend(BSKY_SESSION_BUCKET_NAME, BSKY_SESSION_PREFIX))
+    return SessionStore(FileSessionBackend(BSKY_SESSION_DIR))
@@ -0,0 +1,225 @@
+import json
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_LATENCY_BUCKETS_MS = (
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+)  # fmt: skip
+"""Upper bounds of the latency histogram buckets in milliseconds"""
+
+_EMF_MAX_VALUES = 100
+"""Maximum number of values in an EMF Values/Counts array"""
+
+
+class Counter:
+    """Monotonic counter, exported as the delta since the previous EMF export"""
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.total = 0
+        self._exported = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.total += amount
+
+    def _delta(self) -> int:
+        delta, self._exported = self.total - self._exported, self.total
+        return delta
+
+
+class Gauge:
+    """Last set value"""
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.value: Optional[float] = None
+
+    def set(self, value: Optional[float]) -> None:
+        self.value = value
+
+
+class Histogram:
+    """Fixed-bucket histogram
+
+    Observing a value is a bisect over the bucket bounds, cheap enough for per-event hot paths.
+    """
+
+    def __init__(self, name: str, unit: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.unit = unit
+        self.buckets = tuple(sorted(buckets))
+        # The last slot counts values above the largest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._window_counts = [0] * (len(self.buckets) + 1)
+        self._window_max = 0.0
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        self.counts[i] += 1
+        self._window_counts[i] += 1
+        self.sum += value
+        if value > self._window_max:
+            self._window_max = value
+
+    def _window(self) -> Tuple[List[float], List[int]]:
+        """Values and counts observed since the previous EMF export
+
+        Each bucket is represented by its upper bound, values above the largest bound by the maximum.
+        """
+        values, counts = [], []
+        for i, count in enumerate(self._window_counts):
+            if count == 0:
+                continue
+            values.append(self.buckets[i] if i < len(self.buckets) else self._window_max)
+            counts.append(count)
+        self._window_counts = [0] * (len(self.buckets) + 1)
+        self._window_max = 0.0
+        return values[:_EMF_MAX_VALUES], counts[:_EMF_MAX_VALUES]
+
+
+class MetricsRegistry:
+    """Holds the metrics of a process and renders them as CloudWatch EMF or Prometheus text
+
+    Args:
+        namespace (str): CloudWatch namespace
+        dimensions (Dict[str, str]): Dimensions attached to every metric
+
+    See:
+        https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    Usage:
+        ```
+        metrics = MetricsRegistry("app/firehose", {"Service": "firehose"})
+        frames = metrics.counter("frames_received")
+        frames.inc()
+        emit_emf(metrics)
+        ```
+    """
+
+    def __init__(self, namespace: str, dimensions: Dict[str, str]):
+        self.namespace = namespace
+        self.dimensions = dimensions
+        self._metrics: Dict[str, Counter | Gauge | Histogram] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric `{metric.name}` is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, unit: str = "Count") -> Counter:
+        return self._register(Counter(name, unit))
+
+    def gauge(self, name: str, unit: str = "None") -> Gauge:
+        return self._register(Gauge(name, unit))
+
+    def histogram(
+        self,
+        name: str,
+        unit: str = "Milliseconds",
+        buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS_MS,
+    ) -> Histogram:
+        return self._register(Histogram(name, unit, buckets))
+
+    def to_emf(self) -> dict:
+        """Render an EMF document of the values since the previous call
+
+        Returns:
+            dict: EMF document, to be written to stdout as a single JSON line
+        """
+        document = dict(self.dimensions)
+        definitions = []
+        for name, metric in self._metrics.items():
+            if isinstance(metric, Counter):
+                value = metric._delta()
+            elif isinstance(metric, Gauge):
+                value = metric.value
+            else:
+                values, counts = metric._window()
+                value = {"Values": values, "Counts": counts} if values else None
+            if value is None:
+                continue
+            document[name] = value
+            definitions.append({"Name": name, "Unit": metric.unit})
+        document["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions.keys())],
+                    "Metrics": definitions,
+                }
+            ],
+        }
+        return document
+
+    def to_prometheus(self, prefix: str = "") -> str:
+        """Render the cumulative values in the Prometheus text exposition format"""
+        lines = []
+        for name, metric in self._metrics.items():
+            full_name = f"{prefix}_{name}" if prefix else name
+            if isinstance(metric, Counter):
+                lines += [f"# TYPE {full_name}_total counter", f"{full_name}_total {metric.total}"]
+            elif isinstance(metric, Gauge):
+                if metric.value is not None:
+                    lines += [f"# TYPE {full_name} gauge", f"{full_name} {metric.value}"]
+            else:
+                lines.append(f"# TYPE {full_name} histogram")
+                cumulative = 0
+                for bound, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{{le="{bound}"}} {cumulative}')
+                total = cumulative + metric.counts[-1]
+                lines += [
+                    f'{full_name}_bucket{{le="+Inf"}} {total}',
+                    f"{full_name}_sum {metric.sum}",
+                    f"{full_name}_count {total}",
+                ]
+        return "\n".join(lines) + "\n"
+
+
+def emit_emf(registry: MetricsRegistry) -> None:
+    """Write the metrics since the previous call to stdout as an EMF log line
+
+    CloudWatch Logs extracts the metrics from the line, so no API call or IAM permission is needed.
+    """
+    print(json.dumps(registry.to_emf()), flush=True)
+
+
+def start_http_server(
+    registry: MetricsRegistry, port: int, prefix: str = ""
+) -> ThreadingHTTPServer:
+    """Serve the metrics in the Prometheus format on a background thread
+
+    The values are read without locking, so a scrape may mix values from adjacent updates.
+
+    Args:
+        registry (MetricsRegistry): Metrics to serve
+        port (int): Port to listen on all interfaces
+        prefix (str): Prefix of the Prometheus metric names
+
+    Returns:
+        ThreadingHTTPServer: Running server, stop it with `shutdown()`
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.to_prometheus(prefix).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    server = ThreadingHTTPServer(("", port), _Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,55 @@
+"""Persistent string stores keyed by name, shared across invocations
+
+`FileStringStore` keeps each value in a file, shared by the invocations of a warm container, and
+`S3StringStore` keeps it in an S3 object, shared by all Lambdas and containers. Both only store
+strings: callers serialize and, if needed, encrypt their values.
+"""
+
+import os
+import uuid
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+from lib.aws.s3 import get_object, post_bytes_object
+
+
+class FileStringStore:
+    """Stores strings as files under `directory`"""
+
+    def __init__(self, directory: str):
+        self._directory = Path(directory)
+
+    def load(self, key: str) -> Optional[str]:
+        try:
+            return (self._directory / key).read_text(encoding="UTF-8")
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, value: str) -> None:
+        # Replace from a temporary file so that a reader never sees a partial value
+        self._directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = self._directory / f"{key}.{uuid.uuid4().hex}.tmp"
+        tmp_path.write_text(value, encoding="UTF-8")
+        os.replace(tmp_path, self._directory / key)
+
+
+class S3StringStore:
+    """Stores strings as S3 objects under `prefix`"""
+
+    def __init__(self, bucket_name: str, prefix: str):
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+
+    def load(self, key: str) -> Optional[str]:
+        try:
+            body = get_object(self._bucket_name, f"{self._prefix}/{key}")["Body"]
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") == "NoSuchKey":
+                return None
+            raise
+        return body.read().decode("utf-8")
+
+    def save(self, key: str, value: str) -> None:
+        with BytesIO(value.encode("utf-8")) as body:
+            post_bytes_object(self._bucket_name, f"{self._prefix}/{key}", body)
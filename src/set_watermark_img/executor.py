@@ -5,23 +5,22 @@ from io import BytesIO
 from pathlib import PurePosixPath
 
 import boto3
-from atproto import Client, IdResolver, models
+from PIL import Image
 
 from lib.aws.s3 import post_bytes_object, post_string_object
 from lib.bs.client import get_client
 from lib.bs.get_bsky_post_by_url import get_did_from_url, get_rkey_from_url
+from lib.bs.pds import get_pds_resolver
+from lib.bs.post_message import decode_post_message
 from lib.common_converter import generate_exec_id, get_id_of_did
 from lib.log import get_logger
 from settings import settings
+from watermarking.compositing import encode_derivative, make_derivatives
 
 logger = get_logger(__name__)
 
-
-def _get_authors_pds_client(author_did: str) -> Client:
-    resolver = IdResolver()
-    did_doc = resolver.did.resolve(author_did)
-    authors_pds_endpoint = did_doc.service[0].service_endpoint
-    return Client(base_url=authors_pds_endpoint)
+# ウォーム起動の間で再利用する
+pds_resolver = get_pds_resolver()
 
 
 def _start_workflow(author_did: str, metadata: dict):
@@ -34,24 +33,46 @@ def _start_workflow(author_did: str, metadata: dict):
     logger.info(f"Started state machine execution_id=`{exec_id}`")
 
 
+def _save_watermark_derivatives(id_of_did: str, blob: bytes) -> dict:
+    """合成時に前処理なしで使える、白を透過しアルファ乗算済みのウォーターマークと縮小版をS3に保存する"""
+    with BytesIO(blob) as f:
+        derivative, scaled = make_derivatives(Image.open(f))
+    base_path = PurePosixPath("derivatives").joinpath(id_of_did)
+    path = base_path.joinpath("full.png").as_posix()
+    post_bytes_object(settings.WATERMARKS_BUCKET_NAME, path, encode_derivative(derivative))
+    scaled_paths = {}
+    for width, scaled_img in scaled.items():
+        scaled_path = base_path.joinpath(f"{width}.png").as_posix()
+        post_bytes_object(
+            settings.WATERMARKS_BUCKET_NAME, scaled_path, encode_derivative(scaled_img)
+        )
+        scaled_paths[str(width)] = scaled_path
+    logger.info(f"Saved watermark derivatives to S3 {base_path.as_posix()}")
+    return {
+        "path": path,
+        "mode": derivative.mode,
+        "width": derivative.width,
+        "height": derivative.height,
+        "scaled": scaled_paths,
+    }
+
+
 def _save_watermark_img_to_s3(event: dict):
     input = json.loads(event["Records"][0]["body"])
     rkey = get_rkey_from_url(input.get("uri"))
     did = get_did_from_url(input.get("uri"))
     client = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
-    post = client.get_post(post_rkey=rkey, profile_identify=did)
+    # レコードを含まない以前の形式のメッセージの場合だけ、ポストを取得し直す
+    post = decode_post_message(input) or client.get_post(post_rkey=rkey, profile_identify=did)
     # いいねを付ける
     client.like(uri=input.get("uri"), cid=input.get("cid"))
 
     # ウォーターマーク画像を取得し、S3に保存
     author_did = input.get("author_did")
-    authors_pds_client = _get_authors_pds_client(author_did)
     for image in post.value.embed.images:
         if "alt" in image.model_fields_set and settings.ALT_OF_SET_WATERMARK_IMG == image.alt:
             blob_cid = image.image.cid.encode()
-            blob = authors_pds_client.com.atproto.sync.get_blob(
-                models.ComAtprotoSyncGetBlob.Params(cid=blob_cid, did=author_did)
-            )
+            blob = pds_resolver.get_blob(author_did, blob_cid)
             metadata = {
                 "did": author_did,
                 "mime_type": image.image.mime_type,
@@ -72,6 +93,12 @@ def _save_watermark_img_to_s3(event: dict):
                 logger.info(f"Saved watermark image to S3 {img_object_name}")
                 metadata["path"] = img_object_name
 
+            try:
+                metadata["derivative"] = _save_watermark_derivatives(id_of_did, blob)
+            except Exception as e:
+                # 前処理済みの画像が無くても、合成時に元画像から作り直せる
+                logger.warning(f"Failed to save watermark derivatives: `{str(e)}`")
+
             # メタデータをS3に保存
             metadata_obj_name = PurePosixPath("metadatas").joinpath(id_of_did).with_suffix(".json")
             metadata_obj_name = metadata_obj_name.as_posix()
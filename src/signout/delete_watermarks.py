@@ -1,7 +1,7 @@
 import json
 from pathlib import PurePosixPath
 
-from lib.aws.s3 import delete_object, get_object, is_exiests_object
+from lib.aws.s3 import delete_object, delete_objects, get_object, is_exiests_object, list_objects
 from lib.common_converter import get_id_of_did
 from lib.log import get_logger
 from settings import settings
@@ -9,6 +9,19 @@ from settings import settings
 logger = get_logger(__name__)
 
 
+def _delete_derivatives(bucket_name: str, id_of_did: str) -> None:
+    """登録時に作った前処理済みの画像と縮小版を削除する
+
+    metadata に記録されていない、以前の登録で作ったものも残さないよう、プレフィックスごと削除する
+    """
+    prefix = PurePosixPath("derivatives").joinpath(id_of_did).as_posix() + "/"
+    keys = [obj["Key"] for obj in list_objects(bucket_name, prefix)]
+    if not keys:
+        return
+    logger.info(f"Deleting {len(keys)} objects under `{prefix}` ...")
+    delete_objects(bucket_name, keys)
+
+
 def handler(event, context):
     logger.info(f"Received event: {event}")
     did = event["did"]
@@ -39,6 +52,9 @@ def handler(event, context):
     else:
         logger.info(f"Metadata object `{metadata_obj_name}` does not exist.")
 
+    # 前処理済みの画像とその縮小版は、metadataが無い場合も削除する
+    _delete_derivatives(target_bucket_name, id_of_did)
+
     return {"did": did}
 
 
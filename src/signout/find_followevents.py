@@ -1,6 +1,6 @@
 import json
 
-from lib.aws.sqs import get_sqs_client
+from lib.aws.sqs import SqsBatchProducer, get_sqs_client
 from lib.bs.client import get_client
 from lib.bs.graph import get_followers, get_follows, get_list_members
 from lib.log import get_logger
@@ -37,22 +37,20 @@ def handler(event, context):
 
     try:
         # signout 通知を送る
-        for unfollower in unfollowers:
-            sqs.send_message(
-                QueueUrl=settings.SIGNOUT_QUEUE_URL, MessageBody=json.dumps({"did": unfollower})
-            )
-            logger.info(f"Send did {unfollower} to {settings.SIGNOUT_QUEUE_URL}")
+        with SqsBatchProducer(sqs) as producer:
+            for unfollower in unfollowers:
+                producer.send(settings.SIGNOUT_QUEUE_URL, json.dumps({"did": unfollower}))
+                logger.info(f"Send did {unfollower} to {settings.SIGNOUT_QUEUE_URL}")
         logger.info(f"Found {len(newfollowers)} new followers.")
     except Exception as e:
         logger.error(f"Error on Signout Process: {e}")
 
     try:
         # signup 通知を送る
-        for newfollower in newfollowers:
-            sqs.send_message(
-                QueueUrl=settings.FOLLOWED_QUEUE_URL, MessageBody=json.dumps({"did": newfollower})
-            )
-            logger.info(f"Send did {newfollower} to {settings.FOLLOWED_QUEUE_URL}")
+        with SqsBatchProducer(sqs) as producer:
+            for newfollower in newfollowers:
+                producer.send(settings.FOLLOWED_QUEUE_URL, json.dumps({"did": newfollower}))
+                logger.info(f"Send did {newfollower} to {settings.FOLLOWED_QUEUE_URL}")
     except Exception as e:
         logger.error(f"Error on Signup Process: {e}")
 
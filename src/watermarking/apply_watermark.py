@@ -1,14 +1,54 @@
+import dataclasses
 import json
+import math
+import os
+from collections import OrderedDict
 from io import BytesIO
 from pathlib import PurePosixPath
-from typing import List
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
 from PIL import Image
 
 from lib.aws.s3 import get_object, post_bytes_object
-from lib.common_converter import get_did_from_post_uri, get_id_of_did
+from lib.bs.pds import get_pds_resolver
+from lib.common_converter import get_did_from_post_uri
 from lib.log import get_logger
 from settings import settings
+from watermarking.bucketio import get_watermark_metadata, get_watermark_version
+from watermarking.compositing import (
+    TILE_COLUMNS,
+    STRIP_LAYERS,
+    blend_overlay,
+    composite_in_strips,
+    decode_derivative,
+    make_overlay,
+    make_transparent_white,
+    select_scaled_width,
+    strip_height_for_budget,
+)
+from watermarking.encoder import (
+    MAX_SIZE,
+    OUTPUT_FORMATS,
+    EncodedImage,
+    EncodeParams,
+    encode_within,
+    load_at_size,
+    plan_output_size,
+)
+from watermarking.overlay_cache import OverlayCache
+from watermarking.parallel import (
+    IMAGE_MEMORY_FRACTION,
+    MAX_IMAGES,
+    MAX_WORKERS,
+    STRIP_MEMORY_BYTES,
+    MemoryBudget,
+    estimate_image_bytes,
+    lambda_memory_bytes,
+    map_ordered,
+)
+from watermarking.profiling import measure_peak_memory
+from watermarking.result_cache import ResultCache
 
 logger = get_logger(__name__)
 
@@ -18,122 +58,303 @@ watermarked_image_bucket = settings.WATERMARKED_IMAGE_BUCKET_NAME
 
 
 OPACITY = 128
-MAX_IMAGES = 4
-MAX_SIZE = 950 * 1024  # max size of image in KB 976.56KB
-
-
-def make_tile(target_width: int, target_height: int, tile_img: Image, wcnt: int) -> Image:
-    """横にwcnt枚タイリングできるタイル画像を返す"""
-    expected_width = target_width // wcnt
-    expected_height = round(tile_img.height * expected_width / tile_img.width)
-    # hcnt = target_height // expected_height
-    hcnt = round(target_height / expected_height)
-    resized_tile_img: Image = tile_img.resize((expected_width, expected_height))
-
-    # base imageにタイル画像を敷き詰めたものを返す
-    base_img = Image.new("RGBA", (target_width, target_height))
-    for i in range(wcnt):
-        for k in range(hcnt):
-            base_img.paste(
-                resized_tile_img, (i * resized_tile_img.size[0], k * resized_tile_img.size[1])
-            )
-    return base_img
-
-
-def _resize(input_img: Image) -> Image:
-    # RGBA画像をRGBに変換して保存サイズを削減
-    if input_img.mode == "RGBA":
-        with BytesIO() as out:
-            input_img.save(out, format="PNG")
-            saving_size_in_bytes = out.tell()
-            logger.info(f"Original Size of image: {saving_size_in_bytes} bytes")
-            if saving_size_in_bytes < MAX_SIZE:
-                return input_img
-            out.seek(0)
-            input_img.convert("RGB").save(out, format="JPEG")
-            saving_size_in_bytes = out.tell()
-            if saving_size_in_bytes < MAX_SIZE:
-                logger.info(f"RGB Converted Size of image: {saving_size_in_bytes} bytes")
-                return input_img.convert("RGB")
-            else:
-                return input_img.convert("RGB").resize(
-                    (input_img.width // 2, input_img.height // 2)
-                )
-    # すでにRGBまたはRGBAから品質低下させてもMAX_SIZEを超える場合は縮小画像を返す
-    return input_img.resize((input_img.width // 2, input_img.height // 2))
+
+OVERLAY_CACHE_MAX_BYTES = int(os.getenv("OVERLAY_CACHE_MAX_BYTES", default=str(64 * 1024 * 1024)))
+"""メモリに保持するウォーターマークの層の合計バイト数"""
+OVERLAY_CACHE_SPILL_DIR = os.getenv("OVERLAY_CACHE_SPILL_DIR")
+"""メモリから溢れた層の退避先。未設定の場合は退避しない"""
+OVERLAY_CACHE_SPILL_MAX_BYTES = int(
+    os.getenv("OVERLAY_CACHE_SPILL_MAX_BYTES", default=str(256 * 1024 * 1024))
+)
+"""退避先に保持する層の合計バイト数"""
+
+ENCODE_HINT_MAX_ENTRIES = int(os.getenv("ENCODE_HINT_MAX_ENTRIES", default="256"))
+"""前回のエンコードのパラメータを保持するユーザー数の上限。超えた場合は参照が古いものから破棄する"""
+PROFILE_MEMORY = os.getenv("APPLY_WATERMARK_PROFILE_MEMORY", default="false").lower() == "true"
+"""画像ごとのピークメモリを計測してログに出すか"""
+
+# ウォーム起動の間で再利用する
+overlay_cache = OverlayCache(
+    OVERLAY_CACHE_MAX_BYTES, OVERLAY_CACHE_SPILL_DIR, OVERLAY_CACHE_SPILL_MAX_BYTES
+)
+result_cache = ResultCache("apply_watermark")
+# キャッシュから削除された結果を合成し直す場合に、元画像を投稿者のPDSから取得する
+pds_resolver = get_pds_resolver()
+_last_params: OrderedDict[str, Tuple[EncodeParams, int]] = OrderedDict()
+"""ユーザーごとの、前回サイズ上限に収まったエンコードのパラメータと出力の画素数"""
+_last_params_lock = Lock()
+
+
+def make_tile(
+    target_width: int,
+    target_height: int,
+    tile_img: Image,
+    wcnt: int,
+    tile_size: Optional[Tuple[int, int]] = None,
+) -> Image:
+    """横にwcnt枚タイリングしたウォーターマークを背景色に重ねた、元画像に混ぜる層を返す"""
+    return make_overlay(target_width, target_height, tile_img, wcnt, tile_size)
+
+
+def _get_encode_hint(did: str, size: Tuple[int, int]) -> Optional[EncodeParams]:
+    """前回収まったパラメータを、解像度が size の画像に合わせて返す。無い場合は None"""
+    with _last_params_lock:
+        entry = _last_params.get(did)
+        if entry is None:
+            return None
+        _last_params.move_to_end(did)
+    params, pixels = entry
+    if params.scale >= 1.0:
+        return params
+    # 倍率は前回の画像に対するものため、前回と同じ画素数になる倍率に直す
+    return dataclasses.replace(params, scale=min(1.0, math.sqrt(pixels / (size[0] * size[1]))))
+
+
+def _encode(input_img: Image, did: str) -> EncodedImage:
+    """ウォーターマークを合成した画像を、Blueskyのサイズ上限に収まるようエンコードする
+
+    同じユーザーの画像は似た条件で収まることが多いため、前回収まったパラメータから試す
+    """
+    encoded = encode_within(
+        input_img, MAX_SIZE, OUTPUT_FORMATS, _get_encode_hint(did, input_img.size)
+    )
+    with _last_params_lock:
+        _last_params[did] = (encoded.params, encoded.width * encoded.height)
+        _last_params.move_to_end(did)
+        while len(_last_params) > ENCODE_HINT_MAX_ENTRIES:
+            _last_params.popitem(last=False)
+    logger.info(
+        f"Encoded image as {encoded.params} in {encoded.attempts} attempts: "
+        f"{encoded.width}x{encoded.height}, {len(encoded.data)} bytes"
+    )
+    return encoded
+
+
+def _plan_input_size(img: Image, blob: dict, blob_size: int) -> Tuple[int, int]:
+    """元画像を、エンコード後にサイズ上限に収まると予測した解像度を返す
+
+    合成を出力の解像度で1度だけ行うため、縮小は合成の前に済ませる
+
+    Args:
+        img (Image): ヘッダーだけを読んだ元画像
+        blob (dict): ポストのメタデータにある画像のblob(`mime_type` と `size` を使う)
+        blob_size (int): メタデータにサイズが無い場合に使う、元画像のバイト数
+    """
+    width, height = img.size
+    size = plan_output_size(
+        width, height, blob.get("mime_type", ""), blob.get("size") or blob_size, MAX_SIZE
+    )
+    if size != (width, height):
+        logger.info(f"Planned output size: {width}x{height} -> {size[0]}x{size[1]}")
+    return size
 
 
 def add_watermark(input_img: Image, watermark_img: Image) -> Image:
-    """_summary_
+    """元画像にウォーターマークをタイリングして合成したRGBA画像を返す
 
     Args:
-        input_img (Image): _description_
-        watermark_text (_type_): _description_
-        position (_type_): _description_
-    TBD:
+        input_img (Image): 透かし適用対象画像
+        watermark_img (Image): 白を透過済みのウォーターマーク画像
+    See:
         official https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html
         https://note.com/sakamod/n/ne5a789a1733b
     """
-    # 透かし適用対象画像をRGBAモードに変換
-    tgt_img = input_img.convert("RGBA")
-    watermark_img = make_tile(tgt_img.width, tgt_img.height, watermark_img, 6)
-
-    # 元のウォーターマーク画像から、白を透過色として除外するマスクを適用した画像をウォーターマークとして適用する
-    _, _, _, alpha = watermark_img.split()
-    alpha_channel = 128
-    alpha.paste(Image.new("L", watermark_img.size, alpha_channel), mask=alpha)
-    watermark_mask = Image.composite(
-        Image.new("RGBA", watermark_img.size, (255, 255, 255, 0)), watermark_img, alpha
-    )
-    clear_img = Image.new("RGBA", tgt_img.size, (255, 255, 255, 200))
-    clear_img.paste(watermark_img, mask=watermark_mask)
-    tgt_img = Image.blend(tgt_img, clear_img, 0.2)
-    return tgt_img
+    overlay = make_tile(input_img.width, input_img.height, watermark_img, TILE_COLUMNS)
+    return blend_overlay(input_img, overlay)
 
 
-def get_watermarks_img(post_uri: str) -> Image:
-    did = get_did_from_post_uri(post_uri)
-    id = get_id_of_did(did)
-    metadata_path = PurePosixPath("metadatas").joinpath(id).with_suffix(".json")
-    metadata_obj = get_object(settings.WATERMARKS_BUCKET_NAME, metadata_path.as_posix())
-    with metadata_obj["Body"] as s:
-        metadata = json.loads(s.data.decode("utf-8"))
+def _load_watermarks_img(metadata: dict, scaled_width: Optional[int] = None) -> Image:
+    """ウォーターマーク画像を合成に使える状態で読み込む
+
+    登録時に作った前処理済みの画像(scaled_width を指定した場合はその幅の縮小版)があればそのまま使い、
+    無い場合は元画像の白を透明化する
+    """
+    derivative = metadata.get("derivative")
+    if derivative is not None:
+        path = derivative["scaled"][str(scaled_width)] if scaled_width else derivative["path"]
+        s3_obj = get_object(settings.WATERMARKS_BUCKET_NAME, path)
+        with BytesIO(s3_obj["Body"].read()) as f:
+            return decode_derivative(f)
     s3_obj = get_object(settings.WATERMARKS_BUCKET_NAME, metadata["path"])
     with BytesIO(s3_obj["Body"].read()) as f:
-        img = Image.open(f).convert("RGBA")
         # 白色を透明化
-        newData = []
-        for data in img.getdata():
-            if data[0] == 255 and data[1] == 255 and data[2] == 255:
-                newData.append((255, 255, 255, 0))
-            else:
-                newData.append(data)
-        img.putdata(newData)
-        return img
+        return make_transparent_white(Image.open(f))
+
+
+def get_watermarks_img(post_uri: str) -> Image:
+    return _load_watermarks_img(get_watermark_metadata(get_did_from_post_uri(post_uri)))
+
+
+class Watermark:
+    """投稿者のウォーターマーク。タイリング済みの層がキャッシュに無い場合だけ画像を読み込む"""
+
+    def __init__(self, post_uri: str):
+        self.did = get_did_from_post_uri(post_uri)
+        self._metadata = get_watermark_metadata(self.did)
+        self.version = get_watermark_version(self._metadata)
+        self._imgs: Dict[Optional[int], Image.Image] = {}
+        # 同じポストの画像を並行して処理するため
+        self._lock = Lock()
+
+    def _get_img(self, scaled_width: Optional[int]) -> Image:
+        with self._lock:
+            if scaled_width not in self._imgs:
+                self._imgs[scaled_width] = _load_watermarks_img(self._metadata, scaled_width)
+            return self._imgs[scaled_width]
+
+    def _get_tile_img(self, width: int) -> Tuple[Image.Image, Optional[Tuple[int, int]]]:
+        """幅 width の画像に敷き詰めるウォーターマーク画像と、make_tile に渡す元のサイズを返す"""
+        derivative = self._metadata.get("derivative")
+        if derivative is None:
+            return self._get_img(None), None
+        # タイルの幅以上で最も小さい縮小版から縮小する
+        scaled_width = select_scaled_width(map(int, derivative["scaled"]), width // TILE_COLUMNS)
+        return self._get_img(scaled_width), (derivative["width"], derivative["height"])
+
+    def get_overlay(self, width: int, height: int) -> Image:
+        """指定サイズの画像に混ぜる、タイリング済みの層を返す"""
+
+        def create() -> Image:
+            tile_img, tile_size = self._get_tile_img(width)
+            return make_tile(width, height, tile_img, TILE_COLUMNS, tile_size)
+
+        # 同じサイズの画像を並行して処理する場合も、層を作るのは1回にする
+        return overlay_cache.get_or_create(self.did, self.version, (width, height), create)
+
+    def composite_in_strips(self, input_img: Image, strip_height: int) -> Image:
+        """画像全体の層を作らずに、帯ごとに合成したRGBA画像を返す"""
+        tile_img, tile_size = self._get_tile_img(input_img.width)
+        return composite_in_strips(input_img, tile_img, strip_height, TILE_COLUMNS, tile_size)
+
+
+def _uses_strips(size: Tuple[int, int]) -> bool:
+    """画像全体の層・RGBA変換・合成結果を作ると STRIP_MEMORY_BYTES を超えるか"""
+    return size[0] * size[1] * 4 * STRIP_LAYERS > STRIP_MEMORY_BYTES
+
+
+def _composite(watermark: Watermark, input_img: Image) -> Image:
+    if _uses_strips(input_img.size):
+        strip_height = strip_height_for_budget(input_img.width, STRIP_MEMORY_BYTES)
+        logger.info(f"Compositing in strips of {strip_height} rows")
+        return watermark.composite_in_strips(input_img, strip_height)
+    return blend_overlay(input_img, watermark.get_overlay(input_img.width, input_img.height))
+
+
+def _watermark_image(
+    watermark: Watermark,
+    path: str,
+    blob: dict,
+    budget: MemoryBudget,
+    source: Optional[bytes] = None,
+) -> dict:
+    """画像1枚にウォーターマークを合成してS3に保存し、保存先のパスと画像の情報を返す
+
+    投稿時にデコードし直さずにアップロードできるよう、エンコード後の幅・高さ・サイズも返す
+
+    Args:
+        source (Optional[bytes]): 元画像。None の場合は get_image が保存した path から読み込む
+    """
+    if source is None:
+        source = get_object(settings.ORIGINAL_IMAGE_BUCKET_NAME, path)["Body"].read()
+    with BytesIO(source) as f:
+        # ヘッダーだけを読み、画素はまだ展開しない
+        img = Image.open(f)
+        size = _plan_input_size(img, blob, len(f.getvalue()))
+        strip_bytes = STRIP_MEMORY_BYTES if _uses_strips(size) else None
+        with budget.reserve(estimate_image_bytes(img.size, size, strip_bytes)):
+            input_img = load_at_size(img, size)
+            encoded = _encode(_composite(watermark, input_img), watermark.did)
+    out_path = PurePosixPath(path).with_suffix(encoded.suffix).as_posix()
+    with BytesIO(encoded.data) as out:
+        post_bytes_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, out_path, out)
+    logger.info(f"Saved watermarked image to S3 {out_path}")
+    return {
+        "path": out_path,
+        "mime_type": encoded.mime_type,
+        "size": len(encoded.data),
+        "width": encoded.width,
+        "height": encoded.height,
+    }
+
+
+def _watermark_image_cached(
+    watermark: Watermark, path: str, blob: dict, cached: Optional[dict], budget: MemoryBudget
+) -> dict:
+    """合成結果がキャッシュにあればコピーし、無ければ合成してキャッシュに保存する
+
+    cached には get_image がキャッシュを確認した結果を渡す。get_image の後に他の実行が保存した場合に備え、
+    None の場合はもう一度確認する
+    """
+    blob_cid = blob.get("ref", {}).get("link")
+    # get_image がキャッシュにヒットした場合は、元画像を保存していない
+    source_saved = cached is None
+    if cached is None and blob_cid is not None:
+        cached = result_cache.get(blob_cid, watermark.version)
+    source = None
+    if cached is not None:
+        try:
+            return result_cache.copy_to(cached, path)
+        except Exception as e:
+            # 確認した後にキャッシュから削除された場合は、合成し直す
+            if not source_saved and blob_cid is None:
+                raise
+            logger.warning(
+                f"Failed to copy cached watermarked image {cached['key']}, "
+                f"watermarking again: `{str(e)}`"
+            )
+        if not source_saved:
+            source = pds_resolver.get_blob(watermark.did, blob_cid)
+    watermark_image = _watermark_image_profiled if PROFILE_MEMORY else _watermark_image
+    out_image = watermark_image(watermark, path, blob, budget, source)
+    if blob_cid is not None:
+        result_cache.put(blob_cid, watermark.version, out_image)
+    return out_image
+
+
+def _watermark_image_profiled(
+    watermark: Watermark,
+    path: str,
+    blob: dict,
+    budget: MemoryBudget,
+    source: Optional[bytes] = None,
+) -> dict:
+    with measure_peak_memory() as peak:
+        out_image = _watermark_image(watermark, path, blob, budget, source)
+    logger.info(
+        f"Peak memory of {path}: traced {peak.traced_peak_bytes} bytes, "
+        f"max RSS +{peak.max_rss_increase_bytes} bytes"
+    )
+    return out_image
 
 
 def handler(event, context):
     logger.info(f"Received event: {event}")
     post = json.loads(event["post"])
-    watermarks_img = get_watermarks_img(post["uri"])
+    watermark = Watermark(post["uri"])
 
     # post_metadata = event["metadata"]
     image_paths: List[str] = event["image_paths"]
-    out_image_paths: List[str] = []
-    # watermarking each image
-    for path in image_paths[:MAX_IMAGES]:
-        with BytesIO(get_object(settings.ORIGINAL_IMAGE_BUCKET_NAME, path)["Body"].read()) as f:
-            watermarked_img = add_watermark(Image.open(f), watermarks_img)
-            watermarked_img = _resize(watermarked_img)
-            fmt, suffix = ("PNG", ".png") if watermarked_img.mode == "RGBA" else ("JPEG", ".jpg")
-            with BytesIO() as out:
-                watermarked_img.save(out, format=fmt)
-                out.seek(0)
-                out_path = PurePosixPath(path).with_suffix(suffix).as_posix()
-                post_bytes_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, out_path, out)
-                out_image_paths.append(out_path)
-                logger.info(f"Saved watermarked image to S3 {out_path}")
-    event["out_image_paths"] = out_image_paths
+    blobs = [image["image"] for image in post["value"]["embed"]["images"]]
+    budget = MemoryBudget(int(lambda_memory_bytes() * IMAGE_MEMORY_FRACTION))
+    cached_images: List[Optional[dict]] = event.get("cached_images") or [None] * len(blobs)
+    if not len(image_paths) == len(blobs) == len(cached_images):
+        # 黙って画像を落としたり取り違えたりしないよう、ここで止める
+        raise ValueError(
+            f"Image counts do not match: {len(image_paths)} image_paths, "
+            f"{len(blobs)} images in the post, {len(cached_images)} cached_images"
+        )
+    # watermarking each image, keeping the order of image_paths
+    out_images: List[dict] = map_ordered(
+        lambda args: _watermark_image_cached(watermark, *args, budget),
+        zip(image_paths[:MAX_IMAGES], blobs[:MAX_IMAGES], cached_images[:MAX_IMAGES], strict=True),
+        MAX_WORKERS,
+    )
+    logger.info(
+        f"Watermark overlay cache: {overlay_cache.hits} hits, {overlay_cache.misses} misses"
+    )
+    result_cache.emit_metrics()
+    event["out_images"] = out_images
+    event["out_image_paths"] = [out_image["path"] for out_image in out_images]
     return event
 
 
@@ -1,11 +1,10 @@
 import json
-from io import BytesIO
-from typing import Generator, List, Optional
+from pathlib import PurePosixPath
+from typing import Generator, List
 
-from PIL import Image
 from pydantic import Json
 
-from lib.aws.s3 import get_object
+from lib.aws.s3 import get_object, head_object
 from lib.common_converter import get_id_of_did
 from lib.fernet import decrypt
 from lib.log import get_logger
@@ -28,12 +27,31 @@ def get_author_app_passwd(author_did: str) -> str:
         raise InvalidAuthorDidError("Author DID is not matched.")
 
 
-def get_images(paths: Optional[List[str]] = None) -> Generator[Image, None, None]:
-    """画像を取得して返すジェネレータ"""
+def get_image_bytes(paths: List[str]) -> Generator[bytes, None, None]:
+    """ウォーターマークを合成した画像を、デコードせずにエンコード済みのバイト列のまま返すジェネレータ
+
+    S3のレスポンスを1つのバイト列に読み込むだけで、画像ごとに読み込みとアップロードを順に行える
+    """
     for path in paths:
-        with BytesIO(get_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, path)["Body"].read()) as f:
-            yield Image.open(f)
-    return None
+        yield get_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, path)["Body"].read()
+
+
+def get_watermark_metadata(author_did: str) -> dict:
+    """投稿者のウォーターマークのメタデータを返す"""
+    metadata_path = (
+        PurePosixPath("metadatas").joinpath(get_id_of_did(author_did)).with_suffix(".json")
+    )
+    metadata_obj = get_object(settings.WATERMARKS_BUCKET_NAME, metadata_path.as_posix())
+    with metadata_obj["Body"] as s:
+        return json.loads(s.data.decode("utf-8"))
+
+
+def get_watermark_version(metadata: dict) -> str:
+    """ウォーターマークのバージョンを返す
+
+    登録し直すと変わるため、元画像のETagをバージョンとして使う
+    """
+    return head_object(settings.WATERMARKS_BUCKET_NAME, metadata["path"])["ETag"].strip('"')
 
 
 def get_metadata(bucket, key) -> Json:
@@ -0,0 +1,171 @@
+"""ウォーターマークの合成処理
+
+白の透過・タイリング・ブレンドを、PillowのC実装による一括処理だけで行う。
+画素ごとのPythonループや全画素のコピーを繰り返していた旧実装と、同じ画素値の画像を返す。
+
+settings など起動時に外部通信が発生するモジュールを import しないこと(ベンチマークから直接呼び出す)。
+"""
+
+import math
+from io import BytesIO
+from typing import BinaryIO, Dict, Iterable, Optional, Tuple
+
+from PIL import Image, ImageChops
+
+TILE_COLUMNS = 6
+"""横に並べるウォーターマークの枚数"""
+WATERMARK_ALPHA = 128
+"""ウォーターマークの不透明部分に適用するアルファ値"""
+OVERLAY_COLOR = (255, 255, 255, 200)
+"""ウォーターマークを重ねる背景色"""
+BLEND_ALPHA = 0.2
+"""元画像にウォーターマークの層を混ぜる割合"""
+STRIP_LAYERS = 4
+"""帯ごとの合成で同時に保持する、帯の大きさのRGBA画像の枚数(元画像の帯・そのRGBA変換・層の帯・合成結果)"""
+DERIVATIVE_WIDTHS = (256, 512, 1024)
+"""登録時に作るウォーターマークの縮小版の幅"""
+
+
+def _div255(value: int) -> int:
+    """Pillowが合成時に使う、丸め付きの255除算"""
+    tmp = value + 128
+    return ((tmp >> 8) + tmp) >> 8
+
+
+_WHITE_LUT = [255 if v == 255 else 0 for v in range(256)]
+"""255のみを255、それ以外を0にする変換表"""
+
+_MASK_LUT = [_div255(a * (255 - _div255(a * (255 - a) + WATERMARK_ALPHA * a))) for a in range(256)]
+"""ウォーターマークのアルファ値から、背景色に重ねる際のマスク値への変換表
+
+旧実装がアルファチャンネルに対して行っていた、定数アルファの貼り付けと透明色との合成を1つにまとめたもの。
+"""
+
+
+def make_transparent_white(img: Image) -> Image:
+    """白(255, 255, 255)の画素を透明にしたRGBA画像を返す"""
+    rgba = img.convert("RGBA")
+    r, g, b, a = rgba.split()
+    is_white = ImageChops.multiply(
+        ImageChops.multiply(r.point(_WHITE_LUT), g.point(_WHITE_LUT)), b.point(_WHITE_LUT)
+    )
+    rgba.putalpha(ImageChops.subtract(a, is_white))
+    return rgba
+
+
+def make_derivatives(img: Image) -> Tuple[Image.Image, Dict[int, Image.Image]]:
+    """登録時に作る、白を透過しアルファ乗算済み(RGBa)のウォーターマークと、その縮小版を返す
+
+    RGBA画像の縮小はPillow内部でRGBaに変換してから行われるため、変換済みのものを保存しておけば
+    合成時の前処理が不要になり、縮小結果もRGBAから縮小した場合と一致する。
+    """
+    derivative = make_transparent_white(img).convert("RGBa")
+    scaled = {}
+    for width in DERIVATIVE_WIDTHS:
+        if width >= derivative.width:
+            break
+        height = max(1, round(derivative.height * width / derivative.width))
+        scaled[width] = derivative.resize((width, height))
+    return derivative, scaled
+
+
+def encode_derivative(derivative: Image) -> BytesIO:
+    """RGBa画像を、画素値をそのままRGBAとして扱ったPNGにする(PNGはRGBaを扱えないため)"""
+    out = BytesIO()
+    Image.frombytes("RGBA", derivative.size, derivative.tobytes()).save(out, format="PNG")
+    out.seek(0)
+    return out
+
+
+def decode_derivative(f: BinaryIO) -> Image.Image:
+    """encode_derivative したPNGをRGBa画像として読み込む"""
+    with Image.open(f) as png:
+        return Image.frombytes("RGBa", png.size, png.tobytes())
+
+
+def select_scaled_width(widths: Iterable[int], required_width: int) -> Optional[int]:
+    """縮小元に使う縮小版の幅を返す。required_width 以上の縮小版が無い場合は None(元画像を使う)"""
+    candidates = [w for w in widths if w >= required_width]
+    return min(candidates) if candidates else None
+
+
+def make_overlay_tile(tile_img: Image, width: int, height: int) -> Image:
+    """ウォーターマーク1枚分を指定サイズに縮小し、背景色に重ねた状態で返す
+
+    重ねる処理は画素ごとに独立しているため、タイリングする前の1枚に対して行えば十分
+    """
+    resized_tile_img = tile_img.resize((width, height))
+    if resized_tile_img.mode != "RGBA":
+        # 登録時に作ったRGBaのウォーターマーク。同じサイズの場合のみRGBAとの往復で画素値がわずかに変わる
+        resized_tile_img = resized_tile_img.convert("RGBA")
+    overlay_tile = Image.new("RGBA", resized_tile_img.size, OVERLAY_COLOR)
+    overlay_tile.paste(resized_tile_img, mask=resized_tile_img.getchannel("A").point(_MASK_LUT))
+    return overlay_tile
+
+
+def make_overlay(
+    target_width: int,
+    target_height: int,
+    tile_img: Image,
+    wcnt: int = TILE_COLUMNS,
+    tile_size: Optional[Tuple[int, int]] = None,
+) -> Image:
+    """横にwcnt枚のウォーターマークを敷き詰めた、元画像に混ぜる層を返す
+
+    tile_img に縮小版を渡す場合は、タイルの縦横比を揃えるため tile_size に元のサイズを渡す
+    """
+    tile_width, tile_height = tile_size or tile_img.size
+    expected_width = target_width // wcnt
+    expected_height = round(tile_height * expected_width / tile_width)
+    hcnt = round(target_height / expected_height)
+    overlay_tile = make_overlay_tile(tile_img, expected_width, expected_height)
+
+    overlay = Image.new("RGBA", (target_width, target_height), OVERLAY_COLOR)
+    for i in range(wcnt):
+        for k in range(hcnt):
+            overlay.paste(overlay_tile, (i * expected_width, k * expected_height))
+    return overlay
+
+
+def blend_overlay(input_img: Image, overlay: Image) -> Image:
+    """元画像にウォーターマークの層を混ぜたRGBA画像を返す"""
+    return Image.blend(input_img.convert("RGBA"), overlay, BLEND_ALPHA)
+
+
+def strip_height_for_budget(width: int, budget_bytes: int) -> int:
+    """帯ごとの合成の一時的な画像が budget_bytes に収まる帯の高さを返す"""
+    return max(1, budget_bytes // (width * 4 * STRIP_LAYERS))
+
+
+def composite_in_strips(
+    input_img: Image,
+    tile_img: Image,
+    strip_height: int,
+    wcnt: int = TILE_COLUMNS,
+    tile_size: Optional[Tuple[int, int]] = None,
+) -> Image:
+    """元画像にウォーターマークの層を混ぜたRGBA画像を、横長の帯ごとに合成して返す
+
+    make_overlay と blend_overlay の結果と同じ画素値になるが、画像全体の大きさの層・RGBA変換・合成結果を
+    作らないため、同時に保持するのは元画像と出力のほかは帯の大きさの画像だけになる
+    """
+    width, height = input_img.size
+    tile_width, tile_height = tile_size or tile_img.size
+    expected_width = width // wcnt
+    expected_height = round(tile_height * expected_width / tile_width)
+    hcnt = round(height / expected_height)
+    overlay_tile = make_overlay_tile(tile_img, expected_width, expected_height)
+    # 層は縦に同じ行の繰り返しのため、1行分だけ作っておく
+    overlay_row = Image.new("RGBA", (width, expected_height), OVERLAY_COLOR)
+    for i in range(wcnt):
+        overlay_row.paste(overlay_tile, (i * expected_width, 0))
+
+    output = Image.new("RGBA", (width, height))
+    for top in range(0, height, strip_height):
+        bottom = min(top + strip_height, height)
+        overlay = Image.new("RGBA", (width, bottom - top), OVERLAY_COLOR)
+        for k in range(top // expected_height, min(hcnt, math.ceil(bottom / expected_height))):
+            overlay.paste(overlay_row, (0, k * expected_height - top))
+        strip = input_img.crop((0, top, width, bottom)).convert("RGBA")
+        output.paste(Image.blend(strip, overlay, BLEND_ALPHA), (0, top))
+    return output
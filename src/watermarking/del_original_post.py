@@ -2,11 +2,11 @@ import json
 
 from atproto import Client
 
-from lib.bs.client import get_client
 from lib.common_converter import get_did_from_post_uri
 from lib.log import get_logger
 from settings import settings
-from watermarking.bucketio import get_author_app_passwd, get_metadata
+from watermarking.bucketio import get_metadata
+from watermarking.user_clients import user_clients
 
 logger = get_logger(__name__)
 
@@ -26,12 +26,12 @@ def handler(event, context):
     logger.info(f"Received event: {event}")
     logger.info(f"Getting deleting post metadata from `{settings.ORIGINAL_IMAGE_BUCKET_NAME}`...")
 
+    author_did = None
     try:
         metadata = get_metadata(settings.ORIGINAL_IMAGE_BUCKET_NAME, event["metadata"])
         original_post_uri = metadata["uri"]
         author_did = get_did_from_post_uri(original_post_uri)
-        author_app_passwd = get_author_app_passwd(author_did)
-        user_client = get_client(author_did, author_app_passwd)
+        user_client = user_clients.get(author_did)
         if user_client.delete_post(original_post_uri):
             msg = f"Original post deleted successfully, uri: {original_post_uri}"
             logger.info(msg)
@@ -40,6 +40,9 @@ def handler(event, context):
             # This is a critical error, so we should raise an exception
             return delete_repost(user_client, json.loads(event["repost"])["uri"])
     except Exception as e:
+        if author_did:
+            # セッションが無効になっている場合に備え、次回は userinfo から読み直してログインする
+            user_clients.invalidate(author_did)
         logger.error(f"Failed to delete original post, error: {str(e)}")
 
 
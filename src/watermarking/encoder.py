@@ -0,0 +1,302 @@
+"""画像サイズの上限に収まるよう、できるだけ少ないエンコード回数で画像をエンコードする
+
+画像の一部を切り出した見本をエンコードして全体のサイズを予測し、上限に収まる最も高い品質・解像度から試す。
+実際にエンコードした結果で予測を補正しながら、上限に収まるまで品質・解像度を下げる。
+
+settings など起動時に外部通信が発生するモジュールを import しないこと(ベンチマークから直接呼び出す)。
+"""
+
+import math
+import os
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Dict, Iterable, Optional, Tuple
+
+from PIL import Image
+
+MAX_SIZE = 950 * 1024
+"""エンコード後のバイト数の上限。Blueskyの画像のblobの上限(976.56KB)に余裕を持たせる"""
+OUTPUT_FORMATS = tuple(os.getenv("WATERMARKED_IMAGE_FORMATS", default="PNG,JPEG,WEBP").split(","))
+"""出力に使うフォーマット。先にあるものを優先する"""
+
+LOSSLESS_FORMAT = "PNG"
+LOSSY_FORMATS = ("JPEG", "WEBP")
+QUALITIES = (95, 90, 85, 80, 75, 70, 60)
+"""試す品質。最低品質でも収まらない場合は解像度を下げる"""
+SCALE_QUALITY = 75
+"""解像度を下げる場合の品質"""
+SIZE_MARGIN = 0.95
+"""予測の誤差を見込み、上限のこの割合に収まる組み合わせを選ぶ"""
+GOOD_ENOUGH_RATIO = 0.6
+"""前回のパラメータで上限のこの割合以上になった場合は、より高い品質を探さずに採用する"""
+MAX_ATTEMPTS = 8
+"""全体のエンコード回数の上限。超えた場合は収まるまで解像度を下げる"""
+
+RECOMPRESSION_RATIOS = {"image/jpeg": 0.5, "image/webp": 0.7}
+"""元の画像のバイト数に対する、同じ解像度で SCALE_QUALITY のJPEGにした場合のバイト数の目安"""
+LOSSLESS_RECOMPRESSION_RATIO = 0.15
+"""PNGなど可逆圧縮の元画像の場合の目安"""
+DRAFT_REDUCING_GAP = 2.0
+"""縮小時に、目標サイズのこの倍率までは画素を間引いて縮小してから補間する"""
+
+_SAMPLE_BLOCK = 128
+"""サイズ予測の見本として切り出すブロックの一辺"""
+_SAMPLE_GRID = 4
+"""見本のブロックを縦横それぞれ何か所から切り出すか"""
+
+SUFFIXES = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+class ImageTooLargeError(Exception):
+    """1画素に縮小しても上限に収まらない"""
+
+
+@dataclass(frozen=True)
+class EncodeParams:
+    format: str
+    quality: int = 0
+    """PNGの場合は使わない"""
+    scale: float = 1.0
+    """元の解像度に対する倍率"""
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data: bytes
+    params: EncodeParams
+    width: int
+    height: int
+    attempts: int
+    """全体をエンコードした回数"""
+
+    @property
+    def suffix(self) -> str:
+        return SUFFIXES[self.params.format]
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.params.format]
+
+
+def _prepare(img: Image, params: EncodeParams) -> Image:
+    if params.format != LOSSLESS_FORMAT and img.mode != "RGB":
+        # 非可逆圧縮ではアルファを持たせずRGBにする
+        img = img.convert("RGB")
+    if params.scale < 1.0:
+        img = img.resize(
+            (max(1, int(img.width * params.scale)), max(1, int(img.height * params.scale)))
+        )
+    return img
+
+
+def _save(img: Image, params: EncodeParams) -> bytes:
+    with BytesIO() as out:
+        if params.format == LOSSLESS_FORMAT:
+            img.save(out, format=params.format)
+        else:
+            img.save(out, format=params.format, quality=params.quality)
+        return out.getvalue()
+
+
+def _make_sample(img: Image) -> Image:
+    """画像全体から等間隔にブロックを切り出し、元の解像度のまま並べた見本を返す"""
+    block_w = min(_SAMPLE_BLOCK, img.width // _SAMPLE_GRID)
+    block_h = min(_SAMPLE_BLOCK, img.height // _SAMPLE_GRID)
+    if block_w == 0 or block_h == 0:
+        return img
+    sample = Image.new(img.mode, (block_w * _SAMPLE_GRID, block_h * _SAMPLE_GRID))
+    for i in range(_SAMPLE_GRID):
+        for k in range(_SAMPLE_GRID):
+            left = (img.width * (2 * i + 1)) // (2 * _SAMPLE_GRID) - block_w // 2
+            top = (img.height * (2 * k + 1)) // (2 * _SAMPLE_GRID) - block_h // 2
+            sample.paste(
+                img.crop((left, top, left + block_w, top + block_h)), (i * block_w, k * block_h)
+            )
+    return sample
+
+
+def plan_output_size(
+    width: int, height: int, mime_type: str, blob_size: int, max_size: int
+) -> Tuple[int, int]:
+    """元の画像の情報から、max_size バイトに収まる出力の解像度を予測する
+
+    合成前に縮小しておけば、合成・エンコードの対象の画素が減り、エンコード後の縮小も不要になる。
+    予測が外れた場合は encode_within が品質・解像度を補正する。
+
+    Args:
+        width (int): 元の画像の幅
+        height (int): 元の画像の高さ
+        mime_type (str): 元の画像のMIMEタイプ(ポストのメタデータの値)
+        blob_size (int): 元の画像のバイト数(ポストのメタデータの値)
+        max_size (int): エンコード後のバイト数の上限
+
+    Returns:
+        Tuple[int, int]: 出力の幅と高さ
+    """
+    predicted = blob_size * RECOMPRESSION_RATIOS.get(mime_type, LOSSLESS_RECOMPRESSION_RATIO)
+    if predicted <= max_size * SIZE_MARGIN:
+        return width, height
+    scale = math.sqrt(max_size * SIZE_MARGIN / predicted)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def load_at_size(img: Image, size: Tuple[int, int]) -> Image:
+    """Image.open しただけの(画素を展開していない)画像を、指定した解像度で読み込む
+
+    JPEGはデコード時にDCTの段階で1/2・1/4・1/8に縮小するため、元の解像度の画素を展開しない
+    """
+    if img.size == size:
+        return img
+    img.draft(img.mode, size)
+    if img.mode not in ("L", "RGB", "RGBA"):
+        # パレットなどは補間できないため、合成時と同じRGBAにしてから縮小する
+        img = img.convert("RGBA")
+    return img.resize(size, reducing_gap=DRAFT_REDUCING_GAP)
+
+
+class SizePredictor:
+    """見本のエンコード結果から、画像全体をエンコードした場合のサイズを予測する
+
+    サイズは画素数にほぼ比例するものとし、見本の1画素あたりのバイト数から求める。
+    実際にエンコードした結果との比で、フォーマットごとに予測を補正する。
+    """
+
+    def __init__(self, img: Image):
+        self._img = img
+        sample = _make_sample(img)
+        # 見本が画像の大半を占める場合は、予測せずに全体をエンコードした方が早い
+        self._sample = (
+            sample if sample.width * sample.height * 2 <= img.width * img.height else None
+        )
+        self._bytes_per_pixel: Dict[Tuple[str, int], float] = {}
+        self._correction: Dict[str, float] = {}
+
+    def _sample_bytes_per_pixel(self, params: EncodeParams) -> float:
+        key = (params.format, params.quality)
+        if key not in self._bytes_per_pixel:
+            sample = _prepare(self._sample, EncodeParams(params.format, params.quality))
+            self._bytes_per_pixel[key] = len(_save(sample, params)) / (sample.width * sample.height)
+        return self._bytes_per_pixel[key]
+
+    def predict(self, params: EncodeParams) -> float:
+        """予測サイズを返す。予測しない小さな画像の場合は0"""
+        if self._sample is None:
+            return 0.0
+        pixels = self._img.width * self._img.height * params.scale**2
+        return (
+            self._sample_bytes_per_pixel(params) * pixels * self._correction.get(params.format, 1.0)
+        )
+
+    def calibrate(self, params: EncodeParams, actual_size: int) -> None:
+        if self._sample is None:
+            return
+        predicted = self.predict(params) / self._correction.get(params.format, 1.0)
+        if predicted > 0:
+            self._correction[params.format] = actual_size / predicted
+
+
+def _candidates(formats: Iterable[str]) -> Iterable[EncodeParams]:
+    """品質の高い順に、試すパラメータを返す"""
+    formats = tuple(formats)
+    if LOSSLESS_FORMAT in formats:
+        yield EncodeParams(LOSSLESS_FORMAT)
+    lossy = [f for f in formats if f in LOSSY_FORMATS]
+    for quality in QUALITIES:
+        for fmt in lossy:
+            yield EncodeParams(fmt, quality)
+
+
+def _is_best(params: EncodeParams, formats: Iterable[str]) -> bool:
+    """これ以上品質を上げられないパラメータか"""
+    return params == next(iter(_candidates(formats)), None)
+
+
+def encode_within(
+    img: Image,
+    max_size: int,
+    formats: Iterable[str] = (LOSSLESS_FORMAT, "JPEG"),
+    hint: Optional[EncodeParams] = None,
+) -> EncodedImage:
+    """max_size バイト未満に収まる、できるだけ品質の高いパラメータで画像をエンコードする
+
+    Args:
+        img (Image): エンコードする画像
+        max_size (int): エンコード後のバイト数の上限
+        formats (Iterable[str]): 候補のフォーマット。先にあるものを優先する
+        hint (Optional[EncodeParams]): 同じユーザーの前回の画像で上限に収まったパラメータ
+
+    Returns:
+        EncodedImage: エンコード結果と、使ったパラメータ・全体のエンコード回数
+
+    Raises:
+        ImageTooLargeError: 1画素に縮小しても max_size バイト以上になる場合
+    """
+    formats = tuple(formats)
+    predictor = SizePredictor(img)
+    attempts = 0
+
+    def attempt(params: EncodeParams) -> Tuple[bytes, Image]:
+        nonlocal attempts
+        attempts += 1
+        prepared = _prepare(img, params)
+        data = _save(prepared, params)
+        predictor.calibrate(params, len(data))
+        return data, prepared
+
+    def result(data: bytes, prepared: Image, params: EncodeParams) -> EncodedImage:
+        return EncodedImage(data, params, prepared.width, prepared.height, attempts)
+
+    # 同じユーザーの画像は似ているため、前回のパラメータで収まり十分大きければそのまま使う
+    hinted = None
+    if hint is not None and hint.format in formats:
+        data, prepared = attempt(hint)
+        if len(data) < max_size:
+            hinted = result(data, prepared, hint)
+            if len(data) >= max_size * GOOD_ENOUGH_RATIO or _is_best(hint, formats):
+                return hinted
+
+    for params in _candidates(formats):
+        if hinted is not None and params == hint:
+            # ここまでの候補は収まらない予測のため、前回のパラメータが最善
+            return hinted
+        if predictor.predict(params) >= max_size * SIZE_MARGIN:
+            continue
+        data, prepared = attempt(params)
+        if len(data) < max_size:
+            return result(data, prepared, params)
+        if attempts >= MAX_ATTEMPTS:
+            break
+    if hinted is not None:
+        return hinted
+
+    # 最低品質でも収まらない場合は、予測サイズが収まる解像度から始め、実際のサイズで解像度を補正する
+    fmt = next((f for f in formats if f in LOSSY_FORMATS), LOSSLESS_FORMAT)
+    quality = SCALE_QUALITY if fmt in LOSSY_FORMATS else 0
+    predicted = predictor.predict(EncodeParams(fmt, quality))
+    scale = min(1.0, math.sqrt(max_size * SIZE_MARGIN / predicted)) if predicted > 0 else 0.5
+    best = None
+    # 収まった最大の倍率と、収まらなかった最小の倍率
+    fitted, overflowed = 0.0, math.inf
+    while True:
+        params = EncodeParams(fmt, quality, scale)
+        data, prepared = attempt(params)
+        if len(data) < max_size:
+            if best is None or len(data) > len(best[0]):
+                best = (data, prepared, params)
+            if len(data) >= max_size * GOOD_ENOUGH_RATIO or scale >= 1.0:
+                return result(*best)
+            fitted = max(fitted, scale)
+        elif prepared.width * prepared.height <= 1:
+            raise ImageTooLargeError(
+                f"Image does not fit in {max_size} bytes even at 1 pixel: {len(data)} bytes"
+            )
+        else:
+            overflowed = min(overflowed, scale)
+        if best is not None and (attempts >= MAX_ATTEMPTS or overflowed / fitted < 1.05):
+            return result(*best)
+        # 縮小すると1画素あたりのバイト数が増えるため、予測どおりの解像度では小さくなりすぎることがある
+        scale = min(1.0, scale * math.sqrt(max_size * SIZE_MARGIN / len(data)))
+        if not fitted < scale < overflowed:
+            # 画像によってはサイズが画素数に比例せず、補正が行き来するため二分探索に切り替える
+            scale = math.sqrt(fitted * overflowed) if fitted > 0 else overflowed / 2
@@ -1,27 +1,45 @@
 import mimetypes
+import os
 import pathlib
+import time
 from io import BytesIO
 from pathlib import PurePosixPath
+from typing import Optional, Tuple
 
-from atproto import Client, IdResolver, models
+import httpx
+from atproto import exceptions, models
 
 from lib.aws.s3 import post_bytes_object, post_string_object
 from lib.bs.client import get_client
 from lib.bs.get_bsky_post_by_url import get_did_from_url, get_rkey_from_url
+from lib.bs.pds import get_pds_resolver
+from lib.bs.post_message import decode_post_message
 from lib.common_converter import get_id_of_did
 from lib.log import get_logger
+from lib.metrics import MetricsRegistry, emit_emf
 from settings import settings
+from watermarking.bucketio import get_watermark_metadata, get_watermark_version
+from watermarking.parallel import map_ordered
+from watermarking.result_cache import METRICS_NAMESPACE, ResultCache
 
 logger = get_logger(__name__)
 
+MAX_WORKERS = int(os.getenv("GET_IMAGE_MAX_WORKERS", default="4"))
+"""並行してダウンロード・アップロードする画像の数。1の場合は順に処理する"""
+BLOB_FETCH_TIMEOUT_SECS = float(os.getenv("BLOB_FETCH_TIMEOUT_SECS", default="10"))
+"""PDSからblobを取得するリクエストごとのタイムアウト"""
+BLOB_FETCH_ATTEMPTS = int(os.getenv("BLOB_FETCH_ATTEMPTS", default="3"))
+"""一時的なエラーでblobの取得を試みる回数。S3へのアップロードはboto3の再試行に任せる"""
+BLOB_FETCH_BACKOFF_SECS = 0.5
+"""再試行までの待ち時間。回数ごとに倍にする"""
 
-def _get_authors_pds_client(author_did: str) -> Client:
-    resolver = IdResolver()
-    did_doc = resolver.did.resolve(author_did)
-    # Since the image to be acquired is stored in the PDS in which the author participates,
-    # the Client of the PDS to which the author belongs is obtained from the author's DID.
-    authors_pds_endpoint = did_doc.service[0].service_endpoint
-    return Client(base_url=authors_pds_endpoint)
+# ウォーム起動の間で再利用する
+result_cache = ResultCache("get_image")
+# ポストの画像は投稿者が参加しているPDSに保存されているため、投稿者のDIDからPDSを解決して取得する
+pds_resolver = get_pds_resolver()
+registry = MetricsRegistry(METRICS_NAMESPACE, {"Service": "watermarking", "Step": "get_image"})
+fetch_ms = registry.histogram("blob_fetch_ms")
+upload_ms = registry.histogram("blob_upload_ms")
 
 
 def _save_post_text_to_s3(
@@ -35,45 +53,113 @@ def _save_post_text_to_s3(
     return post_obj_name
 
 
+def _get_post(event: dict) -> models.AppBskyFeedPost.GetRecordResponse:
+    """イベントが運んできたレコードからポストを組み立てる
+
+    レコードを含まない以前の形式のメッセージの場合は、Botとしてログインしてポストを取得する
+    """
+    post = decode_post_message(event)
+    if post is not None:
+        return post
+    uri = event["uri"]
+    client = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
+    return client.get_post(post_rkey=get_rkey_from_url(uri), profile_identify=get_did_from_url(uri))
+
+
+def _get_watermark_version(author_did: str) -> Optional[str]:
+    """合成結果のキャッシュの確認に使うウォーターマークのバージョンを返す。取得できない場合は None"""
+    try:
+        return get_watermark_version(get_watermark_metadata(author_did))
+    except Exception as e:
+        logger.warning(f"Failed to get watermark version of `{author_did}`: `{str(e)}`")
+        return None
+
+
+def _is_transient(e: Exception) -> bool:
+    """タイムアウト・通信エラー・5xx・429のように、再試行すれば成功しうるエラーか"""
+    if isinstance(e, exceptions.RequestErrorBase) and e.response is not None:
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    # レスポンスが無いものはタイムアウトか通信エラー
+    return isinstance(e, (exceptions.NetworkError, httpx.TransportError))
+
+
+def _fetch_blob(author_did: str, blob_cid: str) -> bytes:
+    """投稿者のPDSからblobを取得する。一時的なエラーの場合は待ち時間を延ばしながら再試行する
+
+    blobが見つからない・削除された場合などは、再試行しても結果が変わらないためすぐに送出する
+    """
+    for attempt in range(1, BLOB_FETCH_ATTEMPTS + 1):
+        try:
+            return pds_resolver.get_blob(author_did, blob_cid, timeout=BLOB_FETCH_TIMEOUT_SECS)
+        except Exception as e:
+            if attempt == BLOB_FETCH_ATTEMPTS or not _is_transient(e):
+                raise
+            logger.warning(f"Failed to fetch blob {blob_cid} (attempt {attempt}): `{str(e)}`")
+            time.sleep(BLOB_FETCH_BACKOFF_SECS * 2 ** (attempt - 1))
+
+
+def _save_blob_to_s3(author_did: str, blob_cid: str, img_object_name: str) -> Tuple[float, float]:
+    """blobを取得してS3に保存し、取得とアップロードの所要時間(ミリ秒)を返す"""
+    started = time.perf_counter()
+    blob = _fetch_blob(author_did, blob_cid)
+    fetched = time.perf_counter()
+    with BytesIO(blob) as f:
+        post_bytes_object(settings.ORIGINAL_IMAGE_BUCKET_NAME, img_object_name, f)
+    uploaded = time.perf_counter()
+    logger.info(
+        f"Original image saved to S3 {img_object_name} ({len(blob)} bytes, "
+        f"fetch {(fetched - started) * 1000:.0f} ms, upload {(uploaded - fetched) * 1000:.0f} ms)"
+    )
+    return (fetched - started) * 1000, (uploaded - fetched) * 1000
+
+
 def handler(event, context):
     """SQSイベントが差すポストから画像を取得しS3バケットに保存する"""
     logger.info(f"Received event: {event}")
-    uri = event["uri"]
     author_did = event["author_did"]
 
-    rkey = get_rkey_from_url(uri)
-    did = get_did_from_url(uri)
-    client = get_client(settings.BOT_USERID, settings.BOT_APP_PASSWORD)
-    post: models.AppBskyFeedPost.GetRecordResponse = client.get_post(
-        post_rkey=rkey, profile_identify=did
-    )
+    post = _get_post(event)
 
-    authors_pds_client = _get_authors_pds_client(author_did)
     id_of_did = get_id_of_did(author_did)
 
-    return_payload = {"metadata": {}, "image_paths": [], "post": {}}
+    watermark_version = _get_watermark_version(author_did)
+
+    return_payload = {"metadata": {}, "image_paths": [], "cached_images": [], "post": {}}
     base_path = PurePosixPath(post.cid).joinpath(id_of_did)
     # ポストの本文情報をS3に保存
     return_payload["metadata"] = _save_post_text_to_s3(base_path, post)
     return_payload["post"] = post.model_dump_json()
 
-    num_of_file = len(post.value.embed.images)
-    # ポストに含まれる画像を取得しS3に保存
-    for image, num_of_file in zip(post.value.embed.images, range(num_of_file)):
+    # 合成結果のキャッシュに無い画像を、ダウンロード・アップロードを重ねて並行して保存する
+    downloads = []
+    for num_of_file, image in enumerate(post.value.embed.images):
         blob_cid = image.image.cid.encode()
-        blob = authors_pds_client.com.atproto.sync.get_blob(
-            models.ComAtprotoSyncGetBlob.Params(cid=blob_cid, did=author_did)
+        img_object_name = base_path.joinpath(str(num_of_file)).with_suffix(
+            mimetypes.guess_extension(image.image.mime_type)
+        )
+        img_object_name = img_object_name.as_posix()
+        return_payload["image_paths"].append(img_object_name)
+        # 同じ画像を合成した結果があれば、ダウンロードせずに apply_watermark でコピーする
+        cached = result_cache.get(blob_cid, watermark_version) if watermark_version else None
+        return_payload["cached_images"].append(cached)
+        if cached is not None:
+            logger.info(f"Watermarked image of {blob_cid} is cached, skipped downloading")
+            continue
+        downloads.append((blob_cid, img_object_name))
+
+    started = time.perf_counter()
+    timings = map_ordered(lambda d: _save_blob_to_s3(author_did, *d), downloads, MAX_WORKERS)
+    # メトリクスはスレッドセーフでないため、まとめて記録する
+    for image_fetch_ms, image_upload_ms in timings:
+        fetch_ms.observe(image_fetch_ms)
+        upload_ms.observe(image_upload_ms)
+    if downloads:
+        logger.info(
+            f"Saved {len(downloads)} original images in {(time.perf_counter() - started) * 1000:.0f} ms"
         )
-        # S3に画像とそのmetadataのセットを保存
-        with BytesIO(blob) as f:
-            img_object_name = base_path.joinpath(str(num_of_file)).with_suffix(
-                mimetypes.guess_extension(image.image.mime_type)
-            )
-            img_object_name = img_object_name.as_posix()
-            post_bytes_object(settings.ORIGINAL_IMAGE_BUCKET_NAME, img_object_name, f)
-            return_payload["image_paths"].append(img_object_name)
-            logger.info(f"Original image saved to S3 {img_object_name}")
 
+    result_cache.emit_metrics()
+    emit_emf(registry)
     return return_payload
 
 
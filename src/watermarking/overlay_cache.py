@@ -0,0 +1,219 @@
+"""ユーザーごとのウォーターマークの層(`make_tile` の結果)のキャッシュ
+
+ユーザーは同じ解像度の画像を繰り返し投稿するため、(DID, ウォーターマークのバージョン, 画像サイズ) ごとに
+タイリング済みの層を保持する。Lambdaのウォーム起動の間で再利用できるよう、モジュールレベルで保持する。
+
+ウォーターマークのバージョンには画像のS3オブジェクトのETagを使う。ユーザーが新しいウォーターマークを
+登録するとETagが変わるため、古いバージョンの層は次に参照した時点で破棄する。
+"""
+
+import os
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from lib.log import get_logger
+
+logger = get_logger(__name__)
+
+OverlayKey = Tuple[str, str, int, int]
+"""(DID, ウォーターマークのバージョン, 幅, 高さ)"""
+
+
+def _size_of(overlay: Image) -> int:
+    return overlay.width * overlay.height * len(overlay.getbands())
+
+
+class OverlayCache:
+    """メモリ上のLRUと、溢れた層を退避するディレクトリの2段のキャッシュ
+
+    退避先の読み書きは層1枚で数十MBになるため、ロックを解放してから行う
+
+    Args:
+        max_bytes (int): メモリに保持する層の合計バイト数の上限
+        spill_dir (Optional[str]): メモリから溢れた層の退避先。None の場合は退避しない
+        spill_max_bytes (int): 退避先に保持する合計バイト数の上限
+    """
+
+    def __init__(self, max_bytes: int, spill_dir: Optional[str] = None, spill_max_bytes: int = 0):
+        self._max_bytes = max_bytes
+        self._spill_dir = Path(spill_dir) if spill_dir else None
+        self._spill_max_bytes = spill_max_bytes
+        self._entries: OrderedDict[OverlayKey, Image.Image] = OrderedDict()
+        self._bytes = 0
+        self._versions: Dict[str, str] = {}
+        self._inflight: Dict[OverlayKey, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        # 同じポストの画像を並行して処理するため
+        self._lock = Lock()
+
+    def _spill_path(self, key: OverlayKey) -> Path:
+        did, version, width, height = key
+        return self._spill_dir.joinpath(did.replace(":", "_"), f"{version}-{width}x{height}.rgba")
+
+    def _spill(self, key: OverlayKey, overlay: Image) -> None:
+        if self._spill_dir is None or _size_of(overlay) > self._spill_max_bytes:
+            return
+        path = self._spill_path(key)
+        if path.exists():
+            # メモリに読み戻したものは退避先にも残っている
+            return
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 同じ層を複数のスレッドが退避する場合があるため、一時ファイルは書き込みごとに分ける
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_bytes(overlay.tobytes())
+            os.replace(tmp_path, path)
+            self._trim_spill()
+        except OSError as e:
+            logger.warning(f"Failed to spill watermark overlay to `{path}`: `{str(e)}`")
+
+    def _trim_spill(self) -> None:
+        """退避先の合計が上限を超えている場合、参照が古いものから削除する"""
+        files = [(p, p.stat()) for p in self._spill_dir.glob("*/*.rgba")]
+        total = sum(stat.st_size for _, stat in files)
+        for path, stat in sorted(files, key=lambda f: f[1].st_mtime):
+            if total <= self._spill_max_bytes:
+                return
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+    def _load_spilled(self, key: OverlayKey) -> Optional[Image.Image]:
+        if self._spill_dir is None:
+            return None
+        path = self._spill_path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        _, _, width, height = key
+        if len(data) != width * height * 4:
+            path.unlink(missing_ok=True)
+            return None
+        # 退避先でも参照順に削除されるよう更新日時を進める
+        os.utime(path)
+        return Image.frombytes("RGBA", (width, height), data)
+
+    def _spill_all(self, victims: List[Tuple[OverlayKey, Image.Image]]) -> None:
+        for key, overlay in victims:
+            self._spill(key, overlay)
+
+    def _put_memory(self, key: OverlayKey, overlay: Image) -> List[Tuple[OverlayKey, Image.Image]]:
+        """層をメモリに置き、溢れた層を返す。呼び出し側はロックを解放してから _spill_all に渡す"""
+        size = _size_of(overlay)
+        if size > self._max_bytes:
+            return [(key, overlay)]
+        replaced = self._entries.pop(key, None)
+        if replaced is not None:
+            self._bytes -= _size_of(replaced)
+        self._entries[key] = overlay
+        self._bytes += size
+        victims = []
+        while self._bytes > self._max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self._bytes -= _size_of(evicted)
+            victims.append((evicted_key, evicted))
+        return victims
+
+    def invalidate(self, did: str) -> None:
+        """ユーザーの層をすべて破棄する"""
+        with self._lock:
+            self._invalidate(did)
+
+    def _invalidate(self, did: str) -> None:
+        for key in [k for k in self._entries if k[0] == did]:
+            self._bytes -= _size_of(self._entries.pop(key))
+        if self._spill_dir is not None:
+            for path in self._spill_dir.joinpath(did.replace(":", "_")).glob("*.rgba"):
+                path.unlink(missing_ok=True)
+        self._versions.pop(did, None)
+
+    def _check_version(self, did: str, version: str) -> None:
+        """ウォーターマークが登録し直されていた場合、以前のバージョンの層を破棄する"""
+        if self._versions.get(did) not in (None, version):
+            logger.info(f"Watermark of `{did}` was updated, dropping cached overlays.")
+            self._invalidate(did)
+        self._versions[did] = version
+
+    def get(self, did: str, version: str, size: Tuple[int, int]) -> Optional[Image.Image]:
+        """キャッシュした層を返す。無い場合は None"""
+        key = (did, version, *size)
+        with self._lock:
+            overlay = self._get_memory(key)
+        if overlay is not None:
+            return overlay
+        overlay = self._load_spilled(key)
+        with self._lock:
+            if overlay is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            victims = self._put_memory(key, overlay)
+        self._spill_all(victims)
+        return overlay
+
+    def _get_memory(self, key: OverlayKey) -> Optional[Image.Image]:
+        did, version, _, _ = key
+        self._check_version(did, version)
+        overlay = self._entries.get(key)
+        if overlay is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return overlay
+
+    def put(self, did: str, version: str, overlay: Image) -> None:
+        """層をキャッシュする。キャッシュした層は呼び出し側で変更しないこと"""
+        with self._lock:
+            self._check_version(did, version)
+            victims = self._put_memory((did, version, overlay.width, overlay.height), overlay)
+        self._spill_all(victims)
+
+    def get_or_create(
+        self, did: str, version: str, size: Tuple[int, int], create: Callable[[], Image.Image]
+    ) -> Image.Image:
+        """キャッシュした層を返す。無い場合は退避先から読み込むか create で作ってキャッシュする
+
+        同じキーの層を並行して要求された場合は1回だけ読み込むか作り、他は結果を待つ
+        """
+        key = (did, version, *size)
+        with self._lock:
+            overlay = self._get_memory(key)
+            if overlay is not None:
+                return overlay
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.misses += 1
+        if not leader:
+            # 他のスレッドが読み込むか作るのを待つ
+            return future.result()
+
+        try:
+            overlay = self._load_spilled(key)
+            spilled = overlay is not None
+            if not spilled:
+                overlay = create()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if spilled:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._check_version(did, version)
+            victims = self._put_memory(key, overlay)
+        future.set_result(overlay)
+        self._spill_all(victims)
+        return overlay
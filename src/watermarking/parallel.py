@@ -0,0 +1,110 @@
+"""ポストの画像を並行して処理するためのスレッドプールとメモリの予算
+
+Pillowはデコード・合成・エンコードの間GILを解放し、S3の読み書きもI/O待ちになるため、
+画像ごとの処理をスレッドで並行させればLambdaに割り当てられたコアを使い切れる。
+同時に展開する画素がLambdaのメモリ上限を超えないよう、画像ごとの見積もりで同時実行を制限する。
+
+settings など起動時に外部通信が発生するモジュールを import しないこと(ベンチマークから直接呼び出す)。
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+WORKING_LAYERS = 5
+"""合成からエンコードまでに同時に保持する、出力の解像度のRGBA画像の枚数(元画像・層・合成結果・RGB変換・エンコード結果)"""
+STRIP_WORKING_LAYERS = 3
+"""帯ごとに合成する場合に、帯のほかに保持する出力の解像度のRGBA画像の枚数(元画像・合成結果・RGB変換)"""
+DEFAULT_MEMORY_BYTES = 512 * 1024 * 1024
+"""Lambda以外で実行した場合に想定するメモリ"""
+
+
+def lambda_memory_bytes() -> int:
+    """Lambdaに割り当てられたメモリのバイト数を返す"""
+    memory_mb = os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    return int(memory_mb) * 1024 * 1024 if memory_mb else DEFAULT_MEMORY_BYTES
+
+
+MAX_IMAGES = 4
+"""ポストに添付できる画像の枚数"""
+MAX_WORKERS = int(os.getenv("APPLY_WATERMARK_MAX_WORKERS", default=str(MAX_IMAGES)))
+"""並行して処理する画像の枚数。1の場合は順に処理する"""
+IMAGE_MEMORY_FRACTION = float(os.getenv("APPLY_WATERMARK_IMAGE_MEMORY_FRACTION", default="0.6"))
+"""Lambdaのメモリのうち、並行して処理する画像の画素に使ってよい割合(残りはランタイムやキャッシュ用)"""
+STRIP_MEMORY_BYTES = int(
+    os.getenv(
+        "STRIP_COMPOSITING_MEMORY_BYTES",
+        default=str(int(lambda_memory_bytes() * IMAGE_MEMORY_FRACTION) // MAX_WORKERS),
+    )
+)
+"""画像全体の層・合成結果の合計がこれを超える場合は、帯ごとに合成して一時的な画像をこの大きさに抑える
+
+既定では、並行して処理する画像1枚あたりのメモリの予算。帯ごとの合成は層のキャッシュを使わないため、
+小さくすると層のキャッシュが効く画像が減る
+"""
+
+
+def estimate_image_bytes(
+    source_size: Tuple[int, int], target_size: Tuple[int, int], strip_bytes: Optional[int] = None
+) -> int:
+    """画像1枚の処理で同時に保持するバイト数を見積もる
+
+    元画像を縮小して読み込む場合は、縮小前の画素も一時的に保持する。
+    帯ごとに合成する場合は strip_bytes に帯の一時的な画像の予算を渡す
+    """
+    if strip_bytes is None:
+        target_bytes = target_size[0] * target_size[1] * 4 * WORKING_LAYERS
+    else:
+        target_bytes = target_size[0] * target_size[1] * 4 * STRIP_WORKING_LAYERS + strip_bytes
+    if source_size == target_size:
+        return target_bytes
+    return source_size[0] * source_size[1] * 4 + target_bytes
+
+
+class MemoryBudget:
+    """同時に処理する画像の見積もりバイト数の合計を、上限以下に保つ
+
+    上限より大きい画像も、他に処理中の画像が無ければ処理できる(待ち続けないようにするため)
+
+    Args:
+        limit_bytes (int): 見積もりバイト数の合計の上限
+    """
+
+    def __init__(self, limit_bytes: int):
+        self.limit_bytes = limit_bytes
+        self._reserved = 0
+        self._condition = Condition()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[None]:
+        """nbytes を確保できるまで待ち、抜ける時に解放する"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._reserved == 0 or self._reserved + nbytes <= self.limit_bytes
+            )
+            self._reserved += nbytes
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._reserved -= nbytes
+                self._condition.notify_all()
+
+
+def map_ordered(
+    func: Callable[[T], R], items: Iterable[T], max_workers: Optional[int] = None
+) -> List[R]:
+    """func を items に並行して適用し、結果を items の順に返す
+
+    max_workers が1以下の場合はスレッドを使わずに順に処理する。いずれかで例外が発生した場合はそれを送出する
+    """
+    items = list(items)
+    if (max_workers is not None and max_workers <= 1) or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers or len(items), len(items))) as executor:
+        return list(executor.map(func, items))
@@ -1,13 +1,12 @@
-from io import BytesIO
 from typing import List
 
 from atproto import models
 
-from lib.bs.client import get_client
 from lib.common_converter import get_did_from_post_uri
 from lib.log import get_logger
 from settings import settings
-from watermarking.bucketio import get_author_app_passwd, get_images, get_metadata
+from watermarking.bucketio import get_image_bytes, get_metadata
+from watermarking.user_clients import user_clients
 
 logger = get_logger(__name__)
 
@@ -24,30 +23,39 @@ def handler(event, context):
     image_alts: List = []
     image_aspect_ratios: List = []
 
-    for image, prop in zip(get_images(event["out_image_paths"]), metadatas, strict=True):
-        with BytesIO() as img_byte_arr:
-            image.save(img_byte_arr, format=image.format)
-            images.append(img_byte_arr.getvalue())
-            alt = prop.get("alt") if isinstance(prop.get("alt"), str) else ""
-            image_alts.append(f"{alt} {settings.ALT_OF_SKIP_WATERMARKING}")
-            prop_height: int = image.height
-            prop_width: int = image.width
+    # apply_watermark がエンコードしたバイト列を、デコード・再エンコードせずにそのままアップロードする
+    out_images = event.get("out_images") or [{"path": p} for p in event["out_image_paths"]]
+    paths = [out_image["path"] for out_image in out_images]
+    for data, out_image, prop in zip(get_image_bytes(paths), out_images, metadatas, strict=True):
+        images.append(data)
+        alt = prop.get("alt") if isinstance(prop.get("alt"), str) else ""
+        image_alts.append(f"{alt} {settings.ALT_OF_SKIP_WATERMARKING}")
+        if "width" in out_image and "height" in out_image:
             image_aspect_ratios.append(
-                models.AppBskyEmbedDefs.AspectRatio(height=prop_height, width=prop_width)
+                models.AppBskyEmbedDefs.AspectRatio(
+                    height=out_image["height"], width=out_image["width"]
+                )
             )
+        else:
+            # 幅・高さを返す前の apply_watermark の出力。縦横比は省略する
+            image_aspect_ratios.append(None)
 
     author_did = get_did_from_post_uri(metadata["uri"])
-    author_app_passwd = get_author_app_passwd(author_did)
-    user_client = get_client(author_did, author_app_passwd)
-    resp: models.app.bsky.feed.post.CreateRecordResponse = user_client.send_images(
-        text=metadata["value"]["text"],
-        images=images,
-        image_alts=image_alts,
-        image_aspect_ratios=image_aspect_ratios,
-        langs=metadata["value"]["langs"],
-        facets=metadata["value"]["facets"],
-        reply_to=metadata["value"]["reply"],
-    )
+    user_client = user_clients.get(author_did)
+    try:
+        resp: models.app.bsky.feed.post.CreateRecordResponse = user_client.send_images(
+            text=metadata["value"]["text"],
+            images=images,
+            image_alts=image_alts,
+            image_aspect_ratios=image_aspect_ratios,
+            langs=metadata["value"]["langs"],
+            facets=metadata["value"]["facets"],
+            reply_to=metadata["value"]["reply"],
+        )
+    except Exception:
+        # セッションが無効になっている場合に備え、リトライでは userinfo から読み直してログインする
+        user_clients.invalidate(author_did)
+        raise
     event["repost"] = resp.model_dump_json()
     return event
 
@@ -0,0 +1,67 @@
+"""画像ごとのピークメモリの計測
+
+tracemalloc はPythonのメモリアロケータを通る確保(S3から読んだバイト列・エンコード結果など)だけを追跡し、
+Pillowが画素の保持に使うメモリは含まない。そのため、プロセスの最大RSSの増加量も合わせて記録する。
+最大RSSはプロセス全体の最大値のため、以前の画像より多く使った場合にだけ増える。
+
+tracemalloc はプロセス全体で1つのため、並行して処理している画像の確保も含まれる。画像ごとの正確な値が必要な
+場合は APPLY_WATERMARK_MAX_WORKERS=1 で計測すること。
+
+settings など起動時に外部通信が発生するモジュールを import しないこと(ベンチマークから直接呼び出す)。
+"""
+
+import resource
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass
+from threading import Lock
+from typing import Iterator
+
+_lock = Lock()
+_active = 0
+"""計測中の数。最初の計測で tracemalloc を開始し、最後の計測で停止する"""
+
+
+def _max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOSではバイト、Linuxではキロバイト
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+@dataclass
+class PeakMemory:
+    traced_peak_bytes: int = 0
+    """計測中にtracemallocが追跡したメモリのピーク"""
+    max_rss_increase_bytes: int = 0
+    """計測中のプロセスの最大RSSの増加量"""
+
+
+@contextmanager
+def measure_peak_memory() -> Iterator[PeakMemory]:
+    """with ブロックの間のピークメモリを計測し、抜けた時に結果を設定する
+
+    Usage:
+        ```
+        with measure_peak_memory() as peak:
+            ...
+        logger.info(f"Peak memory: {peak.traced_peak_bytes} bytes")
+        ```
+    """
+    global _active
+    with _lock:
+        if _active == 0:
+            tracemalloc.start()
+        _active += 1
+        traced_before = tracemalloc.get_traced_memory()[0]
+    max_rss_before = _max_rss_bytes()
+    peak = PeakMemory()
+    try:
+        yield peak
+    finally:
+        with _lock:
+            peak.traced_peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - traced_before)
+            peak.max_rss_increase_bytes = _max_rss_bytes() - max_rss_before
+            _active -= 1
+            if _active == 0:
+                tracemalloc.stop()
@@ -0,0 +1,169 @@
+"""ウォーターマークを合成した結果の、元画像の内容をキーにしたキャッシュ
+
+同じイラストはリポスト・クロスポスト・リトライで何度も処理されるため、元画像のblobのCID・ウォーターマークの
+バージョン・合成処理のバージョンの組ごとに、エンコード済みの結果を WATERMARKED_IMAGE_BUCKET_NAME の
+`results/` 以下に保存する。ヒットした場合は、ダウンロード・合成・エンコードを行わずにS3上でコピーする。
+
+古いものはバケットのライフサイクルルールと読み込み時の日時の確認で、合計サイズの超過分は古いものから削除する。
+ヒットした結果は自身にコピーして更新日時を進めるため、どちらも最後に参照された日時で判断する(LRU)。
+"""
+
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import PurePosixPath
+from threading import Lock
+from typing import Optional
+
+from lib.aws.s3 import copy_object, delete_objects, head_object, list_objects
+from lib.log import get_logger
+from lib.metrics import Counter, MetricsRegistry, emit_emf
+from settings import settings
+
+logger = get_logger(__name__)
+
+PIPELINE_VERSION = "1"
+"""合成・エンコードの結果が変わる変更をした場合に上げる。以前の結果はキャッシュから参照されなくなる"""
+RESULT_CACHE_PREFIX = "results"
+RESULT_CACHE_MAX_AGE_SECS = float(
+    os.getenv("RESULT_CACHE_MAX_AGE_SECS", default=str(30 * 24 * 60 * 60))
+)
+"""これより古い結果は使わない"""
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", default=str(2 * 1024**3)))
+"""キャッシュの合計サイズの上限"""
+RESULT_CACHE_TRIM_INTERVAL_SECS = float(
+    os.getenv("RESULT_CACHE_TRIM_INTERVAL_SECS", default=str(60 * 60))
+)
+"""合計サイズを確認する間隔。確認にはキャッシュ全体の一覧を取得するため、ウォーム起動の間で間引く"""
+RESULT_CACHE_TOUCH_INTERVAL_SECS = float(
+    os.getenv("RESULT_CACHE_TOUCH_INTERVAL_SECS", default=str(24 * 60 * 60))
+)
+"""ヒットした結果の更新日時を進める間隔。ヒットのたびにコピーしないよう、これより古い場合だけ進める"""
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", default="watermarking")
+"""CloudWatchメトリクスの名前空間"""
+
+SUFFIXES = {"image/png": ".png", "image/jpeg": ".jpg", "image/webp": ".webp"}
+
+
+class ResultCache:
+    """合成結果のキャッシュ。ヒット・ミスの数を処理の段階ごとにCloudWatch EMFで出力する
+
+    get・put は画像ごとのワーカースレッドから並行して呼ばれるため、カウンターの更新はロックの下で行う
+
+    Args:
+        step (str): キャッシュを参照する処理の段階。メトリクスのディメンションに使う
+    """
+
+    def __init__(self, step: str):
+        self.registry = MetricsRegistry(
+            METRICS_NAMESPACE, {"Service": "watermarking", "Step": step}
+        )
+        self.hits = self.registry.counter("result_cache_hits")
+        self.misses = self.registry.counter("result_cache_misses")
+        self.hit_rate = self.registry.gauge("result_cache_hit_rate", "Percent")
+        self._emitted = (0, 0)
+        self._trimmed_at = 0.0
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(blob_cid: str, watermark_version: str) -> str:
+        return f"{RESULT_CACHE_PREFIX}/{blob_cid}/{watermark_version}-{PIPELINE_VERSION}"
+
+    def _count(self, counter: Counter) -> None:
+        with self._lock:
+            counter.inc()
+
+    def get(self, blob_cid: str, watermark_version: str) -> Optional[dict]:
+        """キャッシュした結果の情報を返す。無い場合や古い場合は None"""
+        key = self._key(blob_cid, watermark_version)
+        try:
+            head = head_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, key)
+        except Exception:
+            self._count(self.misses)
+            return None
+        age = (datetime.now(timezone.utc) - head["LastModified"]).total_seconds()
+        if age > RESULT_CACHE_MAX_AGE_SECS:
+            self._count(self.misses)
+            return None
+        self._count(self.hits)
+        if age > RESULT_CACHE_TOUCH_INTERVAL_SECS:
+            self._touch(key, head)
+        return {
+            "key": key,
+            "mime_type": head["ContentType"],
+            "size": head["ContentLength"],
+            "width": int(head["Metadata"]["width"]),
+            "height": int(head["Metadata"]["height"]),
+        }
+
+    def _touch(self, key: str, head: dict) -> None:
+        """結果を自身にコピーして更新日時を進め、古いものから削除される順番を後ろにする"""
+        try:
+            copy_object(
+                settings.WATERMARKED_IMAGE_BUCKET_NAME,
+                key,
+                key,
+                metadata=head["Metadata"],
+                content_type=head["ContentType"],
+            )
+        except Exception as e:
+            logger.warning(f"Failed to touch cached watermarked image {key}: `{str(e)}`")
+
+    def copy_to(self, cached: dict, path: str) -> dict:
+        """キャッシュした結果を path(拡張子は形式に合わせて置き換える)にコピーし、画像の情報を返す"""
+        out_path = PurePosixPath(path).with_suffix(SUFFIXES[cached["mime_type"]]).as_posix()
+        copy_object(settings.WATERMARKED_IMAGE_BUCKET_NAME, cached["key"], out_path)
+        logger.info(f"Copied cached watermarked image {cached['key']} to {out_path}")
+        return {
+            "path": out_path,
+            "mime_type": cached["mime_type"],
+            "size": cached["size"],
+            "width": cached["width"],
+            "height": cached["height"],
+        }
+
+    def put(self, blob_cid: str, watermark_version: str, out_image: dict) -> None:
+        """保存済みの結果 out_image をキャッシュにコピーする。失敗しても処理は続ける"""
+        key = self._key(blob_cid, watermark_version)
+        try:
+            copy_object(
+                settings.WATERMARKED_IMAGE_BUCKET_NAME,
+                out_image["path"],
+                key,
+                metadata={"width": str(out_image["width"]), "height": str(out_image["height"])},
+                content_type=out_image["mime_type"],
+            )
+            self._trim_periodically()
+        except Exception as e:
+            logger.warning(f"Failed to cache watermarked image {out_image['path']}: `{str(e)}`")
+
+    def _trim_periodically(self) -> None:
+        # 並行して put された場合に、複数のスレッドが同時に削除しないようにする
+        with self._lock:
+            if time.monotonic() - self._trimmed_at < RESULT_CACHE_TRIM_INTERVAL_SECS:
+                return
+            self._trimmed_at = time.monotonic()
+        self.trim(RESULT_CACHE_MAX_BYTES)
+
+    def trim(self, max_bytes: int) -> None:
+        """キャッシュの合計サイズが max_bytes を超えている場合、最後に参照されたのが古いものから削除する"""
+        objs = list(list_objects(settings.WATERMARKED_IMAGE_BUCKET_NAME, f"{RESULT_CACHE_PREFIX}/"))
+        total = sum(obj["Size"] for obj in objs)
+        evicted = []
+        for obj in sorted(objs, key=lambda o: o["LastModified"]):
+            if total <= max_bytes:
+                break
+            evicted.append(obj["Key"])
+            total -= obj["Size"]
+        if evicted:
+            delete_objects(settings.WATERMARKED_IMAGE_BUCKET_NAME, evicted)
+            logger.info(f"Evicted {len(evicted)} watermarked images from the result cache")
+
+    def emit_metrics(self) -> None:
+        """前回の出力からのヒット・ミスの数とヒット率を出力する"""
+        with self._lock:
+            hits = self.hits.total - self._emitted[0]
+            misses = self.misses.total - self._emitted[1]
+            self._emitted = (self.hits.total, self.misses.total)
+            self.hit_rate.set(hits * 100 / (hits + misses) if hits + misses else None)
+            emit_emf(self.registry)
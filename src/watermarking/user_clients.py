@@ -0,0 +1,97 @@
+"""投稿者ごとのBlueskyクライアントのキャッシュ
+
+post_watermarked と del_original_post は、同じ投稿者について数秒の間に userinfo の取得・JSONの解析・
+app_password の復号・ログインを繰り返す。Lambdaのウォーム起動の間で再利用できるよう、ログイン済みの
+クライアントをモジュールレベルで DID ごとに保持する。
+
+パスワードの変更や退会を反映するため、一定時間で破棄して userinfo から読み直す。同じ DID のログインが
+並行した場合は1回だけ行い、他は結果を待つ(PDSのレート制限はハンドルごとのため)。
+"""
+
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+from atproto import Client
+
+from lib.bs.client import get_client
+from lib.log import get_logger
+from watermarking.bucketio import get_author_app_passwd
+
+logger = get_logger(__name__)
+
+USER_CLIENT_TTL_SECS = float(os.getenv("USER_CLIENT_TTL_SECS", default=str(15 * 60)))
+"""ログイン済みのクライアントを使い回す時間"""
+USER_CLIENT_MAX_ENTRIES = int(os.getenv("USER_CLIENT_MAX_ENTRIES", default="32"))
+"""保持するクライアントの数の上限。超えた場合は参照が古いものから破棄する"""
+
+
+def login_as_author(author_did: str) -> Client:
+    """userinfo の app_password で投稿者としてログインする"""
+    return get_client(author_did, get_author_app_passwd(author_did))
+
+
+class UserClientCache:
+    """TTL付きのLRUで、同じ DID の並行したログインを1回にまとめる
+
+    Args:
+        ttl_secs (float): クライアントを使い回す時間
+        max_entries (int): 保持するクライアントの数の上限
+        login (Callable[[str], Client]): DID でログインしたクライアントを返す関数
+    """
+
+    def __init__(
+        self, ttl_secs: float, max_entries: int, login: Callable[[str], Client] = login_as_author
+    ):
+        self._ttl_secs = ttl_secs
+        self._max_entries = max_entries
+        self._login = login
+        self._entries: OrderedDict[str, Tuple[float, Client]] = OrderedDict()
+        self._inflight: Dict[str, Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def get(self, author_did: str) -> Client:
+        """投稿者としてログインしたクライアントを返す"""
+        with self._lock:
+            entry = self._entries.get(author_did)
+            if entry is not None and time.monotonic() - entry[0] < self._ttl_secs:
+                self._entries.move_to_end(author_did)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(author_did, None)
+            future = self._inflight.get(author_did)
+            leader = future is None
+            if leader:
+                self.misses += 1
+                future = self._inflight[author_did] = Future()
+        if not leader:
+            # 他のスレッドのログインを待つ
+            return future.result()
+
+        try:
+            client = self._login(author_did)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[author_did]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[author_did]
+            self._entries[author_did] = (time.monotonic(), client)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        future.set_result(client)
+        return client
+
+    def invalidate(self, author_did: str) -> None:
+        """クライアントを破棄する。セッションやパスワードが無効になった場合に呼ぶ"""
+        with self._lock:
+            self._entries.pop(author_did, None)
+
+
+user_clients = UserClientCache(USER_CLIENT_TTL_SECS, USER_CLIENT_MAX_ENTRIES)
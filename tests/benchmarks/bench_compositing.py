@@ -0,0 +1,161 @@
+"""Benchmark of the watermark compositing engine against the previous Pillow implementation
+
+Checks that `watermarking.compositing` returns the same pixels as the previous implementation
+for several input modes, then times both on a 4K input.
+
+Usage:
+    ```
+    PYTHONPATH=src python -m tests.benchmarks.bench_compositing
+    ```
+"""
+
+import time
+from typing import Callable, Dict
+
+from PIL import Image, ImageChops, ImageDraw
+
+from watermarking.compositing import (
+    blend_overlay,
+    decode_derivative,
+    encode_derivative,
+    make_derivatives,
+    make_overlay,
+    make_transparent_white,
+)
+
+SIZE_4K = (3840, 2160)
+REPEAT = 3
+
+
+def legacy_transparent_white(img: Image) -> Image:
+    """Previous `get_watermarks_img`, converting white to transparent pixel by pixel"""
+    img = img.convert("RGBA")
+    newData = []
+    for data in img.getdata():
+        if data[0] == 255 and data[1] == 255 and data[2] == 255:
+            newData.append((255, 255, 255, 0))
+        else:
+            newData.append(data)
+    img.putdata(newData)
+    return img
+
+
+def legacy_make_tile(target_width: int, target_height: int, tile_img: Image, wcnt: int) -> Image:
+    """Previous `make_tile`"""
+    expected_width = target_width // wcnt
+    expected_height = round(tile_img.height * expected_width / tile_img.width)
+    hcnt = round(target_height / expected_height)
+    resized_tile_img = tile_img.resize((expected_width, expected_height))
+    base_img = Image.new("RGBA", (target_width, target_height))
+    for i in range(wcnt):
+        for k in range(hcnt):
+            base_img.paste(
+                resized_tile_img, (i * resized_tile_img.size[0], k * resized_tile_img.size[1])
+            )
+    return base_img
+
+
+def legacy_add_watermark(input_img: Image, watermark_img: Image) -> Image:
+    """Previous `add_watermark`"""
+    tgt_img = input_img.convert("RGBA")
+    watermark_img = legacy_make_tile(tgt_img.width, tgt_img.height, watermark_img, 6)
+    _, _, _, alpha = watermark_img.split()
+    alpha.paste(Image.new("L", watermark_img.size, 128), mask=alpha)
+    watermark_mask = Image.composite(
+        Image.new("RGBA", watermark_img.size, (255, 255, 255, 0)), watermark_img, alpha
+    )
+    clear_img = Image.new("RGBA", tgt_img.size, (255, 255, 255, 200))
+    clear_img.paste(watermark_img, mask=watermark_mask)
+    return Image.blend(tgt_img, clear_img, 0.2)
+
+
+def add_watermark(input_img: Image, watermark_img: Image) -> Image:
+    overlay = make_overlay(input_img.width, input_img.height, watermark_img)
+    return blend_overlay(input_img, overlay)
+
+
+def make_input(size, mode: str) -> Image:
+    """Deterministic photo-like input: gradients and noise in each band"""
+    width, height = size
+    r = Image.linear_gradient("L").resize(size)
+    g = Image.radial_gradient("L").resize(size)
+    b = Image.effect_noise(size, 64)
+    img = Image.merge("RGB", (r, g, b))
+    if mode == "RGBA":
+        img.putalpha(Image.linear_gradient("L").rotate(90).resize(size))
+    elif mode != "RGB":
+        img = img.convert(mode)
+    return img
+
+
+def make_watermark(size=(600, 200)) -> Image:
+    """Deterministic watermark: white background, opaque text-like strokes and soft alpha edges"""
+    img = Image.new("RGBA", size, (255, 255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for i in range(12):
+        x = 20 + i * 45
+        draw.rectangle((x, 40, x + 25, 160), fill=(30 + i * 15, 60, 200 - i * 10, 255))
+        draw.ellipse((x, 10, x + 30, 40), fill=(255, 255, 255, 128 + i * 10))
+        draw.line((x, 180, x + 40, 120), fill=(0, 0, 0, 90 + i * 12), width=3)
+    return img
+
+
+def check_equivalence() -> None:
+    watermark = make_watermark()
+    keyed = make_transparent_white(watermark)
+    assert ImageChops.difference(keyed, legacy_transparent_white(watermark)).getbbox() is None
+    # The derivative stored at registration gives the same result
+    derivative = decode_derivative(encode_derivative(make_derivatives(watermark)[0]))
+    for mode in ("RGB", "RGBA", "L", "P", "CMYK"):
+        for size in ((1200, 800), (799, 1333), (64, 40)):
+            img = make_input(size, mode)
+            expected = legacy_add_watermark(img, keyed)
+            for watermark_img in (keyed, derivative):
+                actual = add_watermark(img, watermark_img)
+                diff = ImageChops.difference(actual, expected).getbbox()
+                assert diff is None, f"{mode} {size} {watermark_img.mode} differs in {diff}"
+
+
+def measure(func: Callable[[], Image]) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> Dict[str, float]:
+    check_equivalence()
+    print("Pixel equivalence: OK")
+
+    watermark = make_watermark((1024, 512))
+    keyed = make_transparent_white(watermark)
+    results = {}
+    for name, legacy, current in (
+        (
+            "transparent_white 1024x512",
+            lambda: legacy_transparent_white(watermark),
+            lambda: make_transparent_white(watermark),
+        ),
+        *(
+            (
+                f"add_watermark 4K {mode}",
+                lambda img=img: legacy_add_watermark(img, keyed),
+                lambda img=img: add_watermark(img, keyed),
+            )
+            for mode, img in ((m, make_input(SIZE_4K, m)) for m in ("RGB", "RGBA"))
+        ),
+    ):
+        legacy_secs = measure(legacy)
+        current_secs = measure(current)
+        results[name] = legacy_secs / current_secs
+        print(
+            f"{name}: legacy {legacy_secs * 1000:.1f} ms, "
+            f"current {current_secs * 1000:.1f} ms, x{legacy_secs / current_secs:.1f}"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Benchmark of serial and parallel processing of the images of a post
+
+Runs the per-image work of `apply_watermark.handler` (decode, composite, encode) for posts of
+1 to 4 images, serially and with `watermarking.parallel.map_ordered`, and compares wall time.
+S3 is replaced by a sleep of `--io-latency` seconds before and after each image.
+
+Usage:
+    ```
+    PYTHONPATH=src python -m tests.benchmarks.bench_parallel [--io-latency 0.05]
+    ```
+"""
+
+import argparse
+import os
+import time
+from io import BytesIO
+from typing import Dict, List
+
+from PIL import Image
+
+from tests.benchmarks.bench_compositing import make_input, make_watermark
+from watermarking.compositing import blend_overlay, make_overlay, make_transparent_white
+from watermarking.encoder import MAX_SIZE, encode_within, load_at_size, plan_output_size
+from watermarking.parallel import (
+    MemoryBudget,
+    estimate_image_bytes,
+    lambda_memory_bytes,
+    map_ordered,
+)
+
+SIZES = ((1200, 800), (2000, 1500), (1080, 1350), (3000, 2000))
+REPEAT = 3
+
+
+def make_post(count: int) -> List[bytes]:
+    """Deterministic JPEG sources of different sizes"""
+    sources = []
+    for size in SIZES[:count]:
+        with BytesIO() as out:
+            make_input(size, "RGB").save(out, format="JPEG", quality=90)
+            sources.append(out.getvalue())
+    return sources
+
+
+def watermark_image(
+    source: bytes, watermark_img: Image, budget: MemoryBudget, io_latency: float
+) -> bytes:
+    time.sleep(io_latency)
+    img = Image.open(BytesIO(source))
+    size = plan_output_size(*img.size, "image/jpeg", len(source), MAX_SIZE)
+    with budget.reserve(estimate_image_bytes(img.size, size)):
+        input_img = load_at_size(img, size)
+        overlay = make_overlay(input_img.width, input_img.height, watermark_img)
+        encoded = encode_within(blend_overlay(input_img, overlay), MAX_SIZE)
+    time.sleep(io_latency)
+    return encoded.data
+
+
+def measure(sources: List[bytes], watermark_img: Image, workers: int, io_latency: float):
+    best = float("inf")
+    for _ in range(REPEAT):
+        budget = MemoryBudget(int(lambda_memory_bytes() * 0.6))
+        started = time.perf_counter()
+        results = map_ordered(
+            lambda source: watermark_image(source, watermark_img, budget, io_latency),
+            sources,
+            workers,
+        )
+        best = min(best, time.perf_counter() - started)
+    return best, results
+
+
+def main() -> Dict[int, float]:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--io-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    watermark_img = make_transparent_white(make_watermark())
+    print(f"CPUs: {os.cpu_count()}, simulated S3 latency: {args.io_latency * 1000:.0f} ms")
+    speedups = {}
+    for count in range(1, len(SIZES) + 1):
+        sources = make_post(count)
+        serial_secs, serial = measure(sources, watermark_img, 1, args.io_latency)
+        parallel_secs, parallel = measure(sources, watermark_img, count, args.io_latency)
+        # The output order and bytes do not depend on the execution mode
+        assert serial == parallel
+        speedups[count] = serial_secs / parallel_secs
+        print(
+            f"{count} images: serial {serial_secs * 1000:.0f} ms, "
+            f"parallel {parallel_secs * 1000:.0f} ms, x{serial_secs / parallel_secs:.1f}"
+        )
+    return speedups
+
+
+if __name__ == "__main__":
+    main()
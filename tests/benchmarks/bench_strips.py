@@ -0,0 +1,116 @@
+"""Benchmark of the peak memory of full-frame and strip compositing
+
+Composites a large PNG with `make_overlay` + `blend_overlay` and with `composite_in_strips`
+under several strip budgets, each in a fresh process so that the maximum RSS is per mode.
+Pillow's pixel buffers are not traced by tracemalloc, so the maximum RSS is the figure to
+compare; the traced peak covers the Python side (source and encoded bytes).
+
+Usage:
+    ```
+    PYTHONPATH=src python -m tests.benchmarks.bench_strips [--size 7680x4320]
+    ```
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+from tests.benchmarks.bench_compositing import make_input, make_watermark
+from watermarking.compositing import (
+    blend_overlay,
+    composite_in_strips,
+    make_overlay,
+    make_transparent_white,
+    strip_height_for_budget,
+)
+from watermarking.profiling import measure_peak_memory
+
+MODES = ("full", "strips-64MiB", "strips-32MiB", "strips-8MiB")
+
+
+def _strip_budget(mode: str) -> int:
+    return int(mode.removeprefix("strips-").removesuffix("MiB")) * 1024 * 1024
+
+
+def run(mode: str, size) -> dict:
+    """Decode the source, composite it and encode the result in this process"""
+    with BytesIO() as out:
+        make_input(size, "RGB").save(out, format="PNG", compress_level=1)
+        source = out.getvalue()
+    watermark_img = make_transparent_white(make_watermark())
+    started = time.perf_counter()
+    with measure_peak_memory() as peak:
+        input_img = Image.open(BytesIO(source))
+        input_img.load()
+        if mode == "full":
+            overlay = make_overlay(input_img.width, input_img.height, watermark_img)
+            output = blend_overlay(input_img, overlay)
+            del overlay
+        else:
+            strip_height = strip_height_for_budget(input_img.width, _strip_budget(mode))
+            output = composite_in_strips(input_img, watermark_img, strip_height)
+        del input_img
+        with BytesIO() as out:
+            output.convert("RGB").save(out, format="JPEG", quality=75)
+    return {
+        "mode": mode,
+        "wall_secs": time.perf_counter() - started,
+        "traced_peak_bytes": peak.traced_peak_bytes,
+        "max_rss_increase_bytes": peak.max_rss_increase_bytes,
+    }
+
+
+def check_equivalence() -> None:
+    watermark_img = make_transparent_white(make_watermark())
+    img = make_input((1500, 1000), "RGB")
+    expected = blend_overlay(img, make_overlay(img.width, img.height, watermark_img))
+    for strip_height in (1, 37, 1000):
+        actual = composite_in_strips(img, watermark_img, strip_height)
+        assert ImageChops.difference(actual, expected).getbbox() is None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="7680x4320")
+    parser.add_argument("--mode", choices=MODES, help="run a single mode in this process")
+    args = parser.parse_args()
+    size = tuple(map(int, args.size.split("x")))
+
+    if args.mode:
+        print(json.dumps(run(args.mode, size)))
+        return
+
+    check_equivalence()
+    print("Pixel equivalence: OK")
+    for mode in MODES:
+        completed = subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "tests.benchmarks.bench_strips",
+                "--size",
+                args.size,
+                "--mode",
+                mode,
+            ],
+            capture_output=True,
+            check=True,
+            env=os.environ,
+            text=True,
+        )
+        result = json.loads(completed.stdout)
+        print(
+            f"{args.size} {mode}: {result['wall_secs'] * 1000:.0f} ms, "
+            f"max RSS +{result['max_rss_increase_bytes'] / 2**20:.0f} MiB, "
+            f"traced peak {result['traced_peak_bytes'] / 2**20:.1f} MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,296 @@
+"""Benchmark suite of the watermarking image path over deterministic synthetic corpora
+
+Generates sources (JPEG, PNG, RGBA PNG and palette PNG from 512px to 8K) and watermarks of
+several shapes, then measures each stage of `apply_watermark` separately and end to end:
+
+- `get_watermarks_img`: decode the registered PNG and make white transparent
+- `get_watermarks_img_derivative`: decode the preprocessed derivative stored at registration
+- `make_tile`: build the tiled overlay at the source size
+- `add_watermark`: `make_tile` and blend
+- `encode`: size-targeted encode of the composite (replaces `_resize`)
+- `end_to_end`: plan the output size, decode, composite and encode from the source bytes
+
+Each stage records wall time, CPU time and the tracemalloc peak, and each case records the
+maximum RSS of the worker process after the end-to-end run and after all stages, since
+Pillow's pixel buffers are invisible to tracemalloc. Every case runs in a fresh process so
+that the maximum RSS is its own. The stages call the
+pure modules directly: `apply_watermark` itself loads settings from Secrets Manager on import.
+
+Usage:
+    ```
+    # Write the results as a new baseline
+    PYTHONPATH=src python -m tests.benchmarks.bench_suite --output tests/benchmarks/baseline.json
+    # Compare with the baseline, exiting with 1 on regressions
+    PYTHONPATH=src python -m tests.benchmarks.bench_suite --compare tests/benchmarks/baseline.json
+    ```
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+import PIL
+from PIL import Image
+
+from tests.benchmarks.bench_compositing import make_input, make_watermark
+from watermarking.compositing import (
+    STRIP_LAYERS,
+    blend_overlay,
+    composite_in_strips,
+    decode_derivative,
+    encode_derivative,
+    make_derivatives,
+    make_overlay,
+    make_transparent_white,
+    strip_height_for_budget,
+)
+from watermarking.encoder import (
+    MAX_SIZE,
+    OUTPUT_FORMATS,
+    encode_within,
+    load_at_size,
+    plan_output_size,
+)
+from watermarking.parallel import STRIP_MEMORY_BYTES
+from watermarking.profiling import measure_peak_memory
+
+
+SIZES = {
+    "512": (512, 512),
+    "1080p": (1920, 1080),
+    "2048": (2048, 2048),
+    "4K": (3840, 2160),
+    "8K": (7680, 4320),
+}
+SOURCE_KINDS = {
+    # kind: (mode, format, mime type)
+    "jpeg": ("RGB", "JPEG", "image/jpeg"),
+    "png": ("RGB", "PNG", "image/png"),
+    "rgba": ("RGBA", "PNG", "image/png"),
+    "palette": ("P", "PNG", "image/png"),
+}
+WATERMARK_SHAPES = {"wide": (600, 200), "square": (400, 400), "tall": (200, 600), "small": (96, 32)}
+SHAPES_SIZE = "2048"
+"""Size at which every watermark shape is measured; other sizes use the wide watermark only"""
+
+WALL_TOLERANCE = 0.25
+"""Relative increase of wall time reported as a regression"""
+WALL_NOISE_FLOOR_MS = 5.0
+"""Increases of wall time below this are ignored as noise"""
+MEMORY_TOLERANCE = 0.15
+"""Relative increase of peak memory reported as a regression"""
+
+
+@dataclass(frozen=True)
+class Case:
+    size: str
+    kind: str
+    watermark: str
+
+    @property
+    def name(self) -> str:
+        return f"{self.size}-{self.kind}-{self.watermark}"
+
+
+@dataclass
+class StageResult:
+    wall_ms: float
+    cpu_ms: float
+    traced_peak_bytes: int
+
+
+def make_corpus(quick: bool = False) -> List[Case]:
+    sizes = [s for s in SIZES if not (quick and s == "8K")]
+    cases = [Case(size, kind, "wide") for size in sizes for kind in SOURCE_KINDS]
+    cases += [
+        Case(SHAPES_SIZE, kind, shape)
+        for kind in SOURCE_KINDS
+        for shape in WATERMARK_SHAPES
+        if shape != "wide"
+    ]
+    return cases
+
+
+def make_source(case: Case) -> bytes:
+    mode, fmt, _ = SOURCE_KINDS[case.kind]
+    with BytesIO() as out:
+        img = make_input(SIZES[case.size], mode)
+        if fmt == "JPEG":
+            img.save(out, format=fmt, quality=90)
+        else:
+            img.save(out, format=fmt, compress_level=1)
+        return out.getvalue()
+
+
+def _measure(func: Callable[[], object]) -> Tuple[object, StageResult]:
+    with measure_peak_memory() as peak:
+        wall_started, cpu_started = time.perf_counter(), time.process_time()
+        value = func()
+        wall_ms = (time.perf_counter() - wall_started) * 1000
+        cpu_ms = (time.process_time() - cpu_started) * 1000
+    return value, StageResult(wall_ms, cpu_ms, peak.traced_peak_bytes)
+
+
+def _composite(input_img: Image, watermark_img: Image) -> Image:
+    """`apply_watermark._composite`, switching to strips on large images"""
+    if input_img.width * input_img.height * 4 * STRIP_LAYERS > STRIP_MEMORY_BYTES:
+        strip_height = strip_height_for_budget(input_img.width, STRIP_MEMORY_BYTES)
+        return composite_in_strips(input_img, watermark_img, strip_height)
+    return blend_overlay(input_img, make_overlay(input_img.width, input_img.height, watermark_img))
+
+
+def _end_to_end(source: bytes, mime_type: str, watermark_img: Image):
+    img = Image.open(BytesIO(source))
+    size = plan_output_size(*img.size, mime_type, len(source), MAX_SIZE)
+    return encode_within(
+        _composite(load_at_size(img, size), watermark_img), MAX_SIZE, OUTPUT_FORMATS
+    )
+
+
+def _max_rss_bytes() -> int:
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def run_case(case: Case) -> dict:
+    """Measure every stage of a case in this process"""
+    source = make_source(case)
+    with BytesIO() as out:
+        make_watermark(WATERMARK_SHAPES[case.watermark]).save(out, format="PNG")
+        watermark_png = out.getvalue()
+    derivative_png = encode_derivative(make_derivatives(Image.open(BytesIO(watermark_png)))[0])
+    _, _, mime_type = SOURCE_KINDS[case.kind]
+    stages: Dict[str, StageResult] = {}
+    watermark_img, stages["get_watermarks_img"] = _measure(
+        lambda: make_transparent_white(Image.open(BytesIO(watermark_png)))
+    )
+    # End to end first, so that the maximum RSS so far is that of the production path
+    end_to_end, stages["end_to_end"] = _measure(
+        lambda: _end_to_end(source, mime_type, watermark_img)
+    )
+    end_to_end_max_rss = _max_rss_bytes()
+
+    input_img = Image.open(BytesIO(source))
+    input_img.load()
+    _, stages["get_watermarks_img_derivative"] = _measure(
+        lambda: decode_derivative(BytesIO(derivative_png.getvalue()))
+    )
+    _, stages["make_tile"] = _measure(
+        lambda: make_overlay(input_img.width, input_img.height, watermark_img)
+    )
+    watermarked_img, stages["add_watermark"] = _measure(
+        lambda: blend_overlay(
+            input_img, make_overlay(input_img.width, input_img.height, watermark_img)
+        )
+    )
+    encoded, stages["encode"] = _measure(
+        lambda: encode_within(watermarked_img, MAX_SIZE, OUTPUT_FORMATS)
+    )
+    return {
+        "case": asdict(case),
+        "source_bytes": len(source),
+        "stages": {name: asdict(result) for name, result in stages.items()},
+        "encode_attempts": encoded.attempts,
+        "encoded_format": encoded.params.format,
+        "encoded_bytes": len(encoded.data),
+        "end_to_end_attempts": end_to_end.attempts,
+        "end_to_end_size": [end_to_end.width, end_to_end.height],
+        "end_to_end_max_rss_bytes": end_to_end_max_rss,
+        "max_rss_bytes": _max_rss_bytes(),
+    }
+
+
+def run(cases: List[Case]) -> dict:
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        # A fresh process per case, so that the maximum RSS is that of the case
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case).result()
+        results[case.name] = result
+        end_to_end = result["stages"]["end_to_end"]
+        print(
+            f"{case.name}: end to end {end_to_end['wall_ms']:.0f} ms "
+            f"(cpu {end_to_end['cpu_ms']:.0f} ms), "
+            f"encode {result['encode_attempts']} attempts {result['encoded_format']}, "
+            f"max RSS {result['end_to_end_max_rss_bytes'] / 2**20:.0f} MiB",
+            flush=True,
+        )
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict) -> List[str]:
+    """Regressions of the current results against the baseline"""
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        for stage, values in result["stages"].items():
+            base_values = base["stages"].get(stage)
+            if base_values is None:
+                continue
+            wall, base_wall = values["wall_ms"], base_values["wall_ms"]
+            if wall > base_wall * (1 + WALL_TOLERANCE) and wall - base_wall > WALL_NOISE_FLOOR_MS:
+                regressions.append(f"{name} {stage}: wall {base_wall:.1f} -> {wall:.1f} ms")
+        for key in ("end_to_end_max_rss_bytes", "max_rss_bytes"):
+            if result[key] > base[key] * (1 + MEMORY_TOLERANCE):
+                regressions.append(
+                    f"{name}: {key} {base[key] / 2**20:.0f} -> {result[key] / 2**20:.0f} MiB"
+                )
+        for key in ("encode_attempts", "end_to_end_attempts"):
+            if result[key] > base[key]:
+                regressions.append(f"{name}: {key} {base[key]} -> {result[key]}")
+    if current["environment"] != baseline["environment"]:
+        print(
+            f"Warning: the baseline was measured on {baseline['environment']}, "
+            f"now on {current['environment']}"
+        )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--quick", action="store_true", help="skip the 8K sources")
+    parser.add_argument("--filter", default="", help="only run cases whose name contains this")
+    args = parser.parse_args(argv)
+
+    cases = [case for case in make_corpus(args.quick) if args.filter in case.name]
+    current = run(cases)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(current, json.load(f))
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
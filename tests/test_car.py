@@ -0,0 +1,128 @@
+import hashlib
+import unittest
+
+import libipld
+from atproto.exceptions import InvalidCARFile
+
+from lib.bs.car import LazyCAR
+
+
+def _cid(data: bytes) -> bytes:
+    """Binary CIDv1 (dag-cbor, sha2-256) of `data`"""
+    return bytes([0x01, 0x71, 0x12, 0x20]) + hashlib.sha256(data).digest()
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if not n:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _car(blocks: list) -> bytes:
+    header = libipld.encode_dag_cbor({"version": 1, "roots": [blocks[0][0]]})
+    out = _varint(len(header)) + header
+    for cid, data in blocks:
+        out += _varint(len(cid) + len(data)) + cid + data
+    return out
+
+
+def _commit_blocks() -> list:
+    """Blocks shaped like a firehose commit: the commit, MST nodes and records"""
+    post = {
+        "$type": "app.bsky.feed.post",
+        "text": "hello " * 40,
+        "createdAt": "2025-01-01T00:00:00.000Z",
+        "embed": {
+            "$type": "app.bsky.embed.images",
+            "images": [
+                {
+                    "alt": "",
+                    "image": {
+                        "$type": "blob",
+                        "ref": _cid(b"image"),
+                        "mimeType": "image/jpeg",
+                        "size": 123456,
+                    },
+                }
+            ],
+        },
+    }
+    follow = {
+        "$type": "app.bsky.graph.follow",
+        "subject": "did:plc:subject",
+        "createdAt": "2025-01-01T00:00:00.000Z",
+    }
+    records = [libipld.encode_dag_cbor(post), libipld.encode_dag_cbor(follow)]
+    mst = [
+        libipld.encode_dag_cbor(
+            {
+                "l": None,
+                "e": [{"p": 0, "k": b"app.bsky.feed.post/%d" % i, "v": _cid(b"%d" % i), "t": None}],
+            }
+        )
+        for i in range(3)
+    ]
+    commit = libipld.encode_dag_cbor(
+        {"did": "did:plc:repo", "version": 3, "data": _cid(mst[0]), "rev": "x"}
+    )
+    return [(_cid(data), data) for data in [commit, *mst, *records]]
+
+
+class TestLazyCAR(unittest.TestCase):
+    def test_blocks_match_libipld(self):
+        data = _car(_commit_blocks())
+        _, expected = libipld.decode_car(data)
+        car = LazyCAR(data)
+        self.assertEqual(len(car), len(expected))
+        for cid, block in expected.items():
+            self.assertIn(cid, car)
+            self.assertEqual(car.get(cid), block)
+
+    def test_large_block_with_multibyte_length(self):
+        record = libipld.encode_dag_cbor({"text": "x" * 100_000})
+        data = _car([(_cid(record), record)])
+        _, expected = libipld.decode_car(data)
+        self.assertEqual(LazyCAR(data).get(_cid(record)), expected[_cid(record)])
+
+    def test_missing_cid(self):
+        car = LazyCAR(_car(_commit_blocks()))
+        self.assertNotIn(_cid(b"missing"), car)
+        self.assertIsNone(car.get(_cid(b"missing")))
+
+    def test_header_only(self):
+        header = libipld.encode_dag_cbor({"version": 1, "roots": []})
+        self.assertEqual(len(LazyCAR(_varint(len(header)) + header)), 0)
+
+    def test_truncated(self):
+        data = _car(_commit_blocks())
+        for length in (0, 1, len(data) - 1, len(data) - 40):
+            with self.subTest(length=length):
+                with self.assertRaises(InvalidCARFile):
+                    LazyCAR(data[:length])
+
+    def test_truncated_varint(self):
+        with self.assertRaises(InvalidCARFile):
+            LazyCAR(b"\x80")
+
+    def test_block_length_exceeds_data(self):
+        data = _car(_commit_blocks())
+        with self.assertRaises(InvalidCARFile):
+            LazyCAR(data + _varint(1000) + b"\x00")
+
+    def test_cid_exceeds_block(self):
+        record = libipld.encode_dag_cbor({"a": 1})
+        header = libipld.encode_dag_cbor({"version": 1, "roots": [_cid(record)]})
+        cid = _cid(record)
+        # The block length covers only half of the CID
+        data = _varint(len(header)) + header + _varint(len(cid) // 2) + cid + record
+        with self.assertRaises(InvalidCARFile):
+            LazyCAR(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import random
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+from watermarking import encoder
+from watermarking.encoder import (
+    GOOD_ENOUGH_RATIO,
+    MAX_ATTEMPTS,
+    EncodeParams,
+    ImageTooLargeError,
+    encode_within,
+)
+
+
+def _noise(width: int, height: int, seed: int = 0) -> Image.Image:
+    """圧縮の効かない画像"""
+    return Image.frombytes(
+        "RGB", (width, height), random.Random(seed).randbytes(width * height * 3)
+    )
+
+
+def _flat(width: int, height: int) -> Image.Image:
+    return Image.new("RGB", (width, height), (200, 100, 50))
+
+
+class TestEncodeWithin(unittest.TestCase):
+    def assertDecodable(self, encoded):
+        with Image.open(BytesIO(encoded.data)) as img:
+            self.assertEqual(img.format, encoded.params.format)
+            self.assertEqual(img.size, (encoded.width, encoded.height))
+
+    def test_lossless_when_it_fits(self):
+        encoded = encode_within(_flat(256, 256), 1_000_000)
+        self.assertEqual(encoded.params, EncodeParams("PNG"))
+        self.assertEqual(encoded.attempts, 1)
+        self.assertDecodable(encoded)
+
+    def test_lossy_quality(self):
+        img = _noise(256, 256)
+        max_size = 60_000
+        encoded = encode_within(img, max_size)
+        self.assertEqual(encoded.params.format, "JPEG")
+        self.assertEqual(encoded.params.scale, 1.0)
+        self.assertLess(len(encoded.data), max_size)
+        self.assertDecodable(encoded)
+
+    def test_scale_search(self):
+        img = _noise(1024, 1024)
+        max_size = 200_000
+        encoded = encode_within(img, max_size)
+        self.assertLess(encoded.params.scale, 1.0)
+        self.assertLess(len(encoded.data), max_size)
+        self.assertGreaterEqual(len(encoded.data), max_size * GOOD_ENOUGH_RATIO)
+        self.assertLessEqual(encoded.attempts, MAX_ATTEMPTS)
+        self.assertDecodable(encoded)
+
+    def test_good_enough_hint_is_used_as_is(self):
+        img = _noise(256, 256)
+        max_size = 60_000
+        first = encode_within(img, max_size)
+        encoded = encode_within(_noise(256, 256, seed=1), max_size, hint=first.params)
+        self.assertEqual(encoded.params, first.params)
+        self.assertEqual(encoded.attempts, 1)
+
+    def test_hint_in_unavailable_format_is_ignored(self):
+        encoded = encode_within(
+            _flat(64, 64), 1_000_000, formats=("PNG",), hint=EncodeParams("WEBP", 90)
+        )
+        self.assertEqual(encoded.params, EncodeParams("PNG"))
+        self.assertEqual(encoded.attempts, 1)
+
+    def test_too_large_even_at_one_pixel(self):
+        with self.assertRaises(ImageTooLargeError):
+            encode_within(_noise(64, 64), 10)
+
+    def test_scale_search_does_not_oscillate(self):
+        # サイズが画素数に比例しない画像:
+        # 一定の画素数を超えると急に上限の2倍になり、それ以下では上限の GOOD_ENOUGH_RATIO 未満に留まる。
+        # 補正だけでは、小さすぎる倍率と元の解像度の間を行き来する
+        img = _flat(1024, 1024)
+        pixels = img.width * img.height
+        max_size = 100_000
+        threshold = 0.8 * pixels
+
+        def save(prepared: Image.Image, params: EncodeParams) -> bytes:
+            prepared_pixels = prepared.width * prepared.height
+            if prepared.size == (512, 512):
+                # 予測の見本。全体では上限を大きく超える予測にする
+                return bytes(4 * max_size)
+            if prepared_pixels > threshold:
+                return bytes(2 * max_size)
+            return bytes(int(0.3 * max_size * prepared_pixels / threshold))
+
+        with mock.patch.object(encoder, "_save", save):
+            encoded = encode_within(img, max_size, formats=("JPEG",))
+        self.assertLess(len(encoded.data), max_size)
+        self.assertLessEqual(encoded.attempts, MAX_ATTEMPTS)
+        # 収まる最大の倍率は sqrt(0.8) ≒ 0.894
+        self.assertGreater(encoded.params.scale, 0.85)
+        self.assertLessEqual(encoded.width * encoded.height, threshold)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import hashlib
+import unittest
+
+import libipld
+
+from firehose.follows import FollowSet, FollowSnapshot
+
+BOT_DID = "did:plc:bot"
+LIST_OWNER_DID = "did:plc:owner"
+WHITE_LIST = f"at://{LIST_OWNER_DID}/app.bsky.graph.list/white"
+IGNORE_LIST = f"at://{LIST_OWNER_DID}/app.bsky.graph.list/ignore"
+
+
+def _cid(data: bytes) -> bytes:
+    return bytes([0x01, 0x71, 0x12, 0x20]) + hashlib.sha256(data).digest()
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if not n:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _commit(repo: str, creates: dict = {}, deletes: tuple = ()) -> dict:
+    """`#commit` フレームのbody。creates はレコードのパスからレコードへの対応"""
+    blocks = b""
+    ops = []
+    for path, record in creates.items():
+        data = libipld.encode_dag_cbor(record)
+        cid = _cid(data)
+        blocks += _varint(len(cid) + len(data)) + cid + data
+        ops.append({"action": "create", "path": path, "cid": cid})
+    for path in deletes:
+        ops.append({"action": "delete", "path": path, "cid": None})
+    header = libipld.encode_dag_cbor({"version": 1, "roots": []})
+    return {"repo": repo, "ops": ops, "blocks": _varint(len(header)) + header + blocks}
+
+
+def _follow(rkey: str, subject: str) -> dict:
+    return _commit(
+        BOT_DID,
+        creates={
+            f"app.bsky.graph.follow/{rkey}": {
+                "$type": "app.bsky.graph.follow",
+                "subject": subject,
+                "createdAt": "2025-01-01T00:00:00.000Z",
+            }
+        },
+    )
+
+
+def _unfollow(rkey: str) -> dict:
+    return _commit(BOT_DID, deletes=(f"app.bsky.graph.follow/{rkey}",))
+
+
+def _follow_uri(rkey: str) -> str:
+    return f"at://{BOT_DID}/app.bsky.graph.follow/{rkey}"
+
+
+def _snapshot(follows: dict = {}, whitelist: dict = {}, ignores: dict = {}) -> FollowSnapshot:
+    return FollowSnapshot(
+        bot_did=BOT_DID, follows=dict(follows), whitelist=dict(whitelist), ignores=dict(ignores)
+    )
+
+
+class TestFollowSet(unittest.TestCase):
+    def test_follow_and_unfollow(self):
+        follow_set = FollowSet(_snapshot(), None, IGNORE_LIST)
+        self.assertTrue(follow_set.apply_commit(_follow("a", "did:plc:a")))
+        self.assertEqual(follow_set.current, {"did:plc:a"})
+        self.assertTrue(follow_set.apply_commit(_unfollow("a")))
+        self.assertEqual(follow_set.current, set())
+
+    def test_ignore_list(self):
+        follow_set = FollowSet(_snapshot({_follow_uri("a"): "did:plc:a"}), None, IGNORE_LIST)
+        listitem = {
+            "$type": "app.bsky.graph.listitem",
+            "subject": "did:plc:a",
+            "list": IGNORE_LIST,
+            "createdAt": "2025-01-01T00:00:00.000Z",
+        }
+        self.assertTrue(
+            follow_set.apply_commit(
+                _commit(LIST_OWNER_DID, creates={"app.bsky.graph.listitem/i": listitem})
+            )
+        )
+        self.assertEqual(follow_set.current, set())
+
+    def test_unwatched_repo(self):
+        follow_set = FollowSet(_snapshot(), None, None)
+        commit = _follow("a", "did:plc:a")
+        commit["repo"] = "did:plc:other"
+        self.assertFalse(follow_set.apply_commit(commit))
+        self.assertEqual(follow_set.current, set())
+
+    def test_follow_during_resync(self):
+        follow_set = FollowSet(_snapshot(), None, None)
+        follow_set.begin_resync()
+        follow_set.apply_commit(_follow("a", "did:plc:a"))
+        # 一覧は follow より前に取得されている
+        follow_set.finish_resync(_snapshot({_follow_uri("b"): "did:plc:b"}))
+        self.assertEqual(follow_set.current, {"did:plc:a", "did:plc:b"})
+
+    def test_unfollow_during_resync(self):
+        follow_set = FollowSet(_snapshot({_follow_uri("a"): "did:plc:a"}), None, None)
+        follow_set.begin_resync()
+        follow_set.apply_commit(_unfollow("a"))
+        self.assertEqual(follow_set.current, set())
+        # 一覧は unfollow より前に取得されている
+        follow_set.finish_resync(_snapshot({_follow_uri("a"): "did:plc:a"}))
+        self.assertEqual(follow_set.current, set())
+
+    def test_unfollow_unknown_to_current_set_during_resync(self):
+        # 取りこぼした follow は現在の一覧に無いが、再取得した一覧には含まれる
+        follow_set = FollowSet(_snapshot(), None, None)
+        follow_set.begin_resync()
+        self.assertFalse(follow_set.apply_commit(_unfollow("a")))
+        follow_set.finish_resync(_snapshot({_follow_uri("a"): "did:plc:a"}))
+        self.assertEqual(follow_set.current, set())
+
+    def test_follow_and_unfollow_during_resync(self):
+        follow_set = FollowSet(_snapshot(), None, None)
+        follow_set.begin_resync()
+        follow_set.apply_commit(_follow("a", "did:plc:a"))
+        follow_set.apply_commit(_unfollow("a"))
+        follow_set.finish_resync(_snapshot())
+        self.assertEqual(follow_set.current, set())
+
+    def test_stale_snapshot_overwrites_without_resync_ops(self):
+        follow_set = FollowSet(_snapshot({_follow_uri("a"): "did:plc:a"}), None, None)
+        follow_set.begin_resync()
+        follow_set.finish_resync(_snapshot({_follow_uri("b"): "did:plc:b"}))
+        self.assertEqual(follow_set.current, {"did:plc:b"})
+
+    def test_journal_cleared_after_resync(self):
+        follow_set = FollowSet(_snapshot(), None, None)
+        follow_set.begin_resync()
+        follow_set.apply_commit(_follow("a", "did:plc:a"))
+        follow_set.finish_resync(_snapshot())
+        follow_set.begin_resync()
+        # 前回の再取得中の操作は適用し直さない
+        follow_set.finish_resync(_snapshot())
+        self.assertEqual(follow_set.current, set())
+
+    def test_cancel_resync(self):
+        follow_set = FollowSet(_snapshot(), None, None)
+        follow_set.begin_resync()
+        follow_set.apply_commit(_follow("a", "did:plc:a"))
+        follow_set.cancel_resync()
+        self.assertEqual(follow_set.current, {"did:plc:a"})
+        self.assertIsNone(follow_set._journal)
+
+
+if __name__ == "__main__":
+    unittest.main()
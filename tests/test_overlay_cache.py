@@ -0,0 +1,116 @@
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+from watermarking.overlay_cache import OverlayCache
+
+DID = "did:plc:test"
+VERSION = "v1"
+
+
+def _overlay(width: int = 10, height: int = 10, color=(0, 0, 0, 0)) -> Image.Image:
+    return Image.new("RGBA", (width, height), color)
+
+
+class TestOverlayCache(unittest.TestCase):
+    def test_put_same_key_twice(self):
+        cache = OverlayCache(max_bytes=1024)
+        cache.put(DID, VERSION, _overlay())
+        cache.put(DID, VERSION, _overlay())
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(cache._bytes, 10 * 10 * 4)
+
+    def test_put_same_key_repeatedly_keeps_cache_usable(self):
+        cache = OverlayCache(max_bytes=1024)
+        for _ in range(10):
+            cache.put(DID, VERSION, _overlay())
+        self.assertEqual(cache._bytes, 10 * 10 * 4)
+        self.assertIsNotNone(cache.get(DID, VERSION, (10, 10)))
+
+    def test_get_or_create_builds_once_when_concurrent(self):
+        cache = OverlayCache(max_bytes=1024)
+        workers = 4
+        barrier = threading.Barrier(workers)
+        created = []
+
+        def create():
+            created.append(1)
+            return _overlay()
+
+        def get(_):
+            barrier.wait()
+            return cache.get_or_create(DID, VERSION, (10, 10), create)
+
+        with ThreadPoolExecutor(workers) as executor:
+            overlays = list(executor.map(get, range(workers)))
+        self.assertEqual(len(created), 1)
+        self.assertTrue(all(overlay is overlays[0] for overlay in overlays))
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(cache._bytes, 10 * 10 * 4)
+
+    def test_get_or_create_propagates_error(self):
+        cache = OverlayCache(max_bytes=1024)
+
+        def create():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            cache.get_or_create(DID, VERSION, (10, 10), create)
+        self.assertEqual(cache._inflight, {})
+        self.assertEqual(cache.get_or_create(DID, VERSION, (10, 10), _overlay).size, (10, 10))
+
+    def test_spill_and_load(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = OverlayCache(max_bytes=400, spill_dir=spill_dir, spill_max_bytes=4096)
+            first = _overlay(color=(255, 0, 0, 128))
+            cache.put(DID, VERSION, first)
+            # 2枚目で1枚目がメモリから溢れる
+            cache.put(DID, VERSION, _overlay(10, 20))
+            self.assertEqual(len(list(Path(spill_dir).glob("*/*.rgba"))), 1)
+            loaded = cache.get(DID, VERSION, (10, 10))
+            self.assertEqual(loaded.tobytes(), first.tobytes())
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_get_or_create_loads_spilled(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = OverlayCache(max_bytes=400, spill_dir=spill_dir, spill_max_bytes=4096)
+            cache.put(DID, VERSION, _overlay(color=(255, 0, 0, 128)))
+            cache.put(DID, VERSION, _overlay(10, 20))
+
+            def create():
+                raise AssertionError("spilled overlay was created again")
+
+            overlay = cache.get_or_create(DID, VERSION, (10, 10), create)
+            self.assertEqual(overlay.getpixel((0, 0)), (255, 0, 0, 128))
+            self.assertEqual(cache.hits, 1)
+
+    def test_spill_io_outside_lock(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            cache = OverlayCache(max_bytes=400, spill_dir=spill_dir, spill_max_bytes=4096)
+            spill, load_spilled = cache._spill, cache._load_spilled
+            locked = []
+
+            def checked(method):
+                def call(*args):
+                    locked.append(cache._lock.locked())
+                    return method(*args)
+
+                return call
+
+            cache._spill = checked(spill)
+            cache._load_spilled = checked(load_spilled)
+            cache.put(DID, VERSION, _overlay())
+            cache.put(DID, VERSION, _overlay(10, 20))
+            cache.get(DID, VERSION, (10, 10))
+            cache.get_or_create(DID, VERSION, (10, 20), lambda: _overlay(10, 20))
+            cache.get_or_create(DID, VERSION, (20, 20), lambda: _overlay(20, 20))
+            self.assertGreaterEqual(len(locked), 4)
+            self.assertFalse(any(locked))
+
+
+if __name__ == "__main__":
+    unittest.main()
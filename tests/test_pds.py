@@ -0,0 +1,162 @@
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from atproto import exceptions
+from atproto_client.models.common import XrpcError
+from atproto_client.request import Response
+
+from lib.bs.pds import PdsResolver, UnresolvableDidError
+from lib.store import FileStringStore
+
+DID = "did:plc:author"
+CID = "bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy"
+OLD_PDS = "https://old.pds.example"
+NEW_PDS = "https://new.pds.example"
+
+
+def _xrpc_error(status_code: int, error: str) -> exceptions.RequestErrorBase:
+    response = Response(
+        success=False,
+        status_code=status_code,
+        content=XrpcError(error=error, message=error),
+        headers={},
+    )
+    return exceptions.BadRequestError(response)
+
+
+class FakeIdResolver:
+    """DID resolver returning the endpoints in `endpoints` in turn, the last one repeatedly"""
+
+    def __init__(self, *endpoints: str):
+        self.endpoints = list(endpoints)
+        self.resolved = 0
+        self.did = self
+
+    def resolve(self, did: str):
+        endpoint = self.endpoints[min(self.resolved, len(self.endpoints) - 1)]
+        self.resolved += 1
+        return SimpleNamespace(get_pds_endpoint=lambda: endpoint)
+
+
+class TestPdsResolver(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch("lib.bs.pds.logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _resolver(self, id_resolver: FakeIdResolver, errors: dict, **kwargs) -> PdsResolver:
+        """Resolver whose PDS at each endpoint raises the error in `errors`, or returns the blob"""
+        resolver = PdsResolver(3600, 60, **kwargs)
+        resolver._id_resolver = id_resolver
+        self.fetched = []
+
+        def get_blob(endpoint: str, params, **kwargs) -> bytes:
+            self.fetched.append(endpoint)
+            if endpoint in errors:
+                raise errors[endpoint]
+            return b"blob from " + endpoint.encode()
+
+        def get_client(did: str, refresh: bool = False):
+            endpoint = resolver.resolve(did, refresh)
+            sync = SimpleNamespace(get_blob=lambda params, **kwargs: get_blob(endpoint, params))
+            return SimpleNamespace(com=SimpleNamespace(atproto=SimpleNamespace(sync=sync)))
+
+        resolver.get_client = get_client
+        return resolver
+
+    def _age(self, resolver: PdsResolver, secs: float) -> None:
+        resolved_at, endpoint = resolver._entries[DID]
+        resolver._entries[DID] = (resolved_at - secs, endpoint)
+
+    def test_fetch(self):
+        id_resolver = FakeIdResolver(OLD_PDS)
+        resolver = self._resolver(id_resolver, {})
+        self.assertEqual(resolver.get_blob(DID, CID), b"blob from " + OLD_PDS.encode())
+        self.assertEqual(resolver.get_blob(DID, CID), b"blob from " + OLD_PDS.encode())
+        self.assertEqual(id_resolver.resolved, 1)
+
+    def test_connection_error_re_resolves_moved_pds(self):
+        id_resolver = FakeIdResolver(OLD_PDS, NEW_PDS)
+        resolver = self._resolver(id_resolver, {OLD_PDS: exceptions.NetworkError()})
+        resolver.resolve(DID)
+        self._age(resolver, 120)
+        self.assertEqual(resolver.get_blob(DID, CID), b"blob from " + NEW_PDS.encode())
+        self.assertEqual(self.fetched, [OLD_PDS, NEW_PDS])
+
+    def test_repo_left_pds_re_resolves(self):
+        for error in ("RepoNotFound", "RepoDeactivated"):
+            with self.subTest(error):
+                id_resolver = FakeIdResolver(OLD_PDS, NEW_PDS)
+                resolver = self._resolver(id_resolver, {OLD_PDS: _xrpc_error(400, error)})
+                resolver.resolve(DID)
+                self._age(resolver, 120)
+                self.assertEqual(resolver.get_blob(DID, CID), b"blob from " + NEW_PDS.encode())
+
+    def test_other_errors_do_not_re_resolve(self):
+        errors = (
+            _xrpc_error(400, "BlobNotFound"),
+            _xrpc_error(400, "InvalidRequest"),
+            exceptions.RequestException(
+                Response(success=False, status_code=500, content=b"", headers={})
+            ),
+        )
+        for error in errors:
+            with self.subTest(error):
+                id_resolver = FakeIdResolver(OLD_PDS, NEW_PDS)
+                resolver = self._resolver(id_resolver, {OLD_PDS: error})
+                resolver.resolve(DID)
+                self._age(resolver, 120)
+                with self.assertRaises(type(error)):
+                    resolver.get_blob(DID, CID)
+                self.assertEqual(id_resolver.resolved, 1)
+
+    def test_not_moved_raises(self):
+        id_resolver = FakeIdResolver(OLD_PDS)
+        resolver = self._resolver(id_resolver, {OLD_PDS: exceptions.NetworkError()})
+        resolver.resolve(DID)
+        self._age(resolver, 120)
+        with self.assertRaises(exceptions.NetworkError):
+            resolver.get_blob(DID, CID)
+        self.assertEqual(id_resolver.resolved, 2)
+        self.assertEqual(self.fetched, [OLD_PDS])
+
+    def test_re_resolve_is_rate_limited(self):
+        id_resolver = FakeIdResolver(OLD_PDS)
+        resolver = self._resolver(
+            id_resolver, {OLD_PDS: exceptions.NetworkError()}, refresh_interval_secs=60
+        )
+        resolver.resolve(DID)
+        self._age(resolver, 120)
+        for _ in range(5):
+            with self.assertRaises(exceptions.NetworkError):
+                resolver.get_blob(DID, CID)
+        # resolved once on the first failure, then the entry is too recent to resolve again
+        self.assertEqual(id_resolver.resolved, 2)
+        self._age(resolver, 60)
+        with self.assertRaises(exceptions.NetworkError):
+            resolver.get_blob(DID, CID)
+        self.assertEqual(id_resolver.resolved, 3)
+
+    def test_unresolvable_did_is_cached(self):
+        id_resolver = FakeIdResolver(None)
+        resolver = self._resolver(id_resolver, {})
+        for _ in range(2):
+            with self.assertRaises(UnresolvableDidError):
+                resolver.get_blob(DID, CID)
+        self.assertEqual(id_resolver.resolved, 1)
+
+    def test_persisted_endpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self._resolver(FakeIdResolver(OLD_PDS), {}, backend=FileStringStore(directory)).resolve(
+                DID
+            )
+            id_resolver = FakeIdResolver(NEW_PDS)
+            resolver = self._resolver(id_resolver, {}, backend=FileStringStore(directory))
+            self.assertEqual(resolver.resolve(DID), OLD_PDS)
+            self.assertEqual(id_resolver.resolved, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
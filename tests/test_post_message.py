@@ -0,0 +1,131 @@
+import json
+import unittest
+
+from atproto import models
+
+from lib.bs.post_message import POST_MESSAGE_VERSION, decode_post_message, encode_post_message
+
+CID = "bafyreiclp443lavogvhj3d2ob2cxbfuscni2k5jk7bebjzg7khl3esabwq"
+IMAGE_CID = "bafkreibme22gw2h7y2h7tg2fhqotaqjucnbc24deqo72b6mkl2egezxhvy"
+URI = "at://did:plc:author/app.bsky.feed.post/3kabc"
+AUTHOR_DID = "did:plc:author"
+CREATED_AT = "2025-01-01T00:00:00.000Z"
+
+
+def _image(**kwargs) -> dict:
+    return {
+        "$type": "app.bsky.embed.images#image",
+        "image": {
+            "$type": "blob",
+            "ref": {"$link": IMAGE_CID},
+            "mimeType": "image/jpeg",
+            "size": 123456,
+        },
+        **kwargs,
+    }
+
+
+def _record(**kwargs) -> models.AppBskyFeedPost.Record:
+    record = {
+        "$type": "app.bsky.feed.post",
+        "text": "hello",
+        "createdAt": CREATED_AT,
+        "embed": {"$type": "app.bsky.embed.images", "images": [_image(alt="")]},
+        **kwargs,
+    }
+    return models.get_or_create(record, models.AppBskyFeedPost.Record, strict=False)
+
+
+def _round_trip(record: models.AppBskyFeedPost.Record) -> dict:
+    """Encode the message and pass it through JSON, as it is sent over SQS"""
+    return json.loads(json.dumps(encode_post_message(CID, URI, AUTHOR_DID, record)))
+
+
+class TestPostMessage(unittest.TestCase):
+    def test_v1_message(self):
+        message = {"cid": CID, "uri": URI, "author_did": AUTHOR_DID, "created_at": CREATED_AT}
+        self.assertIsNone(decode_post_message(message))
+
+    def test_v2_message(self):
+        message = {
+            "v": 2,
+            "cid": CID,
+            "uri": URI,
+            "author_did": AUTHOR_DID,
+            "created_at": CREATED_AT,
+            "text": "hello",
+            "images": [
+                {
+                    "cid": IMAGE_CID,
+                    "mime_type": "image/png",
+                    "size": 1000,
+                    "alt": "a cat",
+                    "aspect_ratio": [800, 600],
+                }
+            ],
+        }
+        post = decode_post_message(message)
+        self.assertEqual(post.uri, URI)
+        self.assertEqual(post.cid, CID)
+        self.assertEqual(post.value.text, "hello")
+        self.assertEqual(post.value.created_at, CREATED_AT)
+        self.assertIsNone(post.value.langs)
+        self.assertIsNone(post.value.facets)
+        self.assertIsNone(post.value.reply)
+        image = post.value.embed.images[0]
+        self.assertEqual(image.image.cid.encode(), IMAGE_CID)
+        self.assertEqual(image.image.mime_type, "image/png")
+        self.assertEqual(image.image.size, 1000)
+        self.assertEqual(image.alt, "a cat")
+        self.assertEqual((image.aspect_ratio.width, image.aspect_ratio.height), (800, 600))
+
+    def test_encode_keeps_v1_fields(self):
+        message = _round_trip(_record())
+        self.assertEqual(message["v"], POST_MESSAGE_VERSION)
+        self.assertEqual(message["cid"], CID)
+        self.assertEqual(message["uri"], URI)
+        self.assertEqual(message["author_did"], AUTHOR_DID)
+        self.assertEqual(message["created_at"], CREATED_AT)
+
+    def test_round_trip(self):
+        records = {
+            "minimal": _record(),
+            "full": _record(
+                text="hello @someone",
+                langs=["ja", "en"],
+                facets=[
+                    {
+                        "$type": "app.bsky.richtext.facet",
+                        "index": {"byteStart": 6, "byteEnd": 14},
+                        "features": [
+                            {"$type": "app.bsky.richtext.facet#mention", "did": "did:plc:someone"}
+                        ],
+                    }
+                ],
+                reply={"root": {"uri": URI, "cid": CID}, "parent": {"uri": URI, "cid": CID}},
+                embed={
+                    "$type": "app.bsky.embed.images",
+                    "images": [
+                        _image(alt="first", aspectRatio={"width": 800, "height": 600}),
+                        _image(alt="second"),
+                    ],
+                },
+            ),
+        }
+        for name, record in records.items():
+            with self.subTest(name):
+                message = _round_trip(record)
+                post = decode_post_message(message)
+                self.assertEqual(post.value, record)
+                self.assertEqual(_round_trip(post.value), message)
+
+    def test_image_without_optional_fields(self):
+        message = _round_trip(_record())
+        message["images"] = [{"cid": IMAGE_CID, "mime_type": "image/jpeg", "size": 1}]
+        image = decode_post_message(message).value.embed.images[0]
+        self.assertEqual(image.alt, "")
+        self.assertIsNone(image.aspect_ratio)
+
+
+if __name__ == "__main__":
+    unittest.main()
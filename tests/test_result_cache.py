@@ -0,0 +1,83 @@
+import sys
+import types
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+# settings loads secrets from Secrets Manager on import; the cache only needs the bucket name
+_settings = types.ModuleType("settings")
+_settings.settings = types.SimpleNamespace(WATERMARKED_IMAGE_BUCKET_NAME="watermarked")
+with mock.patch.dict(sys.modules, {"settings": _settings}):
+    from watermarking import result_cache as result_cache_module
+    from watermarking.result_cache import RESULT_CACHE_MAX_AGE_SECS, ResultCache
+
+
+def _head(age_secs: float) -> dict:
+    return {
+        "LastModified": datetime.now(timezone.utc) - timedelta(seconds=age_secs),
+        "ContentType": "image/jpeg",
+        "ContentLength": 1000,
+        "Metadata": {"width": "800", "height": "600"},
+    }
+
+
+def head_object(bucket_name: str, key: str) -> dict:
+    if "/hit/" in key:
+        return _head(0)
+    if "/stale/" in key:
+        return _head(RESULT_CACHE_MAX_AGE_SECS + 60)
+    raise Exception("Not Found")
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(result_cache_module, "head_object", head_object)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        interval = sys.getswitchinterval()
+        # スレッドを頻繁に切り替え、カウンターの更新が競合しやすくする
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+
+    def test_get(self):
+        cache = ResultCache("test")
+        self.assertEqual(
+            cache.get("hit", "v1"),
+            {
+                "key": "results/hit/v1-1",
+                "mime_type": "image/jpeg",
+                "size": 1000,
+                "width": 800,
+                "height": 600,
+            },
+        )
+        self.assertIsNone(cache.get("stale", "v1"))
+        self.assertIsNone(cache.get("missing", "v1"))
+        self.assertEqual((cache.hits.total, cache.misses.total), (1, 2))
+
+    def test_counts_from_worker_threads(self):
+        cache = ResultCache("test")
+        blob_cids = ["hit", "stale", "missing"] * 2000
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda blob_cid: cache.get(blob_cid, "v1"), blob_cids))
+        self.assertEqual(cache.hits.total, 2000)
+        self.assertEqual(cache.misses.total, 4000)
+
+    def test_emit_metrics(self):
+        cache = ResultCache("test")
+        cache.get("hit", "v1")
+        cache.get("missing", "v1")
+        with mock.patch.object(result_cache_module, "emit_emf") as emit_emf:
+            cache.emit_metrics()
+            self.assertEqual(cache.hit_rate.value, 50)
+            cache.get("hit", "v1")
+            cache.emit_metrics()
+            self.assertEqual(cache.hit_rate.value, 100)
+            cache.emit_metrics()
+            self.assertIsNone(cache.hit_rate.value)
+        self.assertEqual(emit_emf.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
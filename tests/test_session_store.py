@@ -0,0 +1,265 @@
+import base64
+import json
+import sys
+import threading
+import time
+import types
+import unittest
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from unittest import mock
+
+from atproto import Session, models
+from cryptography.fernet import Fernet
+
+# settings loads secrets from Secrets Manager on import; lib.fernet only needs the key
+_settings = types.ModuleType("settings")
+_settings.settings = types.SimpleNamespace(FERNET_KEY=Fernet.generate_key().decode())
+with mock.patch.dict(sys.modules, {"settings": _settings}):
+    from lib import store as store_module
+    from lib.bs import client as client_module
+    from lib.bs import session_store as session_store_module
+    from lib.bs.client import StoredSessionClient
+    from lib.bs.session_store import S3SessionBackend, SessionStore
+
+BUCKET = "bucket"
+PREFIX = "bsky_sessions"
+IDENTIFIER = "user.bsky.social"
+DID = "did:plc:user"
+
+
+class InMemoryS3:
+    """The functions of lib.aws.s3 used by S3SessionBackend and S3StringStore, over a dict"""
+
+    def __init__(self):
+        self.objects = {}
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def _put(self, key: str, body: bytes, last_modified: datetime = None) -> str:
+        self._version += 1
+        etag = f'"{self._version}"'
+        self.objects[key] = (body, etag, last_modified or datetime.now(timezone.utc))
+        return etag
+
+    def put_bytes_object_if(self, bucket_name, key, body, etag=None):
+        with self._lock:
+            current = self.objects.get(key)
+            if (current is not None) if etag is None else (current is None or current[1] != etag):
+                return None
+            return self._put(key, body)
+
+    def post_bytes_object(self, bucket_name, key, body):
+        with self._lock:
+            self._put(key, body.read())
+
+    def get_object(self, bucket_name, key):
+        with self._lock:
+            if key not in self.objects:
+                error = Exception("NoSuchKey")
+                error.response = {"Error": {"Code": "NoSuchKey"}}
+                raise error
+            return {"Body": BytesIO(self.objects[key][0])}
+
+    def head_object(self, bucket_name, key):
+        with self._lock:
+            _, etag, last_modified = self.objects[key]
+            return {"ETag": etag, "LastModified": last_modified}
+
+    def delete_object(self, bucket_name, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    def patch(self, test: unittest.TestCase) -> None:
+        for module, name in (
+            (session_store_module, "put_bytes_object_if"),
+            (session_store_module, "get_object"),
+            (session_store_module, "head_object"),
+            (session_store_module, "delete_object"),
+            (store_module, "post_bytes_object"),
+            (store_module, "get_object"),
+        ):
+            patcher = mock.patch.object(module, name, getattr(self, name))
+            patcher.start()
+            test.addCleanup(patcher.stop)
+
+
+def _lease_key(identifier: str) -> str:
+    return f"{PREFIX}/{SessionStore._key(identifier)}.lease"
+
+
+def _jwt(exp: datetime) -> str:
+    def encode(payload: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(payload).encode()).rstrip(b"=").decode()
+
+    header = encode({"alg": "ES256K", "typ": "at+jwt"})
+    payload = encode({"scope": "com.atproto.access", "sub": DID, "exp": int(exp.timestamp())})
+    return f"{header}.{payload}.c2ln"
+
+
+def _session(access_exp: datetime, refresh_jwt: str) -> Session:
+    return Session(IDENTIFIER, DID, _jwt(access_exp), refresh_jwt, "https://pds.example")
+
+
+class LeaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.s3 = InMemoryS3()
+        self.s3.patch(self)
+        for name, value in (
+            ("LEASE_TTL_SECS", 30.0),
+            ("LEASE_WAIT_SECS", 0.5),
+            ("LEASE_POLL_SECS", 0.01),
+        ):
+            patcher = mock.patch.object(session_store_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(session_store_module, "logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _store(self) -> SessionStore:
+        """Store of another process sharing the bucket"""
+        return SessionStore(S3SessionBackend(BUCKET, PREFIX))
+
+
+class TestSessionStoreLease(LeaseTestCase):
+    def test_lease_is_released(self):
+        store = self._store()
+        with store.lease(IDENTIFIER):
+            self.assertIn(_lease_key(IDENTIFIER), self.s3.objects)
+        self.assertNotIn(_lease_key(IDENTIFIER), self.s3.objects)
+
+    def test_lease_is_reentrant(self):
+        store = self._store()
+        with store.lease(IDENTIFIER):
+            with store.lease(IDENTIFIER):
+                pass
+            self.assertIn(_lease_key(IDENTIFIER), self.s3.objects)
+
+    def test_contended_lease_waits_for_holder(self):
+        holder, waiter = self._store(), self._store()
+        events = []
+        acquired = threading.Event()
+
+        def hold():
+            with holder.lease(IDENTIFIER):
+                acquired.set()
+                time.sleep(0.1)
+                events.append("holder released")
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        with waiter.lease(IDENTIFIER):
+            events.append("waiter acquired")
+        thread.join()
+        self.assertEqual(events, ["holder released", "waiter acquired"])
+
+    def test_contended_lease_times_out(self):
+        holder, waiter = self._store(), self._store()
+        with holder.lease(IDENTIFIER):
+            started = time.monotonic()
+            with waiter.lease(IDENTIFIER):
+                # goes on without the lease, and must not release the holder's
+                pass
+            self.assertGreaterEqual(time.monotonic() - started, 0.5)
+            self.assertIn(_lease_key(IDENTIFIER), self.s3.objects)
+        self.assertNotIn(_lease_key(IDENTIFIER), self.s3.objects)
+
+    def test_expired_lease_is_taken_over(self):
+        # left by a holder that died
+        expired_at = datetime.now(timezone.utc) - timedelta(seconds=60)
+        self.s3._put(_lease_key(IDENTIFIER), b'{"owner": "dead"}', expired_at)
+        started = time.monotonic()
+        with self._store().lease(IDENTIFIER):
+            self.assertLess(time.monotonic() - started, 0.5)
+            owner = json.loads(self.s3.objects[_lease_key(IDENTIFIER)][0])["owner"]
+            self.assertNotEqual(owner, "dead")
+        self.assertNotIn(_lease_key(IDENTIFIER), self.s3.objects)
+
+    def test_expired_holder_does_not_release_new_lease(self):
+        holder = self._store()
+        with holder.lease(IDENTIFIER):
+            # the holder stalls past the TTL and another process takes over
+            body, _, _ = self.s3.objects[_lease_key(IDENTIFIER)]
+            expired_at = datetime.now(timezone.utc) - timedelta(seconds=60)
+            self.s3._put(_lease_key(IDENTIFIER), body, expired_at)
+            taken_over = threading.Event()
+            release = threading.Event()
+
+            def take_over():
+                with self._store().lease(IDENTIFIER):
+                    taken_over.set()
+                    release.wait()
+
+            thread = threading.Thread(target=take_over)
+            thread.start()
+            self.assertTrue(taken_over.wait(1))
+        self.assertIn(_lease_key(IDENTIFIER), self.s3.objects)
+        release.set()
+        thread.join()
+        self.assertNotIn(_lease_key(IDENTIFIER), self.s3.objects)
+
+
+class TestStoredSessionClient(LeaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.store = self._store()
+        patcher = mock.patch.object(client_module, "session_store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now = datetime.now(timezone.utc)
+        self.expired = _session(now - timedelta(minutes=1), "refresh-1")
+        self.rotated = _session(now + timedelta(hours=2), "refresh-2")
+
+    def _client(self, session: Session) -> StoredSessionClient:
+        client = StoredSessionClient(identifier=IDENTIFIER)
+        client._import_session_string(session.export())
+        return client
+
+    def test_adopts_session_rotated_by_another_process(self):
+        client = self._client(self.expired)
+        self._store().save(IDENTIFIER, self.rotated.export())
+        with mock.patch.object(client.com.atproto.server, "refresh_session") as refresh_session:
+            client._refresh_and_set_session()
+        refresh_session.assert_not_called()
+        self.assertEqual(client._session.refresh_jwt, "refresh-2")
+
+    def test_refreshes_and_saves_under_lease(self):
+        client = self._client(self.expired)
+        self.store.save(IDENTIFIER, self.expired.export())
+        leased = []
+
+        def refresh_session(*args, **kwargs):
+            leased.append(_lease_key(IDENTIFIER) in self.s3.objects)
+            return models.ComAtprotoServerRefreshSession.Response(
+                access_jwt=self.rotated.access_jwt,
+                refresh_jwt="refresh-2",
+                handle=IDENTIFIER,
+                did=DID,
+            )
+
+        with mock.patch.object(client.com.atproto.server, "refresh_session", refresh_session):
+            client._refresh_and_set_session()
+        self.assertEqual(leased, [True])
+        stored = Session.decode(self._store().get(IDENTIFIER))
+        self.assertEqual(stored.refresh_jwt, "refresh-2")
+
+    def test_refreshes_when_lease_is_contended(self):
+        client = self._client(self.expired)
+        refreshed = mock.Mock(
+            return_value=models.ComAtprotoServerRefreshSession.Response(
+                access_jwt=self.rotated.access_jwt,
+                refresh_jwt="refresh-2",
+                handle=IDENTIFIER,
+                did=DID,
+            )
+        )
+        with self._store().lease(IDENTIFIER):
+            with mock.patch.object(client.com.atproto.server, "refresh_session", refreshed):
+                client._refresh_and_set_session()
+        refreshed.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
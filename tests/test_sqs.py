@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from lib.aws.sqs import AsyncSqsBatchProducer, send_message_batch
+
+QUEUE_URL = "https://sqs.example/queue"
+
+
+class StubSqsClient:
+    """SendMessageBatch stub that fails the entries whose bodies are in `failures`
+
+    `failures` maps a body to the number of attempts that fail, and `sender_fault` to the bodies
+    rejected as the sender's fault on every attempt.
+    """
+
+    def __init__(self, failures: dict = None, sender_fault: set = None, error: Exception = None):
+        self.failures = dict(failures or {})
+        self.sender_fault = set(sender_fault or ())
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def send_message_batch(self, QueueUrl: str, Entries: list) -> dict:
+        with self._lock:
+            self.calls.append((QueueUrl, [entry["MessageBody"] for entry in Entries]))
+            if self.error is not None:
+                raise self.error
+            failed = []
+            for entry in Entries:
+                body = entry["MessageBody"]
+                if body in self.sender_fault:
+                    failed.append({"Id": entry["Id"], "SenderFault": True, "Message": "invalid"})
+                elif self.failures.get(body, 0) > 0:
+                    self.failures[body] -= 1
+                    failed.append({"Id": entry["Id"], "SenderFault": False, "Message": "busy"})
+            return {"Successful": [], "Failed": failed}
+
+    @property
+    def sent_bodies(self) -> list:
+        return [body for _, bodies in self.calls for body in bodies]
+
+
+class QuietTestCase(unittest.TestCase):
+    def setUp(self):
+        for target in ("lib.aws.sqs.time.sleep", "lib.aws.sqs.logger"):
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class TestSendMessageBatch(QuietTestCase):
+    def test_all_sent(self):
+        client = StubSqsClient()
+        self.assertEqual(send_message_batch(client, QUEUE_URL, ["a", "b"]), [])
+        self.assertEqual(client.calls, [(QUEUE_URL, ["a", "b"])])
+
+    def test_retries_only_failed_entries(self):
+        client = StubSqsClient(failures={"b": 1})
+        self.assertEqual(send_message_batch(client, QUEUE_URL, ["a", "b", "c"]), [])
+        self.assertEqual(client.calls, [(QUEUE_URL, ["a", "b", "c"]), (QUEUE_URL, ["b"])])
+
+    def test_gives_up_after_max_attempts(self):
+        client = StubSqsClient(failures={"b": 5})
+        self.assertEqual(send_message_batch(client, QUEUE_URL, ["a", "b"], max_attempts=3), ["b"])
+        self.assertEqual(len(client.calls), 3)
+
+    def test_sender_fault_is_not_retried(self):
+        client = StubSqsClient(failures={"c": 1}, sender_fault={"b"})
+        self.assertEqual(send_message_batch(client, QUEUE_URL, ["a", "b", "c"]), ["b"])
+        self.assertEqual(client.calls, [(QUEUE_URL, ["a", "b", "c"]), (QUEUE_URL, ["c"])])
+
+
+class TestAsyncSqsBatchProducer(QuietTestCase):
+    def _run(self, coro):
+        return asyncio.run(coro)
+
+    def test_flush_sends_without_waiting_for_interval(self):
+        client = StubSqsClient()
+
+        async def run():
+            async with AsyncSqsBatchProducer(client, flush_interval=3600) as producer:
+                await producer.send(QUEUE_URL, "a")
+                await producer.send(QUEUE_URL, "b")
+                dropped = await asyncio.wait_for(producer.flush(), 5)
+                return dropped, list(client.sent_bodies)
+
+        self.assertEqual(self._run(run()), (0, ["a", "b"]))
+
+    def test_flush_after_partial_failure_retry(self):
+        client = StubSqsClient(failures={"b": 2})
+
+        async def run():
+            async with AsyncSqsBatchProducer(client, flush_interval=3600) as producer:
+                for body in ("a", "b", "c"):
+                    await producer.send(QUEUE_URL, body)
+                return await producer.flush()
+
+        self.assertEqual(self._run(run()), 0)
+        self.assertEqual(sorted(set(client.sent_bodies)), ["a", "b", "c"])
+        self.assertEqual(client.sent_bodies.count("b"), 3)
+
+    def test_dropped_counted_once_per_flush(self):
+        client = StubSqsClient(failures={"b": 10}, sender_fault={"c"})
+
+        async def run():
+            async with AsyncSqsBatchProducer(client, flush_interval=3600) as producer:
+                for body in ("a", "b", "c"):
+                    await producer.send(QUEUE_URL, body)
+                first = await producer.flush()
+                await producer.send(QUEUE_URL, "d")
+                second = await producer.flush()
+                return first, second
+
+        self.assertEqual(self._run(run()), (2, 0))
+
+    def test_client_error_drops_whole_batch(self):
+        client = StubSqsClient(error=RuntimeError("unavailable"))
+
+        async def run():
+            producer = AsyncSqsBatchProducer(client, flush_interval=3600)
+            producer.start()
+            for body in ("a", "b"):
+                await producer.send(QUEUE_URL, body)
+            return await producer.close()
+
+        self.assertEqual(self._run(run()), 2)
+
+    def test_batches_per_queue(self):
+        client = StubSqsClient()
+        other_url = "https://sqs.example/other"
+
+        async def run():
+            async with AsyncSqsBatchProducer(client, flush_interval=3600) as producer:
+                for i in range(12):
+                    await producer.send(QUEUE_URL, str(i))
+                await producer.send(other_url, "x")
+                return await producer.flush()
+
+        self.assertEqual(self._run(run()), 0)
+        self.assertTrue(all(len(bodies) <= 10 for _, bodies in client.calls))
+        self.assertEqual(
+            sorted(b for url, bodies in client.calls if url == QUEUE_URL for b in bodies),
+            sorted(str(i) for i in range(12)),
+        )
+        self.assertIn((other_url, ["x"]), client.calls)
+
+    def test_flush_without_start(self):
+        async def run():
+            return await AsyncSqsBatchProducer(StubSqsClient()).flush()
+
+        self.assertEqual(self._run(run()), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()